@@ -0,0 +1,68 @@
+"""
+Cost and gain of the result cache on the IGRF computation.
+
+Times main.compute_columns on random points without a result cache, with an
+empty memory cache (every point is a miss and gets stored) and with the
+same points again (every point is a hit):
+
+    python benchmarks/bench_cache.py [--sizes 10000 300000] [--maxsize 400000]
+
+Batches larger than --maxsize bypass the cache, so their three timings are
+the same.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import igrf_cache
+import main
+
+SIZES = [10000, 300000]
+
+
+def make_columns(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.uniform(-89.0, 89.0, n), rng.uniform(-180.0, 180.0, n),
+            rng.uniform(0.0, 500.0, n), rng.uniform(1950.0, 2025.0, n))
+
+
+def timed(columns):
+    start = time.perf_counter()
+    main.compute_columns(*columns)
+    return time.perf_counter() - start
+
+
+def run(sizes, maxsize):
+    rows = []
+    for n in sizes:
+        columns = make_columns(n)
+        main.result_cache = None
+        uncached = timed(columns)
+        main.result_cache = igrf_cache.MemoryCache(maxsize, ttl=0)
+        cold = timed(columns)
+        repeat = timed(columns)
+        rows.append((n, uncached, cold, repeat))
+    return rows
+
+
+def report(rows):
+    print(f"{'points':>10}  {'no cache':>10}  {'cold':>10}  {'repeat':>10}")
+    for n, uncached, cold, repeat in rows:
+        print(f"{n:>10}  {uncached:>9.3f}s  {cold:>9.3f}s  {repeat:>9.3f}s")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of points per batch")
+    parser.add_argument("--maxsize", type=int, default=400000, help="capacity of the memory cache")
+    args = parser.parse_args()
+    report(run(args.sizes, args.maxsize))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,99 @@
+"""
+Memory used by POST /pyigrf for large point lists.
+
+Compares the array-backed ResultBatch that evaluate_points returns with the
+list of result dictionaries it replaced, measured with tracemalloc:
+
+    held     memory held by the results once they are computed
+    peak     peak memory from the parsed points to the encoded response body
+
+    python benchmarks/bench_memory.py [--sizes 10000 100000 1000000]
+
+The parsed point objects count in both peaks, they are what json.loads
+returns for the point-object formats.
+
+The batch only lowers the peak for requests larger than one encoding chunk
+(main.ENCODE_CHUNK_POINTS, 10000 points), whose result dictionaries are
+built and encoded a chunk at a time. Up to one chunk every dictionary is
+built at once as before, and the arrays of the batch stay alive next to
+them: at 10000 points the peak is about 8% higher (11.9 MB against 11.0 MB).
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_service import make_points
+
+import igrf_encoder
+import main
+
+SIZES = [10000, 100000, 1000000]
+MB = 1024 * 1024
+
+
+def measure(func, *args):
+    """Memory held by the value func returns and the peak while it runs, in bytes"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        value = func(*args)
+        held, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return held - start, peak - start, value
+
+
+def dict_results(points):
+    """The results as one dictionary per point, as POST /pyigrf built them before ResultBatch"""
+    return list(main.evaluate_points(points))
+
+
+def dict_pipeline(points):
+    return igrf_encoder.dumps(dict_results(points))
+
+
+def batch_pipeline(points):
+    return main.evaluate_points(points).to_json()
+
+
+def run(sizes):
+    # Cached results would count as held memory
+    main.result_cache = None
+    # Load the coefficients and build the kernels first, or they count as held by the first size
+    dict_pipeline(make_points(10))
+    batch_pipeline(make_points(10))
+    rows = []
+    for n in sizes:
+        points = make_points(n)
+        held_dicts, _, _ = measure(dict_results, points)
+        held_batch, _, _ = measure(main.evaluate_points, points)
+        _, peak_dicts, body_dicts = measure(dict_pipeline, points)
+        _, peak_batch, body_batch = measure(batch_pipeline, points)
+        if body_dicts != body_batch:
+            raise RuntimeError(f"ResultBatch and dictionaries encode {n} points differently")
+        rows.append((n, held_dicts, held_batch, peak_dicts, peak_batch))
+    return rows
+
+
+def report(rows):
+    print(f"{'points':>10}  {'held (dicts)':>14}  {'held (batch)':>14}  {'peak (dicts)':>14}  {'peak (batch)':>14}  {'peak change':>11}")
+    for n, held_dicts, held_batch, peak_dicts, peak_batch in rows:
+        print(f"{n:>10}  {held_dicts / MB:>11.1f} MB  {held_batch / MB:>11.1f} MB  "
+              f"{peak_dicts / MB:>11.1f} MB  {peak_batch / MB:>11.1f} MB  {peak_batch / peak_dicts - 1:>+11.0%}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of points per request")
+    args = parser.parse_args()
+    report(run(args.sizes))
+
+
+if __name__ == "__main__":
+    main_cli()
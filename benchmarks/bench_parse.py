@@ -0,0 +1,101 @@
+"""
+Parse time and peak memory per MB of input for the /pyigrf body parser.
+
+Compares igrf_parser.parse_points with the json.loads cascade that
+compute_pyigrf used before it, for every accepted body shape.
+
+    python benchmarks/bench_parse.py [--sizes 1000 100000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import igrf_parser
+
+SIZES = [1000, 100000]
+DEVNULL = open(os.devnull, "w")
+
+
+def legacy_parse(body):
+    """The parsing cascade of compute_pyigrf before the single-pass parser, including its logging"""
+    body_str = body.decode('utf-8')
+    data = json.loads(body_str)
+    print("Data: ", data, file=DEVNULL)
+    if isinstance(data, dict) and "points_json" in data:
+        points_json_str = data["points_json"]
+        print("points_json_str in data: ", points_json_str, file=DEVNULL)
+        if isinstance(points_json_str, list):
+            parsed_points = points_json_str
+            print("parsed_points as list: ", parsed_points, file=DEVNULL)
+        else:
+            parsed_points = json.loads(points_json_str)
+        if isinstance(parsed_points, dict) and "points_json" in parsed_points:
+            return parsed_points["points_json"]
+        return parsed_points
+    try:
+        parsed_body = json.loads(body_str)
+    except json.JSONDecodeError:
+        parsed_body = json.loads(body_str.strip('"').replace('\\"', '"'))
+    print("Parsed body without point_json key: ", parsed_body, file=DEVNULL)
+    if isinstance(parsed_body, dict) and "points_json" in parsed_body:
+        return parsed_body["points_json"]
+    return parsed_body
+
+
+def make_points(n):
+    return [{"latitude": str(13.9375 - (i // 1000) * 0.125), "longitude": str(4.0625 + (i % 1000) * 0.125),
+             "altitude": "253.74992", "year": "2024.9"} for i in range(n)]
+
+
+def make_bodies(n):
+    points = make_points(n)
+    array = json.dumps(points)
+    return {
+        "bare array": array,
+        "points_json array": json.dumps({"points_json": points}),
+        "points_json string": json.dumps({"points_json": array}),
+        "doubly stringified": json.dumps({"points_json": json.dumps({"points_json": points})}),
+    }
+
+
+def measure(parse, body, repeat=3):
+    """Best wall time and peak traced allocation of parse(body)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(body)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    parse(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def run(sizes):
+    decoder = "orjson" if igrf_parser.orjson is not None else "json"
+    print(f"decoder: {decoder}")
+    print(f"{'points':>8} {'shape':<20} {'MB':>7} {'parser':<8} {'s/MB':>8} {'peak MB/MB':>11}")
+    for n in sizes:
+        for shape, text in make_bodies(n).items():
+            body = text.encode()
+            mb = len(body) / 1e6
+            for name, parse in (("legacy", legacy_parse), ("single", igrf_parser.parse_points)):
+                seconds, peak = measure(parse, body)
+                print(f"{n:>8} {shape:<20} {mb:>7.2f} {name:<8} {seconds / mb:>8.4f} {peak / 1e6 / mb:>11.2f}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of points per body")
+    args = parser.parse_args()
+    run(args.sizes)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,144 @@
+"""
+End-to-end and per-stage timings of the IGRF endpoints.
+
+Posts synthetic point sets to POST /pyigrf (bare array and points_json
+bodies) and POST /pyigrf/model through an in-process ASGI client, then times
+the stages of /pyigrf on the same body: parsing, validation, the IGRF
+computation, collecting the results into a ResultBatch and encoding the response.
+
+    python benchmarks/bench_service.py [--sizes 1 1000 100000 1000000]
+                                       [--save baseline.json] [--compare baseline.json]
+
+With --compare, every timing is shown next to the baseline and the script
+exits with status 1 when one of them is slower than --tolerance times the
+baseline.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+import igrf_parser
+import main
+
+DEVNULL = open(os.devnull, "w")
+SIZES = [1, 1000, 100000, 1000000]
+# Timings faster than this are too noisy to compare against a baseline
+MIN_COMPARED_SECONDS = 0.005
+
+
+def make_points(n, seed=0):
+    """Random valid points at one epoch with stringified values, like the ones in test_main.http"""
+    rng = random.Random(seed)
+    return [{"latitude": str(rng.uniform(-90, 90)), "longitude": str(rng.uniform(-180, 180)),
+             "altitude": str(rng.uniform(0, 1000)), "year": "2024.9"}
+            for _ in range(n)]
+
+
+def make_requests(points):
+    """Endpoint, body format and body of every end-to-end request"""
+    array = json.dumps(points)
+    return [
+        ("/pyigrf", "bare array", array.encode()),
+        ("/pyigrf", "points_json", json.dumps({"points_json": points}).encode()),
+        ("/pyigrf/model", "points_json", json.dumps({"points_json": array}).encode()),
+    ]
+
+
+def best_of(repeat, func, *args):
+    """Best wall time of repeat calls and the value of the last one"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, value
+
+
+def stage_timings(body, repeat):
+    """Timings of each stage of POST /pyigrf for one body"""
+    timings = {}
+    timings["parse"], points = best_of(repeat, igrf_parser.parse_points, body)
+    timings["validate"], (fixed, positions, columns, _) = best_of(repeat, main.validate_points, points)
+    timings["compute"], components = best_of(repeat, main.compute_columns, *columns)
+    timings["format"], results = best_of(repeat, main.ResultBatch, len(points), positions, columns, components, fixed)
+    # Result dictionaries are built a chunk at a time while the batch is encoded
+    timings["encode"], _ = best_of(repeat, main.json_response, results)
+    return timings
+
+
+def run(sizes):
+    # Every body is posted several times, time the computation rather than the result cache
+    main.result_cache = None
+    client = TestClient(main.app)
+    timings = {}
+    for n in sizes:
+        repeat = max(1, min(20, 100000 // n))
+        for path, body_format, body in make_requests(make_points(n)):
+            with contextlib.redirect_stdout(DEVNULL):
+                seconds, response = best_of(repeat, client.post, path, body)
+                stages = stage_timings(body, repeat) if path == "/pyigrf" else {}
+            if response.status_code != 200:
+                raise RuntimeError(f"{path} returned {response.status_code} for {n} points")
+            timings[f"{path} {body_format} {n}"] = dict(end_to_end=seconds, **stages)
+    return timings
+
+
+def report(timings, baseline=None, tolerance=1.25):
+    """Print the timings, next to the baseline if there is one, and return the regressions"""
+    regressions = []
+    for key, stages in timings.items():
+        print(key)
+        for stage, seconds in stages.items():
+            line = f"    {stage:<12} {seconds * 1000:>10.2f} ms"
+            previous = (baseline or {}).get(key, {}).get(stage)
+            if previous:
+                ratio = seconds / previous
+                line += f"  baseline {previous * 1000:>10.2f} ms  x{ratio:.2f}"
+                if ratio > tolerance and seconds >= MIN_COMPARED_SECONDS:
+                    line += "  REGRESSION"
+                    regressions.append(f"{key} {stage}")
+            print(line)
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of points per request")
+    parser.add_argument("--save", help="write the timings to this baseline file")
+    parser.add_argument("--compare", help="compare the timings with this baseline file")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="slowdown over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["timings"]
+
+    timings = run(args.sizes)
+    regressions = report(timings, baseline, args.tolerance)
+
+    if args.save:
+        meta = {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                "cpus": os.cpu_count(), "date": time.strftime("%Y-%m-%d")}
+        with open(args.save, "w") as f:
+            json.dump({"meta": meta, "timings": timings}, f, indent=2)
+            f.write("\n")
+        print(f"Saved baseline to {args.save}")
+
+    if regressions:
+        print(f"{len(regressions)} regressions over x{args.tolerance}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,86 @@
+"""
+Throughput of many concurrent small POST /pyigrf requests.
+
+Starts the app with uvicorn once with micro-batching off and once for each
+batching window given, and has --clients threads send requests of
+--points random points (5, like the sample in test_main.http) for
+--seconds. The result cache is turned off so every point is computed.
+
+    python benchmarks/bench_small_requests.py [--clients 32] [--points 5] [--seconds 10] [--windows 1,2,5]
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_health import free_port, make_points, wait_until_up
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def client(port, points, stop, latencies):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    while not stop.is_set():
+        body = json.dumps(make_points(points))
+        start = time.perf_counter()
+        connection.request("POST", "/pyigrf", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"POST /pyigrf returned {response.status}")
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def run(window_ms, clients, points, seconds):
+    """Requests per second and the latencies of one server setting"""
+    port = free_port()
+    env = dict(os.environ, IGRF_BATCH_WINDOW_MS=str(window_ms), IGRF_RESULT_CACHE="off")
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_up(f"http://127.0.0.1:{port}/")
+        stop = threading.Event()
+        latencies = [[] for _ in range(clients)]
+        threads = [threading.Thread(target=client, args=(port, points, stop, samples)) for samples in latencies]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+    samples = sorted(sample for thread_samples in latencies for sample in thread_samples)
+    return len(samples) / elapsed, samples
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--points", type=int, default=5)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--windows", default="1,2,5", help="batching windows in milliseconds, comma separated")
+    args = parser.parse_args()
+
+    random.seed(0)
+    for window_ms in [0.0] + [float(window) for window in args.windows.split(",")]:
+        rate, samples = run(window_ms, args.clients, args.points, args.seconds)
+        label = "off" if window_ms == 0 else f"{window_ms:g} ms"
+        print(f"window {label:>7}  {rate:8.1f} requests/s  latency median {statistics.median(samples) * 1000:7.1f} ms"
+              f"  p99 {samples[int(0.99 * (len(samples) - 1))] * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,98 @@
+"""
+Cold start time of the service.
+
+Every run starts a fresh interpreter, as a new instance does when it is
+scaled up:
+
+    import   python -c "import main", interpreter start included
+    ready    from launching uvicorn to the first answered GET /
+    first    the first POST /pyigrf of one point after that, which loads the
+             coefficients and builds the recursion plans
+
+    python benchmarks/bench_startup.py [--runs 5] [--imports 15]
+
+--imports lists the modules that take the longest to import with main,
+from python -X importtime.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_health import free_port, get, wait_until_up
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POINT = [{"latitude": "45", "longitude": "10", "altitude": "100", "year": "2024.9"}]
+
+
+def time_import():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main"], cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def time_server():
+    """Seconds until uvicorn answers GET /, the duration of the first POST /pyigrf and of a later GET /"""
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                              cwd=ROOT, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_up(base + "/", poll_interval=0.005)
+        ready = time.perf_counter() - start
+        request = urllib.request.Request(base + "/pyigrf", data=json.dumps(POINT).encode(),
+                                         headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+        first = time.perf_counter() - start
+        # The answer of a warm server, for comparison
+        warm = get(base + "/")
+    finally:
+        server.terminate()
+        server.wait()
+    return ready, first, warm
+
+
+def slowest_imports(count):
+    """Modules imported by main with the largest cumulative import time, in seconds"""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT,
+                            capture_output=True, text=True, check=True).stderr
+    modules = []
+    for line in output.splitlines()[1:]:
+        _, _, cumulative, name = (part.strip() for part in line.replace("import time:", "|").split("|"))
+        modules.append((int(cumulative) / 1e6, name))
+    return sorted(modules, reverse=True)[:count]
+
+
+def summary(samples):
+    return f"median {statistics.median(samples) * 1000:8.1f} ms  min {min(samples) * 1000:8.1f} ms"
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per measurement")
+    parser.add_argument("--imports", type=int, default=0, help="number of slowest imports to list")
+    args = parser.parse_args()
+
+    imports = [time_import() for _ in range(args.runs)]
+    servers = [time_server() for _ in range(args.runs)]
+    print(f"import   {summary(imports)}")
+    print(f"ready    {summary([ready for ready, _, _ in servers])}")
+    print(f"first    {summary([first for _, first, _ in servers])}")
+    print(f"warm GET {summary([warm for _, _, warm in servers])}")
+    if args.imports:
+        print("\nslowest imports (cumulative)")
+        for seconds, name in slowest_imports(args.imports):
+            print(f"  {seconds * 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,118 @@
+"""
+Health-check latency while a large batch is in flight.
+
+Starts the app with uvicorn, measures GET / latency on an idle server,
+then again while a large POST /pyigrf is being computed. With the compute
+path off the event loop both sets of numbers should be about the same.
+
+    python benchmarks/load_health.py [--points 200000] [--samples 50]
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES = 50
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get(url, timeout=60):
+    """Latency of one GET in seconds"""
+    start = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def wait_until_up(url, timeout=30, poll_interval=0.2):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            get(url, timeout=1)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(poll_interval)
+
+
+def make_points(n):
+    rng = random.Random(0)
+    return [{"latitude": str(rng.uniform(-90, 90)), "longitude": str(rng.uniform(-180, 180)),
+             "altitude": str(rng.uniform(0, 1000)), "year": "2024.9"} for _ in range(n)]
+
+
+def latencies(url, stop=None, count=SAMPLES):
+    """GET latencies, count of them or until stop is set"""
+    samples = []
+    while len(samples) < count or (stop is not None and not stop.is_set()):
+        samples.append(get(url))
+        if stop is not None and stop.is_set():
+            break
+        time.sleep(0.02)
+    return samples
+
+
+def summary(samples):
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2]
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    return f"n={len(samples):<5} p50={p50 * 1000:8.2f} ms  p95={p95 * 1000:8.2f} ms  max={samples[-1] * 1000:8.2f} ms"
+
+
+def run(n, count=SAMPLES):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                              cwd=ROOT, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_up(base + "/")
+        print(f"idle        {summary(latencies(base + '/', count=count))}")
+
+        body = json.dumps(make_points(n)).encode()
+        done = threading.Event()
+        elapsed = []
+
+        def post():
+            request = urllib.request.Request(base + "/pyigrf", data=body, headers={"Content-Type": "application/json"})
+            start = time.perf_counter()
+            with urllib.request.urlopen(request, timeout=600) as response:
+                response.read()
+            elapsed.append(time.perf_counter() - start)
+            done.set()
+
+        worker = threading.Thread(target=post)
+        worker.start()
+        # Give the server time to read the body and start computing
+        time.sleep(0.5)
+        busy = latencies(base + "/", stop=done, count=count)
+        worker.join()
+        print(f"busy        {summary(busy)}")
+        print(f"batch of {n} points took {elapsed[0]:.2f} s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--points", type=int, default=200000, help="points in the large request")
+    parser.add_argument("--samples", type=int, default=SAMPLES, help="minimum number of health checks per measurement")
+    args = parser.parse_args()
+    run(args.points, args.samples)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,145 +1,429 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
+import hashlib
+import logging
 import os
+import re
 import sys
+import threading
+import time
+from functools import lru_cache
 
-def load_coeffs(filename):
+import numpy as np
+
+# Named explicitly so the messages keep the same logger when this file is run as a script
+logger = logging.getLogger("pyIGRF.loadCoeffs")
+
+# Number of interpolated coefficient sets (one per decimal year) kept in memory per model
+COEFFS_CACHE_SIZE = int(os.environ.get("IGRF_COEFFS_CACHE_SIZE", 256))
+
+# The default model: IGRF_COEFFS_FILE, or src/igrf14coeffs.txt of the package this file is installed in.
+# Its compiled table (see compile_coeffs) is used instead when it exists next to it.
+COEFFS_FILE = os.environ.get("IGRF_COEFFS_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src', 'igrf14coeffs.txt')
+# Directory of more coefficient files, each one a model named after its header or its file
+MODELS_DIR = os.environ.get("IGRF_MODELS_DIR", "")
+# Name of the model used when a request does not choose one, the model of COEFFS_FILE by default
+DEFAULT_MODEL = os.environ.get("IGRF_DEFAULT_MODEL", "")
+# Seconds between two checks of the coefficient files for changes, 0 to only reload on request
+RELOAD_SECONDS = float(os.environ.get("IGRF_MODELS_RELOAD_SECONDS", 10))
+# Layout version of the compiled tables, stored in their first row. Bump it when compile_coeffs changes the layout
+TABLE_FORMAT = 2
+
+
+def parse_table(filename):
     """
-    load igrf14 coeffs from file
+    Parse a coefficients file in the IGRF text format. The epochs come from
+    the "g/h n m" header line, where a label such as 2025-30 marks the
+    secular variation column.
     :param filename: file which save coeffs (str)
-    :return: g and h list one by one (list(float))
-    """
-    gh = []
-    gh2arr = []
-
-    # Try multiple possible locations for the coefficients file
-    possible_paths = [
-        filename,
-        os.path.dirname(os.path.abspath(__file__)) + '/src/igrf14coeffs.txt',
-        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src', 'igrf14coeffs.txt'),
-        '/opt/render/project/src/.venv/lib/python3.11/site-packages/pyIGRF/src/igrf14coeffs.txt',
-        '/opt/render/project/.venv/lib/python3.11/site-packages/pyIGRF/src/igrf14coeffs.txt',
-        '/opt/render/project/src/.venv/lib/python3.9/site-packages/pyIGRF/src/igrf14coeffs.txt',
-        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'custom_igrf14coeffs.txt'),
-        # Additional paths to try
-        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'site-packages', 'pyIGRF', 'src', 'igrf14coeffs.txt'),
-        os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'custom_igrf14coeffs.txt'),
-        os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'site-packages', 'pyIGRF', 'src', 'igrf14coeffs.txt'),
-        # Try absolute paths
-        '/app/custom_igrf14coeffs.txt',
-        '/app/site-packages/pyIGRF/src/igrf14coeffs.txt',
-        '/opt/render/project/src/custom_igrf14coeffs.txt',
-        '/opt/render/project/src/site-packages/pyIGRF/src/igrf14coeffs.txt'
-    ]
-
-    # Try each path until we find one that works
-    for path in possible_paths:
+    :return: epochs (ndarray), whether the last column is the secular variation (bool),
+             g (0) or h (1), n and m of each row (ndarray(int)), and the values (ndarray, rows x columns)
+    """
+    labels = None
+    keys, values = [], []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if line[:3] == 'g/h':
+                labels = fields[3:]
+            elif line[:2] == 'g ' or line[:2] == 'h ':
+                keys.append((0 if fields[0] == 'g' else 1, int(fields[1]), int(fields[2])))
+                values.append([float(x) for x in fields[3:]])
+    if labels is None or not keys:
+        raise ValueError(f"{filename} is not an IGRF coefficients file, it has no 'g/h n m' header or no coefficients")
+    secular = '-' in labels[-1][1:]
+    epochs = np.array([float(label) for label in (labels[:-1] if secular else labels)])
+    keys = np.array(keys, dtype=int)
+    return epochs, secular, keys[:, 0], keys[:, 1], keys[:, 2], np.array(values)
+
+
+def model_name(filename):
+    """
+    :return: igrf<generation> for a file whose header names the IGRF generation, else the file name
+             without its extension and a trailing "coeffs" (str)
+    """
+    with open(filename) as f:
+        match = re.search(r'(\d+)(?:st|nd|rd|th) Generation International Geomagnetic Reference Field', f.readline())
+    if match:
+        return f"igrf{match.group(1)}"
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return re.sub(r'coeffs$', '', stem) or stem
+
+
+def binary_path(filename):
+    """
+    :param filename: text coefficients file (str)
+    :return: path of the compiled binary table next to it (str)
+    """
+    return os.path.splitext(filename)[0] + '.npy'
+
+
+def compile_coeffs(filename, output=None):
+    """
+    Compile the text coefficients file into a float64 .npy table that
+    load_table memory-maps instead of parsing the text. The first row holds
+    the secular variation flag, TABLE_FORMAT, the number of coefficient rows
+    and the epochs, every other row g (0) or h (1), n, m and the values of
+    one coefficient.
+    :param filename: text coefficients file (str)
+    :param output: binary file to write, defaults to binary_path(filename) (str)
+    :return: path of the written file (str)
+    """
+    output = output or binary_path(filename)
+    epochs, secular, kind, n, m, values = parse_table(filename)
+    header = np.full(3 + values.shape[1], np.nan)
+    header[:3] = secular, TABLE_FORMAT, len(kind)
+    header[3:3 + len(epochs)] = epochs
+    table = np.vstack([header, np.column_stack([kind, n, m, values])]).astype('<f8')
+    # Write to a temporary file first so running workers never map a partial table
+    tmp = f"{output}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        np.save(f, table)
+    os.replace(tmp, output)
+    return output
+
+
+def read_table(binary):
+    """
+    Memory-map a table written by compile_coeffs
+    :param binary: compiled table (str)
+    :raises ValueError: when the table has another TABLE_FORMAT or is truncated
+    :return: as parse_table
+    """
+    table = np.load(binary, mmap_mode='r')
+    if table.ndim != 2 or table.shape[1] < 4 or table[0, 1] != TABLE_FORMAT or table[0, 2] != table.shape[0] - 1:
+        raise ValueError(f"{binary} is not a compiled coefficients table of format {TABLE_FORMAT}")
+    header, rows = table[0], table[1:]
+    epochs = header[3:][~np.isnan(header[3:])]
+    return (np.array(epochs), bool(header[0]), rows[:, 0].astype(int), rows[:, 1].astype(int),
+            rows[:, 2].astype(int), rows[:, 3:])
+
+
+def load_table(filename):
+    """
+    load a coefficients file, memory-mapping the compiled binary table when
+    it exists next to the text file. A table older than the text file or of
+    another format is compiled again, and the text file is parsed when that
+    fails or there is no table
+    :param filename: file which save coeffs (str)
+    :return: as parse_table
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f"IGRF coefficients file not found at {filename}, set IGRF_COEFFS_FILE to its path")
+    # The compiled table is shared read-only between workers through the page cache
+    binary = binary_path(filename)
+    if os.path.exists(binary):
+        try:
+            if os.path.getmtime(binary) < os.path.getmtime(filename):
+                raise ValueError(f"{binary} is older than {filename}")
+            table = read_table(binary)
+            logger.info(f"Memory-mapped coefficients file at: {binary}")
+            return table
+        except (OSError, ValueError, IndexError) as e:
+            logger.warning(f"Compiling the stale coefficients table again: {e}")
         try:
-            with open(path) as f:
-                print(f"Successfully opened coefficients file at: {path}")
-                text = f.readlines()
-                for a in text:
-                    if a[:2] == 'g ' or a[:2] == 'h ':
-                        b = a.split()[3:]
-                        b = [float(x) for x in b]
-                        gh2arr.append(b)
-                gh2arr = [list(row) for row in zip(*gh2arr)]
-                N = len(gh2arr)
-                for i in range(N):
-                    if i < 19:
-                        for j in range(120):
-                            gh.append(gh2arr[i][j])
-                    else:
-                        for p in gh2arr[i]:
-                            gh.append(p)
-                gh.append(0)
-                return gh
-        except Exception as e:
-            print(f"Failed to open coefficients file at {path}: {e}")
-            continue
-
-    # If we get here, we couldn't find the file anywhere
-    print("ERROR: Could not find igrf14coeffs.txt in any of the expected locations.")
-    print("Searched in:")
-    for path in possible_paths:
-        print(f"  - {path}")
-
-    # Create a dummy coefficients file with minimal data to prevent crashes
-    print("Creating dummy coefficients to prevent crashes...")
-    # Return a minimal set of coefficients to prevent crashes
-    # This is not accurate but will allow the application to start
-    return [0.0] * 3060  # Approximate size needed for the coefficients
-
-# Try to load the coefficients
-try:
-    gh = load_coeffs(os.path.dirname(os.path.abspath(__file__)) + '/src/igrf14coeffs.txt')
-except Exception as e:
-    print(f"Error loading coefficients: {e}")
-    # Provide dummy coefficients to prevent crashes
-    gh = [0.0] * 3060  # Approximate size needed for the coefficients
+            table = read_table(compile_coeffs(filename, binary))
+            logger.info(f"Compiled and memory-mapped coefficients file at: {binary}")
+            return table
+        except OSError as e:
+            logger.warning(f"Failed to compile coefficients file at {binary}, parsing {filename} instead: {e}")
+    table = parse_table(filename)
+    logger.info(f"Parsed coefficients file at: {filename}")
+    return table
+
+
+def term_count(nmx):
+    """:return: number of (n, m) terms for n=1..nmx, m=0..n (int)"""
+    return nmx * (nmx + 3) // 2
+
+
+class CoefficientModel:
+    """
+    The coefficients of one file indexed by epoch and term: g and h of every
+    model epoch with one column per (n, m) for n=1..nmax, m=0..n, and the
+    secular variation after the last epoch. The degree of each epoch is the
+    highest with a nonzero coefficient.
+    """
+
+    def __init__(self, name, filename, table):
+        epochs, secular, kind, n, m, values = table
+        self.name = name
+        self.filename = filename
+        self.epochs = epochs
+        self.nmax = int(n.max())
+        index = n * (n + 1) // 2 - 1 + m
+        g = np.zeros((values.shape[1], term_count(self.nmax)))
+        h = np.zeros((values.shape[1], term_count(self.nmax)))
+        g[:, index[kind == 0]] = values[kind == 0].T
+        h[:, index[kind == 1]] = values[kind == 1].T
+        self.g, self.h = g[:len(epochs)], h[:len(epochs)]
+        self.sv_g, self.sv_h = (g[-1], h[-1]) if secular else (np.zeros(g.shape[1]), np.zeros(h.shape[1]))
+        self.secular = secular
+
+        nonzero = (values != 0)
+        self.degrees = np.array([int(n[nonzero[:, column]].max(initial=0)) for column in range(len(epochs))])
+        # An interval between two epochs goes to the higher of their degrees (1995-2000 to degree 13 as the
+        # 2000 model), the extrapolation from the last epoch to its degree
+        self.interval_degrees = np.append(np.maximum(self.degrees[:-1], self.degrees[1:]), self.degrees[-1])
+        self.start = float(epochs[0])
+        self.interval = float(epochs[-1] - epochs[-2]) if len(epochs) > 1 else 5.0
+        # With a secular variation the model is intended for one interval past its last epoch, and computed for two
+        self.intended_end = float(epochs[-1] + self.interval) if secular else float(epochs[-1])
+        self.end = float(epochs[-1] + 2 * self.interval) if secular else float(epochs[-1])
+        self.digest = hashlib.sha256(b"".join(np.ascontiguousarray(a, dtype='<f8').tobytes()
+                                              for a in (epochs, self.g, self.h, self.sv_g, self.sv_h))).hexdigest()[:16]
+        self.coeffs = lru_cache(maxsize=COEFFS_CACHE_SIZE)(self._coeffs)
+
+    def _coeffs(self, date):
+        """
+        Interpolated coefficients for one date as flat contiguous arrays,
+        cached per decimal year by self.coeffs.
+        :param date: float
+        :return: nmx (int), g (ndarray), h (ndarray) with one value per (n, m) for n=1..nmx, m=0..n
+                 and h = 0 for m = 0, or 0, None, None if the date is out of range
+        """
+        if date < self.start or date > self.end:
+            logger.warning('This subroutine will not work with a date of ' + str(date)
+                           + f'. Date must be in the range {self.start} <= date <= {self.end}. On return [], []')
+            return 0, None, None
+        elif date >= self.epochs[-1]:
+            if date > self.intended_end:
+                # not adapt for the model but can calculate
+                logger.warning(f'This version of the IGRF is intended for use up to {self.intended_end}. values for '
+                               + str(date) + ' will be computed but may be of reduced accuracy')
+            t = date - self.epochs[-1]
+            nmx = int(self.interval_degrees[-1])
+            g = self.g[-1] + t * self.sv_g
+            h = self.h[-1] + t * self.sv_h
+        else:
+            i = int(np.searchsorted(self.epochs, date, side='right')) - 1
+            t = (date - self.epochs[i]) / (self.epochs[i + 1] - self.epochs[i])
+            nmx = int(self.interval_degrees[i])
+            g = (1.0 - t) * self.g[i] + t * self.g[i + 1]
+            h = (1.0 - t) * self.h[i] + t * self.h[i + 1]
+        g = np.ascontiguousarray(g[:term_count(nmx)])
+        h = np.ascontiguousarray(h[:term_count(nmx)])
+        # The arrays are shared by every caller of the cache
+        g.flags.writeable = False
+        h.flags.writeable = False
+        return nmx, g, h
+
+    def degree(self, dates):
+        """
+        :param dates: decimal years in the model range (ndarray)
+        :return: the degree the coefficients of each date go to (ndarray(int))
+        """
+        interval = np.clip(np.searchsorted(self.epochs, dates, side='right') - 1, 0, len(self.epochs) - 1)
+        return self.interval_degrees[interval]
+
+    def series(self, years):
+        """
+        Interpolated coefficients and their rate of change for many epochs at
+        once, matching coeffs(year) for each year.
+        :param years: decimal years in the model range (ndarray)
+        :return: g, h, dg/dt, dh/dt with one row per year, padded to degree nmax (ndarray, nT and nT/year)
+        :raise ValueError: for years outside the model range, which coeffs() has no coefficients for either
+        """
+        years = np.asarray(years, dtype=float)
+        outside = ~((years >= self.start) & (years <= self.end))
+        if outside.any():
+            raise ValueError(f"Years must be in the range {self.start} <= year <= {self.end} of model {self.name}, "
+                             f"got {years[outside][0]}")
+        # Without a secular variation the last epoch ends the last interval, and keeps its rate of change
+        extrapolated = (years >= self.epochs[-1]) & self.secular
+        interval = np.clip(np.searchsorted(self.epochs, years, side='right') - 1, 0, max(len(self.epochs) - 2, 0))
+        upper = np.minimum(interval + 1, len(self.epochs) - 1)
+        span = np.where(upper > interval, self.epochs[upper] - self.epochs[interval], 1.0)[:, None]
+        t = (years[:, None] - self.epochs[interval][:, None]) / span
+        # Terms above the degree of the interval are zero, as in coeffs
+        short = np.arange(term_count(self.nmax))[None, :] >= term_count(self.degree(years))[:, None]
+        series_g = np.where(short, 0.0, (1.0 - t) * self.g[interval] + t * self.g[upper])
+        series_h = np.where(short, 0.0, (1.0 - t) * self.h[interval] + t * self.h[upper])
+        rate_g = np.where(short, 0.0, (self.g[upper] - self.g[interval]) / span)
+        rate_h = np.where(short, 0.0, (self.h[upper] - self.h[interval]) / span)
+
+        if extrapolated.any():
+            dt = (years[extrapolated] - self.epochs[-1])[:, None]
+            series_g[extrapolated] = self.g[-1] + dt * self.sv_g
+            series_h[extrapolated] = self.h[-1] + dt * self.sv_h
+            rate_g[extrapolated] = self.sv_g
+            rate_h[extrapolated] = self.sv_h
+        return series_g, series_h, rate_g, rate_h
+
+    def info(self):
+        """:return: description of the model for the API (dict)"""
+        return {"name": self.name, "file": self.filename, "epochs": [float(self.epochs[0]), float(self.epochs[-1])],
+                "valid_from": self.start, "valid_to": self.end, "max_degree": self.nmax,
+                "secular_variation": self.secular, "digest": self.digest}
+
+
+def file_version(filename):
+    """:return: what changes when the file is replaced or rewritten (tuple)"""
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ModelRegistry:
+    """
+    Coefficient models by name: the default file and every *.txt file of a
+    directory. Files are checked for changes at most every reload_seconds
+    when a model is looked up, so a replaced or new file is loaded by every
+    process without a restart. A file that fails to load keeps the model
+    loaded before it.
+    """
+
+    def __init__(self, default_file, models_dir="", default_name="", reload_seconds=10.0):
+        self.default_file = default_file
+        self.models_dir = models_dir
+        self.default_name = default_name
+        self.reload_seconds = reload_seconds
+        self.models = {}
+        self.versions = {}
+        self.checked = 0.0
+        self._lock = threading.Lock()
+        self.reload()
+        if self.default_name not in self.models:
+            raise KeyError(f"Default model {self.default_name!r} is not one of the loaded models {sorted(self.models)}")
+
+    def files(self):
+        """:return: the coefficient files of the registry, the default one first (list)"""
+        files = [self.default_file]
+        if self.models_dir:
+            files += sorted(os.path.join(self.models_dir, name) for name in os.listdir(self.models_dir)
+                            if name.endswith('.txt') and os.path.join(self.models_dir, name) != self.default_file)
+        return files
+
+    def reload(self):
+        """
+        Load the files that are new or changed since they were loaded.
+        :return: the names of the models loaded (list)
+        """
+        with self._lock:
+            self.checked = time.monotonic()
+            models = dict(self.models)
+            loaded = []
+            for filename in self.files():
+                try:
+                    version = file_version(filename)
+                    if self.versions.get(filename) == version:
+                        continue
+                    name = model_name(filename)
+                    if name in models and models[name].filename != filename:
+                        logger.warning(f"Model {name} of {filename} is already loaded from {models[name].filename}, skipped")
+                        self.versions[filename] = version
+                        continue
+                    models[name] = CoefficientModel(name, filename, load_table(filename))
+                    self.versions[filename] = version
+                    loaded.append(name)
+                    logger.info(f"Loaded model {name} from {filename}")
+                except (OSError, ValueError) as e:
+                    if filename == self.default_file and not self.models:
+                        raise
+                    logger.error(f"Failed to load coefficients file {filename}: {e}")
+            if not self.default_name:
+                self.default_name = model_name(self.default_file)
+            # Lookups read the dict without the lock, replace it as a whole
+            self.models = models
+            return loaded
+
+    def get(self, name=None):
+        """
+        :param name: model name, None for the default model (str)
+        :return: CoefficientModel
+        :raise KeyError: for an unknown name
+        """
+        if self.reload_seconds > 0 and time.monotonic() - self.checked > self.reload_seconds:
+            self.reload()
+        model = self.models.get(name or self.default_name)
+        if model is None:
+            # The file may have been added since the last check, e.g. when another process was asked to reload
+            self.reload()
+            model = self.models.get(name or self.default_name)
+        if model is None:
+            raise KeyError(f"Unknown model {name!r}, the models are {', '.join(sorted(self.models))}")
+        return model
+
+
+@lru_cache(maxsize=1)
+def registry():
+    """
+    The models of COEFFS_FILE and MODELS_DIR, loaded on first use
+    :return: ModelRegistry
+    """
+    return ModelRegistry(COEFFS_FILE, MODELS_DIR, DEFAULT_MODEL, RELOAD_SECONDS)
+
+
+def get_model(name=None):
+    """
+    :param name: model name, None for the default model (str)
+    :return: CoefficientModel
+    """
+    return registry().get(name)
+
+
+def get_coeffs_flat(date, model=None):
+    """
+    Interpolated coefficients for one date as flat contiguous arrays.
+    Results are cached per model and decimal year, see coeffs_cache_info().
+    :param date: float
+    :param model: model name, None for the default model (str)
+    :return: nmx (int), g (ndarray), h (ndarray) with one value per (n, m) for n=1..nmx, m=0..n
+             and h = 0 for m = 0, or 0, None, None if the date is out of range
+    """
+    return get_model(model).coeffs(float(date))
+
+
+def coeffs_cache_info():
+    """
+    :return: hit/miss counters of the per-date caches of the loaded models (dict)
+    """
+    infos = [model.coeffs.cache_info() for model in registry().models.values()]
+    return {"hits": sum(info.hits for info in infos), "misses": sum(info.misses for info in infos),
+            "maxsize": COEFFS_CACHE_SIZE * len(infos), "currsize": sum(info.currsize for info in infos)}
+
 
 def get_coeffs(date):
     """
-    :param gh: list from load_coeffs
     :param date: float
     :return: list: g, list: h
     """
-    if date < 1900.0 or date > 2035.0:
-        print('This subroutine will not work with a date of ' + str(date))
-        print('Date must be in the range 1900.0 <= date <= 2035.0')
-        print('On return [], []')
+    nmx, flat_g, flat_h = get_coeffs_flat(float(date))
+    if flat_g is None:
         return [], []
-    elif date >= 2025.0:
-        if date > 2030.0:
-            # not adapt for the model but can calculate
-            print('This version of the IGRF is intended for use up to 2025.0.')
-            print('values for ' + str(date) + ' will be computed but may be of reduced accuracy')
-        t = date - 2025.0
-        tc = 1.0
-        #     pointer for last coefficient in pen-ultimate set of MF coefficients...
-        ll = 3060+195+195
-        nmx = 13
-        nc = nmx * (nmx + 2)
-    else:
-        t = 0.2 * (date - 1900.0)
-        ll = int(t)
-        t = t - ll
-        #     SH models before 1995.0 are only to degree 10
-        if date < 1995.0:
-            nmx = 10
-            nc = nmx * (nmx + 2)
-            ll = nc * ll
-        else:
-            nmx = 13
-            nc = nmx * (nmx + 2)
-            ll = int(0.2 * (date - 1995.0))
-            #     19 is the number of SH models that extend to degree 10
-            ll = 120 * 19 + nc * ll
-        tc = 1.0 - t
-
-    # Check if we have enough coefficients
-    if len(gh) < ll + nc:
-        print(f"Warning: Not enough coefficients. Need at least {ll + nc}, but only have {len(gh)}")
-        # Extend the list if needed
-        gh.extend([0.0] * (ll + nc - len(gh) + 1))
-
-    # print(tc, t)
-    g, h = [], []
-    temp = ll-1
-    for n in range(nmx+1):
-        g.append([])
-        h.append([])
-        if n == 0:
-            g[0].append(None)
-        for m in range(n+1):
-            if m != 0:
-                g[n].append(tc*gh[temp] + t*gh[temp+nc])
-                h[n].append(tc*gh[temp+1] + t*gh[temp+nc+1])
-                temp += 2
-                # print(n, m, g[n][m], h[n][m])
-            else:
-                g[n].append(tc*gh[temp] + t*gh[temp+nc])
-                h[n].append(None)
-                temp += 1
-                # print(n, m, g[n][m], h[n][m])
+
+    g, h = [[None]], [[None]]
+    k = 0
+    for n in range(1, nmx + 1):
+        g.append(flat_g[k:k + n + 1].tolist())
+        h.append([None] + flat_h[k + 1:k + n + 1].tolist())
+        k += n + 1
     return g, h
+
+
+if __name__ == "__main__":
+    # Build step: python custom_loadCoeffs.py [coeffs.txt] [coeffs.npy]
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'custom_igrf14coeffs.txt')
+    output = compile_coeffs(source, sys.argv[2] if len(sys.argv) > 2 else None)
+    # Read the table back so a build that cannot load it fails here rather than in the workers
+    read_table(output)
+    print(f"Compiled {source} to {output}")
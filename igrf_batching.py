@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Micro-batching of small point requests.
+
+A request of a handful of points spends far more time in the fixed cost of
+a synthesis (the Legendre recursion runs over every term whatever the
+number of points) and in the hop to a worker thread than on its points.
+MicroBatcher gathers the points that concurrent requests submit within a
+short window, computes them with one call and hands each request its own
+slice of the results.
+
+A batch is computed when the window of its first request has passed or as
+soon as it holds max_points points, whichever comes first. Requests that
+cannot share a computation (e.g. different coordinate frames) are batched
+separately by key.
+
+Configured from the environment by from_env():
+    IGRF_BATCH_WINDOW_MS      milliseconds a batch waits for more requests, 0 turns batching off (default 2)
+    IGRF_BATCH_MAX_POINTS     points in one batch (default 4096)
+    IGRF_BATCH_MAX_BODY_BYTES requests with larger bodies are not batched (default 16384)
+"""
+import asyncio
+import os
+
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Gathers columns of points from concurrent callers on one event loop and
+    computes them together.
+    """
+
+    def __init__(self, compute, window=0.002, max_points=4096, max_body_bytes=16384):
+        """
+        :param compute: coroutine function called as compute(*columns, key), returning a
+                        sequence of arrays with one value per point along the last axis,
+                        or None in place of an array
+        :param window: seconds a batch waits for more points after its first request (float)
+        :param max_points: points after which a batch is computed without waiting (int)
+        :param max_body_bytes: largest request body worth batching, for the caller (int)
+        """
+        self.compute = compute
+        self.window = window
+        self.max_points = max_points
+        self.max_body_bytes = max_body_bytes
+        self.batches = {}
+        self.timers = {}
+
+    async def submit(self, columns, key=None):
+        """
+        Add columns of points to the pending batch of key and wait for its results.
+        :param columns: arrays with one value per point (sequence of ndarray)
+        :param key: batches are only shared by requests with the same key (hashable)
+        :return: the outputs of compute for these points, in the same order
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.batches.setdefault(key, [])
+        batch.append((columns, future))
+        if sum(len(columns[0]) for columns, _ in batch) >= self.max_points:
+            self._dispatch(key)
+        elif len(batch) == 1:
+            self.timers[key] = loop.call_later(self.window, self._dispatch, key)
+        return await future
+
+    def _dispatch(self, key):
+        """Start computing the pending batch of key"""
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.batches.pop(key, None)
+        if batch:
+            asyncio.ensure_future(self._run(batch, key))
+
+    async def _run(self, batch, key):
+        try:
+            if len(batch) == 1:
+                columns = batch[0][0]
+            else:
+                columns = [np.concatenate(column) for column in zip(*(columns for columns, _ in batch))]
+            outputs = await self.compute(*columns, key)
+        except Exception as e:
+            # Every request of the batch fails the way a request computed alone would
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        start = 0
+        for columns, future in batch:
+            stop = start + len(columns[0])
+            # A caller that went away cancels its future, the others still get their results
+            if not future.done():
+                future.set_result([None if output is None else np.asarray(output)[..., start:stop] for output in outputs])
+            start = stop
+
+
+def from_env(compute, environ=os.environ):
+    """
+    Build the batcher configured by the IGRF_BATCH_* variables.
+    :param compute: see MicroBatcher
+    :return: a MicroBatcher, or None when batching is off
+    """
+    window = float(environ.get("IGRF_BATCH_WINDOW_MS", 2)) / 1000
+    max_points = int(environ.get("IGRF_BATCH_MAX_POINTS", 4096))
+    max_body_bytes = int(environ.get("IGRF_BATCH_MAX_BODY_BYTES", 16384))
+    if window <= 0 or max_points <= 0:
+        return None
+    return MicroBatcher(compute, window, max_points, max_body_bytes)
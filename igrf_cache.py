@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Result cache for repeat IGRF queries.
+
+Points are keyed on (latitude, longitude, altitude, year) rounded to a
+configurable quantum, so a point re-submitted in an overlapping survey tile
+is answered from the cache instead of being recomputed. Two backends share
+the same interface:
+
+    MemoryCache   per-process LRU with a time to live
+    SqliteCache   one SQLite file shared by every uvicorn worker on the host
+
+Configured from the environment by from_env():
+    IGRF_RESULT_CACHE          "memory" (default), "sqlite:<path>" or "off"
+    IGRF_RESULT_CACHE_SIZE     maximum number of cached points (default 100000)
+    IGRF_RESULT_CACHE_TTL      seconds a result stays valid, 0 for no expiry (default 3600)
+    IGRF_RESULT_CACHE_QUANTUM  latitude, longitude (degrees), altitude (km) and
+                               year steps the keys are rounded to
+                               (default "1e-6,1e-6,1e-3,1e-4")
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_QUANTUM = (1e-6, 1e-6, 1e-3, 1e-4)
+# Number of result values stored per point
+RESULT_SIZE = 7
+# SQLite limits the number of parameters of one statement
+SQLITE_BATCH = 500
+
+
+def quantize(lats, longs, altitudes, years, quantum=DEFAULT_QUANTUM, namespace=None):
+    """
+    Cache keys of columns of points.
+    :param quantum: step of each column, values closer than a step share a key (tuple of 4 floats)
+    :param namespace: prefix of every key, so results of e.g. different coefficient models never share one (int)
+    :return: one key per point, the little-endian int64 (lat, long, altitude, year) steps after
+             the namespace if given, packed into bytes (list)
+    """
+    columns = [np.rint(np.asarray(column, dtype=float) / step).astype("<i8")
+               for column, step in zip((lats, longs, altitudes, years), quantum)]
+    if namespace is not None:
+        columns.insert(0, np.full(len(columns[0]), namespace, dtype="<i8"))
+    return np.column_stack(columns).view(f"V{8 * len(columns)}").ravel().tolist()
+
+
+def _pack_results(values):
+    """:return: one bytes value per row of a (points, RESULT_SIZE) array (list)"""
+    return np.ascontiguousarray(values, dtype="<f8").reshape(-1, RESULT_SIZE).view(f"V{8 * RESULT_SIZE}").ravel().tolist()
+
+
+def _unpack_results(values):
+    """:return: the (points, RESULT_SIZE) array of a sequence of bytes values (ndarray)"""
+    return np.frombuffer(b"".join(values), dtype="<f8").reshape(-1, RESULT_SIZE)
+
+
+class MemoryCache:
+    """In-process LRU cache of results with a time to live, safe to use from several threads"""
+
+    def __init__(self, maxsize=100000, ttl=3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """
+        :param keys: bytes keys, see quantize (sequence)
+        :return: whether each key was found (ndarray of bool) and the results
+                 of the keys found, one row each (ndarray of shape (found, RESULT_SIZE))
+        """
+        now = time.monotonic()
+        found = np.zeros(len(keys), dtype=bool)
+        values = []
+        with self._lock:
+            for index, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is not None and (not self.ttl or entry[0] > now):
+                    self._entries.move_to_end(key)
+                    found[index] = True
+                    values.append(entry[1])
+                elif entry is not None:
+                    del self._entries[key]
+            self.hits += len(values)
+            self.misses += len(keys) - len(values)
+        return found, _unpack_results(values)
+
+    def set_many(self, keys, values):
+        """Store one result per key (rows of an array of shape (keys, RESULT_SIZE)), evicting the least recently used"""
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in zip(keys, _pack_results(values)):
+                self._entries[key] = (expires, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """
+        :return: hit/miss counters and size (dict)
+        """
+        return {"backend": "memory", "hits": self.hits, "misses": self.misses,
+                "maxsize": self.maxsize, "currsize": len(self._entries), "ttl": self.ttl}
+
+
+class SqliteCache:
+    """
+    Results stored in one SQLite file, so every worker process on the host
+    shares them. Hits update the access time of their entries, and when the
+    table grows past maxsize the least recently used entries are evicted.
+    The number of entries is kept in a metadata row by triggers, so inserts
+    never count the table.
+    """
+
+    def __init__(self, path, maxsize=100000, ttl=3600.0):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value BLOB, stored REAL, accessed REAL)")
+            # Files written before entries had an access time start from their store time
+            if "accessed" not in [row[1] for row in self._connection.execute("PRAGMA table_info(results)")]:
+                self._connection.execute("ALTER TABLE results ADD COLUMN accessed REAL")
+                self._connection.execute("UPDATE results SET accessed = stored")
+            self._connection.execute("DROP INDEX IF EXISTS results_stored")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS results_meta (name TEXT PRIMARY KEY, value INTEGER)")
+            self._connection.execute("INSERT OR IGNORE INTO results_meta SELECT 'count', COUNT(*) FROM results")
+            self._connection.execute("CREATE TRIGGER IF NOT EXISTS results_inserted AFTER INSERT ON results BEGIN "
+                                     "UPDATE results_meta SET value = value + 1 WHERE name = 'count'; END")
+            self._connection.execute("CREATE TRIGGER IF NOT EXISTS results_deleted AFTER DELETE ON results BEGIN "
+                                     "UPDATE results_meta SET value = value - 1 WHERE name = 'count'; END")
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _count(self):
+        return self._connection.execute("SELECT value FROM results_meta WHERE name = 'count'").fetchone()[0]
+
+    def get_many(self, keys):
+        """
+        :param keys: bytes keys, see quantize (sequence)
+        :return: whether each key was found (ndarray of bool) and the results
+                 of the keys found, one row each (ndarray of shape (found, RESULT_SIZE))
+        """
+        now = time.time()
+        oldest = now - self.ttl if self.ttl else float("-inf")
+        rows = {}
+        with self._lock:
+            for start in range(0, len(keys), SQLITE_BATCH):
+                batch = list(keys[start:start + SQLITE_BATCH])
+                rows.update(self._connection.execute(
+                    f"SELECT key, value FROM results WHERE stored > ? AND key IN ({','.join('?' * len(batch))})",
+                    [oldest] + batch))
+            # Hits become the most recently used entries
+            found_keys = list(rows)
+            for start in range(0, len(found_keys), SQLITE_BATCH):
+                batch = found_keys[start:start + SQLITE_BATCH]
+                self._connection.execute(f"UPDATE results SET accessed = ? WHERE key IN ({','.join('?' * len(batch))})",
+                                         [now] + batch)
+            found = np.fromiter((key in rows for key in keys), dtype=bool, count=len(keys))
+            hits = int(found.sum())
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found, _unpack_results([rows[key] for key in keys if key in rows])
+
+    def set_many(self, keys, values):
+        """Store one result per key (rows of an array of shape (keys, RESULT_SIZE)), evicting the least recently used beyond maxsize"""
+        now = time.time()
+        rows = [(key, value, now, now) for key, value in zip(keys, _pack_results(values))]
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                # An upsert rather than INSERT OR REPLACE, whose implicit delete does not fire the count trigger
+                self._connection.executemany(
+                    "INSERT INTO results VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE "
+                    "SET value = excluded.value, stored = excluded.stored, accessed = excluded.accessed", rows)
+                excess = self._count() - self.maxsize
+                if excess > 0:
+                    self._connection.execute(
+                        "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)", (excess,))
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM results")
+            self.hits = self.misses = 0
+
+    def info(self):
+        """
+        :return: hit/miss counters and size (dict)
+        """
+        with self._lock:
+            size = self._count()
+        return {"backend": "sqlite", "path": self.path, "hits": self.hits, "misses": self.misses,
+                "maxsize": self.maxsize, "currsize": size, "ttl": self.ttl}
+
+
+def from_env(environ=os.environ):
+    """
+    Build the result cache configured by the IGRF_RESULT_CACHE* variables.
+    :return: a cache, or None when caching is off
+    """
+    backend = environ.get("IGRF_RESULT_CACHE", "memory")
+    maxsize = int(environ.get("IGRF_RESULT_CACHE_SIZE", 100000))
+    ttl = float(environ.get("IGRF_RESULT_CACHE_TTL", 3600))
+    if backend == "off" or maxsize <= 0:
+        return None
+    if backend == "memory":
+        return MemoryCache(maxsize, ttl)
+    if backend.startswith("sqlite:"):
+        return SqliteCache(backend[len("sqlite:"):], maxsize, ttl)
+    raise ValueError(f"Unknown IGRF_RESULT_CACHE backend: {backend}")
+
+
+def quantum_from_env(environ=os.environ):
+    """
+    :return: the key steps set by IGRF_RESULT_CACHE_QUANTUM (tuple of 4 floats)
+    """
+    value = environ.get("IGRF_RESULT_CACHE_QUANTUM")
+    if not value:
+        return DEFAULT_QUANTUM
+    quantum = tuple(float(step) for step in value.split(","))
+    if len(quantum) != 4 or min(quantum) <= 0:
+        raise ValueError(f"IGRF_RESULT_CACHE_QUANTUM needs 4 positive steps, got {value}")
+    return quantum
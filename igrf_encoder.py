@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Response encoding for the IGRF endpoints.
+
+Results are turned into JSON bytes in one call, without going through
+FastAPI's jsonable_encoder. NumPy arrays (columnar and grid responses) are
+encoded directly instead of being converted to lists first. orjson, a
+dependency in requirements.txt, does the encoding: it is several times
+faster than the stdlib encoder on result lists. The stdlib encoder is only a
+fallback for an environment where orjson failed to install, both produce
+compact JSON with the same values and key order.
+
+Large responses are gzip-compressed for clients that accept it.
+"""
+import json
+import math
+import zlib
+
+import numpy as np
+
+# orjson is required by requirements.txt, the stdlib encoder only stands in when it could not be installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MEDIA_TYPE = "application/json"
+
+
+def _default(value):
+    """Encode the NumPy values the stdlib encoder does not know"""
+    if isinstance(value, (np.ndarray, np.generic)):
+        return _finite(value.tolist())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _finite(content):
+    """NaN and infinities replaced by None, which orjson writes as null but the stdlib encoder refuses"""
+    if isinstance(content, float):
+        return content if math.isfinite(content) else None
+    if isinstance(content, dict):
+        return {key: _finite(value) for key, value in content.items()}
+    if isinstance(content, (list, tuple)):
+        return [_finite(value) for value in content]
+    return content
+
+
+def dumps(content):
+    """
+    Encode a response body.
+    :param content: lists, dicts, numbers, strings and NumPy arrays
+    :return: compact JSON (bytes)
+    """
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(_finite(content), ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def dumps_lines(items):
+    """
+    Encode items as newline-delimited JSON.
+    :return: one JSON document per line, each ending in a newline (bytes)
+    """
+    return b"".join(dumps(item) + b"\n" for item in items)
+
+
+def accepts_gzip(accept_encoding):
+    """True if an Accept-Encoding header value allows gzip"""
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*") and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            return True
+    return False
+
+
+def gzip(body, level):
+    """
+    :return: body in the gzip format (bytes)
+    """
+    # wbits 31 writes the gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
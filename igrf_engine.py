@@ -0,0 +1,674 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized IGRF synthesis.
+
+This is a NumPy port of pyIGRF.calculate.igrf12syn / pyIGRF.value.igrf_value
+that evaluates many points at once. The Schmidt quasi-normal Legendre
+recursion is the same as in the scalar routine, but every step operates on a
+whole chunk of points instead of a single colatitude.
+
+Accuracy: for the same inputs the results agree with pyIGRF.igrf_value to
+within 1e-6 nT for X, Y, Z, H and F and 1e-9 degrees for D and I. The only
+differences come from floating point summation order and from computing
+cos(m*lon) / sin(m*lon) directly instead of by recurrence.
+"""
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+
+from pyIGRF.loadCoeffs import COEFFS_CACHE_SIZE, get_model
+
+FACT = 180. / np.pi
+
+# Points are processed in chunks so the (number of coefficients x points)
+# Legendre tables stay small enough to sit in cache.
+CHUNK_SIZE = 4096
+
+# Epochs with fewer points than this in one batch are not synthesized one by
+# one, see igrf12syn_epochs
+SHARED_EPOCH_POINTS = 256
+
+# Tolerances documented above, used by the tests
+FIELD_TOLERANCE_NT = 1e-6
+ANGLE_TOLERANCE_DEG = 1e-9
+
+# WGS84 spheroid constants as used by pyIGRF.calculate.geodetic2geocentric
+A2 = 40680631.6
+B2 = 40408296.0
+# Reference radius of the IGRF model in km
+RE = 6371.2
+
+_plans = {}
+
+
+def _recursion_plan(nmx):
+    """
+    Precompute the index/constant table of the Legendre recursion used in
+    igrf12syn for a model of maximum degree nmx.
+    :param nmx: maximum degree (int)
+    :return: dict of arrays indexed by k - 1 (one entry per (n, m) term)
+    """
+    if nmx in _plans:
+        return _plans[nmx]
+
+    kmx = (nmx + 1) * (nmx + 2) // 2 + 1
+    steps = []
+    n_of_k = [0] * (kmx - 1)
+    m_of_k = [0] * (kmx - 1)
+    m, n = 1, 0
+    for k in range(2, kmx):
+        if n < m:
+            m = 0
+            n = n + 1
+        n_of_k[k - 1] = n
+        m_of_k[k - 1] = m
+        fn, gn = float(n), float(n - 1)
+        if m != n:
+            gmm = m * m
+            one = np.sqrt(fn * fn - gmm)
+            two = np.sqrt(gn * gn - gmm) / one
+            three = (fn + gn) / one
+            i = k - n
+            j = i - n + 1
+            steps.append((k - 1, False, i - 1, j - 1, two, three))
+        elif k != 3:
+            one = np.sqrt(1.0 - 0.5 / m)
+            j = k - n - 1
+            steps.append((k - 1, True, 0, j - 1, one, 0.))
+        m = m + 1
+
+    plan = {
+        'kmx': kmx,
+        'steps': steps,
+        'n': np.array(n_of_k[1:], dtype=float),
+        'm': np.array(m_of_k[1:], dtype=float),
+        # Sums the per-(n, m) terms of each order m, used by the grid synthesis
+        'order_sum': np.equal.outer(m_of_k[1:], np.arange(nmx + 1)).astype(float),
+    }
+    _plans[nmx] = plan
+    return plan
+
+
+def geodetic2geocentric(theta, alt):
+    """
+    Vectorized pyIGRF.calculate.geodetic2geocentric.
+    :param theta: colatitude (ndarray, rad)
+    :param alt: altitude (ndarray, km)
+    :return gccolat: geocentric colatitude (ndarray, rad)
+            d: gccolat minus theta (ndarray, rad)
+            r: geocentric radius (ndarray, km)
+    """
+    ct = np.cos(theta)
+    st = np.sin(theta)
+    one = A2 * st * st
+    two = B2 * ct * ct
+    three = one + two
+    rho = np.sqrt(three)
+    r = np.sqrt(alt * (alt + 2.0 * rho) + (A2 * one + B2 * two) / three)
+    cd = (alt + rho) / r
+    sd = (A2 - B2) / rho * ct * st / r
+    gccolat = np.arctan2(st * cd + ct * sd, ct * cd - st * sd)
+    d = np.arctan2(sd, cd)
+    return gccolat, d, r
+
+
+class Coordinates:
+    """
+    Output of the coordinate conversion stage, the input of the synthesis:
+    cos and sin of the geocentric colatitude and the geocentric radius of
+    every point, with cos and sin of the angle that rotates the geocentric
+    components back to the geodetic frame (None for geocentric input).
+    Indexing returns the coordinates of a subset of the points, so one
+    conversion serves every epoch and chunk of a batch.
+    """
+    __slots__ = ("ct", "st", "r", "cd", "sd")
+
+    def __init__(self, ct, st, r, cd=None, sd=None):
+        self.ct = ct
+        self.st = st
+        self.r = r
+        self.cd = cd
+        self.sd = sd
+
+    def __len__(self):
+        return self.ct.shape[0]
+
+    def __getitem__(self, index):
+        if self.cd is None:
+            return Coordinates(self.ct[index], self.st[index], self.r[index])
+        return Coordinates(self.ct[index], self.st[index], self.r[index], self.cd[index], self.sd[index])
+
+
+def geocentric_coordinates(itype, alt, lat):
+    """
+    Coordinate conversion stage of igrf12syn for arrays of points. The
+    conversion runs once per distinct latitude and altitude pair, so points
+    that share a latitude row and altitude, as in surveys and repeated
+    epochs, share its trigonometry.
+    :param itype: 1 if geodetic (spheroid), 2 if geocentric (sphere)
+    :param alt: height in km above sea level if itype = 1, distance from
+                centre of Earth in km if itype = 2 (ndarray)
+    :param lat: latitude in degrees (ndarray)
+    :return: Coordinates
+    """
+    alt, lat = np.broadcast_arrays(np.asarray(alt, dtype=float), np.asarray(lat, dtype=float))
+    pairs, inverse = np.unique(lat + 1j * alt, return_inverse=True)
+    if len(pairs) == len(lat):
+        # All distinct, convert in input order without the gather
+        inverse = None
+    else:
+        alt, lat = pairs.imag, pairs.real
+
+    colat = (90. - lat) / FACT
+    ct = np.cos(colat)
+    st = np.sin(colat)
+    if itype == 2:
+        coordinates = Coordinates(ct, st, alt)
+    else:
+        gclat, gclon, r = geodetic2geocentric(np.arctan2(st, ct), alt)
+        coordinates = Coordinates(np.cos(gclat), np.sin(gclat), r, np.cos(gclon), np.sin(gclon))
+    return coordinates if inverse is None else coordinates[inverse.reshape(-1)]
+
+
+def _legendre(plan, ct, st, p=None, q=None):
+    """
+    Schmidt quasi-normal associated Legendre functions and their derivatives
+    with respect to colatitude, as computed by the recursion in igrf12syn.
+    :param plan: table from _recursion_plan
+    :param ct, st: cos and sin of the geocentric colatitude (ndarray)
+    :param p, q: arrays of shape (kmx - 1, points) to fill, allocated when not given (ndarray)
+    :return: p, q with one row per (n, m) term and one column per point (ndarray)
+    """
+    npts = ct.shape[0]
+    if p is None:
+        p = np.empty((plan['kmx'] - 1, npts))
+        q = np.empty((plan['kmx'] - 1, npts))
+    term = np.empty(npts)
+    p[0] = 1.0
+    p[2] = st
+    q[0] = 0.0
+    q[2] = ct
+    for k, diagonal, i, j, two, three in plan['steps']:
+        if diagonal:
+            # p[k] = two * st * p[j], q[k] = two * (st * q[j] + ct * p[j])
+            np.multiply(st, p[j], out=p[k])
+            p[k] *= two
+            np.multiply(st, q[j], out=q[k])
+            q[k] += np.multiply(ct, p[j], out=term)
+            q[k] *= two
+        else:
+            # p[k] = three * ct * p[i] - two * p[j], q[k] = three * (ct * q[i] - st * p[i]) - two * q[j]
+            np.multiply(ct, p[i], out=p[k])
+            p[k] *= three
+            p[k] -= np.multiply(p[j], two, out=term)
+            np.multiply(ct, q[i], out=q[k])
+            q[k] -= np.multiply(st, p[i], out=term)
+            q[k] *= three
+            q[k] -= np.multiply(q[j], two, out=term)
+    return p[1:], q[1:]
+
+
+class _Workspace:
+    """
+    Scratch arrays of the synthesis for chunks of up to `size` points of a
+    degree nmx model. Every array is flat and viewed with the shape of the
+    current chunk, so the views stay contiguous for any number of points.
+    """
+
+    def __init__(self, nmx, size):
+        self.nmx = nmx
+        self.size = size
+        self.rows = _recursion_plan(nmx)['kmx'] - 1
+        self.legendre = np.empty((2, self.rows * size))
+        self.terms = np.empty((6, (self.rows - 1) * size))
+        self.orders = np.empty((3, (nmx + 1) * size))
+
+    def arrays(self, npts):
+        """
+        :return: p, q of shape (kmx - 1, npts), six arrays of shape (terms, npts)
+                 and three of shape (nmx + 1, npts) (ndarray)
+        """
+        p, q = (a[:self.rows * npts].reshape(self.rows, npts) for a in self.legendre)
+        terms = [a[:(self.rows - 1) * npts].reshape(self.rows - 1, npts) for a in self.terms]
+        orders = [a[:(self.nmx + 1) * npts].reshape(self.nmx + 1, npts) for a in self.orders]
+        return p, q, terms, orders
+
+
+# Idle workspaces kept per degree, at most this many. A workspace is only used
+# by one chunk at a time, so concurrent requests and pool threads each take their own.
+WORKSPACE_POOL_SIZE = 4
+_free_workspaces = {10: [], 13: []}
+
+
+@contextmanager
+def _workspace(nmx, npts):
+    """
+    An idle workspace for npts points of a degree nmx model, returned to the pool on exit.
+    """
+    free = _free_workspaces.setdefault(nmx, [])
+    try:
+        workspace = free.pop()
+    except IndexError:
+        workspace = None
+    if workspace is None or workspace.size < npts:
+        # Untouched pages of the arrays are not committed, small chunks only use the start
+        workspace = _Workspace(nmx, max(npts, CHUNK_SIZE))
+    try:
+        yield workspace
+    finally:
+        if len(free) < WORKSPACE_POOL_SIZE:
+            free.append(workspace)
+
+
+class SynthesisKernel:
+    """
+    Spherical harmonic synthesis of one set of coefficients, the batched
+    counterpart of the loop in igrf12syn. The per-term constants are derived
+    from the recursion plan once, and every chunk is evaluated in place in a
+    pooled workspace, so the only arrays allocated per chunk are the
+    geodetic conversion and a few rows of the length of the chunk.
+    Kernels of single epochs are made once and cached by kernel().
+    """
+
+    def __init__(self, nmx, g, h):
+        """
+        :param nmx: maximum degree of the coefficients, as decided by the model for their epoch (int)
+        :param g, h: flat coefficients from get_coeffs_flat (ndarray), or one column of them
+                     per point of a chunk (ndarray, terms x points)
+        """
+        plan = _recursion_plan(nmx)
+        self.nmx = nmx
+        self.plan = plan
+        self.g = g[:, None] if g.ndim == 1 else g
+        self.h = h[:, None] if h.ndim == 1 else h
+        self.degrees = plan['n'].astype(np.intp)
+        self.orders = plan['m'].astype(np.intp)
+        self.all_orders = np.arange(nmx + 1, dtype=float)[:, None]
+        self.m = plan['m'][:, None]
+        self.n1 = plan['n'][:, None] + 1.0
+
+    def synthesize(self, ct, st, r, elong, x, y, z):
+        """
+        Field components in geocentric coordinates for one chunk of points.
+        :param ct, st: cos and sin of the geocentric colatitude (ndarray)
+        :param r: geocentric radius in km (ndarray)
+        :param elong: east longitude (ndarray, rad)
+        :param x, y, z: arrays the components are written to (ndarray, nT)
+        """
+        npts = ct.shape[0]
+        with _workspace(self.nmx, npts) as workspace:
+            p, q, (rr, cl, sl, grr, hrr, east), (cos_m, sin_m, power) = workspace.arrays(npts)
+            p, q = _legendre(self.plan, ct, st, p, q)
+
+            # cos(m*lon), sin(m*lon) and (RE/r)**(n+2) once per order and degree, then spread over the terms
+            np.multiply(self.all_orders, elong, out=power)
+            np.cos(power, out=cos_m)
+            np.sin(power, out=sin_m)
+            ratio = RE / r
+            np.multiply(ratio, ratio, out=power[0])
+            for n in range(1, self.nmx + 1):
+                np.multiply(power[n - 1], ratio, out=power[n])
+            np.take(power, self.degrees, axis=0, out=rr, mode='clip')
+            np.take(cos_m, self.orders, axis=0, out=cl, mode='clip')
+            np.take(sin_m, self.orders, axis=0, out=sl, mode='clip')
+
+            np.multiply(self.g, rr, out=grr)
+            np.multiply(self.h, rr, out=hrr)
+            # three = grr * cl + hrr * sl, east = grr * sl - hrr * cl
+            three = np.multiply(grr, cl, out=rr)
+            three += np.multiply(hrr, sl, out=east)
+            np.multiply(grr, sl, out=east)
+            east -= np.multiply(hrr, cl, out=hrr)
+
+            np.einsum('kn,kn->n', three, q, out=x)
+            three *= self.n1
+            np.einsum('kn,kn->n', three, p, out=z)
+            np.negative(z, out=z)
+
+            pole = st == 0.0
+            if pole.any():
+                y_pole = np.einsum('kn,kn->n', east[:, pole], q[:, pole]) * ct[pole]
+            east *= self.m
+            np.einsum('kn,kn->n', east, p, out=y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                y /= st
+            if pole.any():
+                y[pole] = y_pole
+
+    def evaluate(self, coordinates, elong, x, y, z):
+        """
+        igrf12syn for one chunk of points, written to x, y and z.
+        :param coordinates: Coordinates of the points from geocentric_coordinates
+        :param elong: east longitude in degrees (ndarray)
+        :param x, y, z: arrays the components are written to (ndarray, nT)
+        """
+        self.synthesize(coordinates.ct, coordinates.st, coordinates.r, elong / FACT, x, y, z)
+        cd, sd = coordinates.cd, coordinates.sd
+        if cd is not None:
+            x[:], z[:] = x * cd + z * sd, z * cd - x * sd
+
+
+@lru_cache(maxsize=COEFFS_CACHE_SIZE)
+def _kernels(coefficients, date):
+    nmx, g, h = coefficients.coeffs(date)
+    if g is None:
+        return None
+    return SynthesisKernel(nmx, g, h)
+
+
+def kernel(date, model=None):
+    """
+    The synthesis kernel of one epoch, made once per model and decimal year.
+    A reloaded model is a new CoefficientModel, so it never gets the kernels of the one it replaced.
+    :param date: decimal year (float)
+    :param model: model name, None for the default model (str)
+    :return: SynthesisKernel, or None if the date is out of range
+    """
+    return _kernels(get_model(model), float(date))
+
+
+def kernel_cache_info():
+    """
+    :return: hit/miss counters of the kernel() cache (dict)
+    """
+    info = _kernels.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "maxsize": info.maxsize, "currsize": info.currsize}
+
+
+def igrf12syn_batch(date, itype, alt, lat, elong, chunk_size=CHUNK_SIZE, coordinates=None, model=None):
+    """
+    Vectorized pyIGRF.calculate.igrf12syn for a single epoch.
+    :param date: decimal year (float)
+    :param itype: 1 if geodetic (spheroid), 2 if geocentric (sphere)
+    :param alt: height in km above sea level if itype = 1, distance from
+                centre of Earth in km if itype = 2 (ndarray)
+    :param lat: latitude in degrees (ndarray)
+    :param elong: east longitude in degrees (ndarray)
+    :param coordinates: the points converted by geocentric_coordinates, which
+                        replace itype, alt and lat when given (Coordinates)
+    :param model: coefficient model name, None for the default model (str)
+    :return: x, y, z, f (ndarray, nT)
+    """
+    elong = np.asarray(elong, dtype=float)
+    npts = elong.shape[0]
+
+    x = np.zeros(npts)
+    y = np.zeros(npts)
+    z = np.zeros(npts)
+    synthesis = kernel(date, model)
+    if synthesis is None:
+        # Same convention as igrf12syn for dates outside the model range
+        return x, y, z, np.ones(npts)
+
+    if coordinates is None:
+        coordinates = geocentric_coordinates(itype, alt, lat)
+    for start in range(0, npts, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        synthesis.evaluate(coordinates[chunk], elong[chunk], x[chunk], y[chunk], z[chunk])
+
+    f = np.sqrt(x * x + y * y + z * z)
+    return x, y, z, f
+
+
+def igrf12syn_epochs(dates, itype, alt, lat, elong, chunk_size=CHUNK_SIZE, coordinates=None, model=None):
+    """
+    Vectorized pyIGRF.calculate.igrf12syn where every point has its own
+    epoch. The coefficients are interpolated per point with coeffs_series and
+    the points of each degree are synthesized together, instead of one call
+    per epoch.
+    :param dates: decimal years between 1900 and 2035 (ndarray)
+    :param itype, alt, lat, elong, coordinates: as in igrf12syn_batch
+    :return: x, y, z, f (ndarray, nT)
+    """
+    dates = np.asarray(dates, dtype=float)
+    elong = np.asarray(elong, dtype=float)
+    if coordinates is None:
+        coordinates = geocentric_coordinates(itype, alt, lat)
+
+    x = np.zeros(dates.shape[0])
+    y = np.zeros(dates.shape[0])
+    z = np.zeros(dates.shape[0])
+    coefficients = get_model(model)
+    degrees = coefficients.degree(dates)
+    for nmx in np.unique(degrees).tolist():
+        idx = np.nonzero(degrees == nmx)[0]
+        terms = len(_recursion_plan(nmx)['n'])
+        for start in range(0, idx.shape[0], chunk_size):
+            chunk = idx[start:start + chunk_size]
+            g, h, _, _ = coefficients.series(dates[chunk])
+            cx, cy, cz = np.empty(chunk.shape[0]), np.empty(chunk.shape[0]), np.empty(chunk.shape[0])
+            synthesis = SynthesisKernel(nmx, g[:, :terms].T, h[:, :terms].T)
+            synthesis.evaluate(coordinates[chunk], elong[chunk], cx, cy, cz)
+            x[chunk], y[chunk], z[chunk] = cx, cy, cz
+
+    f = np.sqrt(x * x + y * y + z * z)
+    return x, y, z, f
+
+
+def igrf12syn_grid(date, itype, alt, lat, elong, model=None):
+    """
+    IGRF synthesis on a regular grid of latitudes x longitudes at one altitude.
+    The grid is separable: the Legendre functions, radial factors and the
+    geodetic to geocentric rotation depend only on the latitude row and
+    cos(m*lon) / sin(m*lon) only on the longitude column, so each is
+    computed once and the rows and columns are combined per order m with
+    two matrix products.
+    :param date: decimal year (float)
+    :param itype: 1 if geodetic (spheroid), 2 if geocentric (sphere)
+    :param alt: height in km above sea level if itype = 1, distance from
+                centre of Earth in km if itype = 2 (float)
+    :param lat: latitude of each row in degrees (ndarray)
+    :param elong: east longitude of each column in degrees (ndarray)
+    :param model: coefficient model name, None for the default model (str)
+    :return: x, y, z, f with shape (len(lat), len(elong)) (ndarray, nT)
+    """
+    lat = np.asarray(lat, dtype=float)
+    elong = np.asarray(elong, dtype=float)
+    shape = (lat.shape[0], elong.shape[0])
+
+    nmx, g, h = get_model(model).coeffs(float(date))
+    if g is None:
+        # Same convention as igrf12syn for dates outside the model range
+        return np.zeros(shape), np.zeros(shape), np.zeros(shape), np.ones(shape)
+
+    # Per latitude row
+    coordinates = geocentric_coordinates(itype, float(alt), lat)
+    ct, st, r, cd, sd = coordinates.ct, coordinates.st, coordinates.r, coordinates.cd, coordinates.sd
+
+    plan = _recursion_plan(nmx)
+    p, q = _legendre(plan, ct, st)
+    n = plan['n'][:, None]
+    m = plan['m'][:, None]
+    rr = (RE / r)[None, :] ** (n + 2.0)
+    grr = g[:, None] * rr
+    hrr = h[:, None] * rr
+
+    pole = st == 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        east = m * p / st
+    east[:, pole] = q[:, pole] * ct[pole]
+
+    # Row weights of cos(m*lon) and sin(m*lon), summed over the degrees n of each order m
+    order_sum = plan['order_sum']
+    weights = np.stack([
+        np.stack([grr * q, hrr * q]),
+        np.stack([-(n + 1.0) * grr * p, -(n + 1.0) * hrr * p]),
+        np.stack([-hrr * east, grr * east]),
+    ])
+    weights = np.einsum('cski,km->csim', weights, order_sum)
+
+    # Per longitude column
+    ml = np.arange(nmx + 1)[:, None] * (elong / FACT)[None, :]
+    cl = np.cos(ml)
+    sl = np.sin(ml)
+
+    x, z, y = (w_cos @ cl + w_sin @ sl for w_cos, w_sin in weights)
+    if cd is not None:
+        x, z = x * cd[:, None] + z * sd[:, None], z * cd[:, None] - x * sd[:, None]
+
+    f = np.sqrt(x * x + y * y + z * z)
+    return x, y, z, f
+
+
+def igrf_value_batch(lat, lon, alt, year, chunk_size=CHUNK_SIZE, itype=1, model=None):
+    """
+    Vectorized pyIGRF.igrf_value for arrays of points.
+    The coordinates are converted once for the whole batch, then points are
+    grouped by year so every epoch is interpolated only once, the points of
+    years shared by few of them are evaluated together with per point
+    coefficients.
+    :param lat: latitude in degrees (array_like)
+    :param lon: east longitude in degrees (array_like)
+    :param alt: altitude in km (array_like)
+    :param year: decimal year (array_like)
+    :param itype: 1 for geodetic latitudes and altitudes above the WGS84
+                  spheroid, 2 for geocentric latitudes and altitudes above
+                  the reference sphere of radius RE, in which case the
+                  components are geocentric too
+    :param model: coefficient model name, None for the default model (str)
+    :return
+         D is declination (+ve east)
+         I is inclination (+ve down)
+         H is horizontal intensity
+         X is north component
+         Y is east component
+         Z is vertical component (+ve down)
+         F is total intensity
+         each as an ndarray with one value per point
+    """
+    lat, lon, alt, year = np.broadcast_arrays(*(np.atleast_1d(np.asarray(a, dtype=float))
+                                                for a in (lat, lon, alt, year)))
+    coordinates = geocentric_coordinates(itype, alt + RE if itype == 2 else alt, lat)
+
+    x = np.empty(lat.shape)
+    y = np.empty(lat.shape)
+    z = np.empty(lat.shape)
+    f = np.empty(lat.shape)
+    epochs, inverse, counts = np.unique(year, return_inverse=True, return_counts=True)
+    if len(epochs) == 1:
+        x[:], y[:], z[:], f[:] = igrf12syn_batch(epochs[0], itype, alt, lat, lon, chunk_size, coordinates, model)
+    else:
+        # Epochs with few points are interpolated per point and synthesized together
+        coefficients = get_model(model)
+        shared = (counts < SHARED_EPOCH_POINTS) & (epochs >= coefficients.start) & (epochs <= coefficients.end)
+        for e in np.nonzero(~shared)[0]:
+            idx = np.nonzero(inverse == e)[0]
+            x[idx], y[idx], z[idx], f[idx] = igrf12syn_batch(epochs[e], itype, alt[idx], lat[idx], lon[idx], chunk_size,
+                                                             coordinates[idx], model)
+        if shared.any():
+            idx = np.nonzero(shared[inverse])[0]
+            x[idx], y[idx], z[idx], f[idx] = igrf12syn_epochs(year[idx], itype, alt[idx], lat[idx], lon[idx], chunk_size,
+                                                              coordinates[idx], model)
+
+    d = FACT * np.arctan2(y, x)
+    h = np.sqrt(x * x + y * y)
+    i = FACT * np.arctan2(z, h)
+    return d, i, h, x, y, z, f
+
+
+def igrf_value_grid(lat, lon, alt, year, model=None):
+    """
+    pyIGRF.igrf_value on a regular grid at one altitude and epoch.
+    :param lat: latitude of each row in degrees (array_like)
+    :param lon: east longitude of each column in degrees (array_like)
+    :param alt: altitude in km (float)
+    :param year: decimal year (float)
+    :param model: coefficient model name, None for the default model (str)
+    :return: D, I, H, X, Y, Z, F as in igrf_value_batch, each as an ndarray
+             of shape (len(lat), len(lon))
+    """
+    x, y, z, f = igrf12syn_grid(year, 1, alt, np.atleast_1d(lat), np.atleast_1d(lon), model)
+    d = FACT * np.arctan2(y, x)
+    h = np.sqrt(x * x + y * y)
+    i = FACT * np.arctan2(z, h)
+    return d, i, h, x, y, z, f
+
+
+def coeffs_series(years, model=None):
+    """
+    Interpolated coefficients and their rate of change for many epochs at
+    once, matching get_coeffs_flat(year) for each year.
+    :param years: decimal years in the range of the model (ndarray)
+    :param model: coefficient model name, None for the default model (str)
+    :return: g, h, dg/dt, dh/dt with one row per year, padded to the highest
+             degree of the model (ndarray, nT and nT/year)
+    """
+    return get_model(model).series(years)
+
+
+def _location_basis(lat, lon, alt, nmx):
+    """
+    Contribution of each Gauss coefficient to the field at one geodetic
+    location, so that X, Y, Z = basis_g @ g + basis_h @ h for any epoch.
+    :param nmx: highest degree of the coefficients (int)
+    :return: basis_g, basis_h with one row per component X, Y, Z and one column per term (ndarray)
+    """
+    plan = _recursion_plan(nmx)
+    colat = np.array([(90. - lat) / FACT])
+    gclat, gclon, r = geodetic2geocentric(colat, np.array([float(alt)]))
+    ct, st = np.cos(gclat), np.sin(gclat)
+    p, q = _legendre(plan, ct, st)
+    p, q = p[:, 0], q[:, 0]
+    n, m = plan['n'], plan['m']
+    rr = (RE / r[0]) ** (n + 2.0)
+    cl = np.cos(m * lon / FACT)
+    sl = np.sin(m * lon / FACT)
+    if st[0] == 0.0:
+        east = q * ct[0]
+    else:
+        east = m * p / st[0]
+
+    # Geocentric north, east and down, then rotated to the geodetic frame
+    x_g, x_h = rr * q * cl, rr * q * sl
+    y_g, y_h = rr * east * sl, -rr * east * cl
+    z_g, z_h = -(n + 1.0) * rr * p * cl, -(n + 1.0) * rr * p * sl
+    cd, sd = np.cos(gclon[0]), np.sin(gclon[0])
+    basis_g = np.stack([x_g * cd + z_g * sd, y_g, z_g * cd - x_g * sd])
+    basis_h = np.stack([x_h * cd + z_h * sd, y_h, z_h * cd - x_h * sd])
+    return basis_g, basis_h
+
+
+def igrf_value_series(lat, lon, alt, years, model=None):
+    """
+    pyIGRF.igrf_value for one location at many epochs. The spherical harmonic
+    basis of the location is computed once and every epoch only applies its
+    interpolated coefficients to it.
+    :param lat: latitude in degrees (float)
+    :param lon: east longitude in degrees (float)
+    :param alt: altitude in km (float)
+    :param years: decimal years in the range of the model (array_like)
+    :param model: coefficient model name, None for the default model (str)
+    :return: D, I, H, X, Y, Z, F as in igrf_value_batch, then their rates of
+             change in the same order (degrees/year for D and I, nT/year for
+             the others), each as an ndarray with one value per year
+    """
+    years = np.atleast_1d(np.asarray(years, dtype=float))
+    coefficients = get_model(model)
+    basis_g, basis_h = _location_basis(float(lat), float(lon), float(alt), coefficients.nmax)
+    g, h, rate_g, rate_h = coefficients.series(years)
+    x, y, z = basis_g @ g.T + basis_h @ h.T
+    dx, dy, dz = basis_g @ rate_g.T + basis_h @ rate_h.T
+
+    h_ = np.sqrt(x * x + y * y)
+    f = np.sqrt(x * x + y * y + z * z)
+    d = FACT * np.arctan2(y, x)
+    i = FACT * np.arctan2(z, h_)
+    dh = (x * dx + y * dy) / h_
+    df = (x * dx + y * dy + z * dz) / f
+    dd = FACT * (x * dy - y * dx) / (h_ * h_)
+    di = FACT * (h_ * dz - z * dh) / (f * f)
+    return d, i, h_, x, y, z, f, dd, di, dh, dx, dy, dz, df
+
+
+def warm_up():
+    """
+    Load the coefficient models and build the recursion plans. Used as the
+    initializer of worker processes so the first chunk they run does not pay
+    for it.
+    """
+    coefficients = get_model()
+    for nmx in np.unique(coefficients.degrees).tolist():
+        _recursion_plan(nmx)
+    kernel(coefficients.epochs[-1])
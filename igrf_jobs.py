@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Job queue for very large surveys.
+
+A job is submitted once, computed in the background and its results are
+fetched in pages, so no HTTP connection has to stay open for the whole
+computation. Everything lives in one SQLite file:
+
+    jobs     one row per job
+    chunks   the points still to compute, split into chunks, with the
+             result components of every computed chunk
+    fixed    results known at submission (rejected or precomputed points)
+
+JobRunner threads claim queued chunks, compute them and store the results.
+A claim is a lease: a chunk whose worker died (e.g. on a restart) is claimed
+again once its lease expires, so jobs resume where they stopped. Several
+uvicorn workers on the host can share one store.
+
+Configured from the environment by from_env():
+    IGRF_JOB_STORE         path of the SQLite file (default igrf_jobs.sqlite in the
+                           temporary directory), "off" disables the job endpoints
+    IGRF_JOB_CHUNK_POINTS  points computed per chunk (default 100000)
+    IGRF_JOB_WORKERS       job worker threads per process (default 1)
+    IGRF_JOB_LEASE         seconds before a claimed chunk that was not completed is claimed again (default 600)
+    IGRF_JOB_TTL           seconds a job is kept after its last update (default 86400)
+"""
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger("igrf.jobs")
+
+# Number of input columns (latitude, longitude, altitude, year) and result components per point
+INPUT_SIZE = 4
+RESULT_SIZE = 7
+
+
+class JobNotReady(Exception):
+    """The requested results have not been computed yet"""
+
+
+class JobStore:
+    """Jobs, their pending chunks and their results in one SQLite file, safe to use from several threads and processes"""
+
+    def __init__(self, path, chunk_points=100000, lease=600.0, ttl=86400.0):
+        self.path = path
+        self.chunk_points = chunk_points
+        self.lease = lease
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, created REAL, updated REAL, points INTEGER)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (job TEXT, chunk INTEGER, first INTEGER, last INTEGER, size INTEGER, "
+            "status TEXT, claimed REAL, positions BLOB, columns BLOB, result BLOB, PRIMARY KEY (job, chunk))")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS chunks_status ON chunks (status)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS fixed (job TEXT, position INTEGER, result TEXT, PRIMARY KEY (job, position))")
+
+    def _transaction(self, statements):
+        """Run statements(connection) in one write transaction"""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self._connection)
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        return result
+
+    def submit(self, points, positions, columns, fixed):
+        """
+        Store a new job.
+        :param points: number of points of the job (int)
+        :param positions: position of each point to compute (ndarray of int)
+        :param columns: latitude, longitude, altitude and year of those points (ndarray, 4 x len(positions))
+        :param fixed: results of the other points by position (dict of dicts)
+        :return: the job id (str)
+        """
+        job = uuid.uuid4().hex
+        now = time.time()
+        positions = np.asarray(positions, dtype="<i8")
+        columns = np.asarray(columns, dtype="<f8").reshape(INPUT_SIZE, -1)
+        chunks = []
+        for chunk, start in enumerate(range(0, len(positions), self.chunk_points)):
+            part = slice(start, start + self.chunk_points)
+            chunks.append((job, chunk, int(positions[part][0]), int(positions[part][-1]), len(positions[part]), "queued",
+                           None, positions[part].tobytes(), np.ascontiguousarray(columns[:, part]).tobytes(), None))
+
+        def insert(connection):
+            connection.execute("INSERT INTO jobs VALUES (?, ?, ?, ?)", (job, now, now, points))
+            connection.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", chunks)
+            connection.executemany("INSERT INTO fixed VALUES (?, ?, ?)",
+                                   ((job, position, json.dumps(result)) for position, result in fixed.items()))
+        self._transaction(insert)
+        return job
+
+    def claim(self):
+        """
+        Lease the oldest queued chunk, or a chunk whose lease has expired.
+        :return: job id, chunk number and the input columns (ndarray, 4 x size), or None when there is nothing to do
+        """
+        now = time.time()
+
+        def take(connection):
+            row = connection.execute(
+                "SELECT job, chunk, columns FROM chunks WHERE status = 'queued' OR (status = 'running' AND claimed < ?) "
+                "ORDER BY rowid LIMIT 1", (now - self.lease,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE chunks SET status = 'running', claimed = ? WHERE job = ? AND chunk = ?",
+                                   (now, row[0], row[1]))
+            return row
+        row = self._transaction(take)
+        if row is None:
+            return None
+        job, chunk, columns = row
+        return job, chunk, np.frombuffer(columns, dtype="<f8").reshape(INPUT_SIZE, -1)
+
+    def complete(self, job, chunk, components):
+        """Store the result components (ndarray, 7 x size) of a claimed chunk"""
+        result = np.ascontiguousarray(components, dtype="<f8").tobytes()
+
+        def store(connection):
+            connection.execute("UPDATE chunks SET status = 'done', result = ? WHERE job = ? AND chunk = ?", (result, job, chunk))
+            connection.execute("UPDATE jobs SET updated = ? WHERE id = ?", (time.time(), job))
+        self._transaction(store)
+
+    def status(self, job):
+        """
+        :return: state ("queued", "running" or "done"), progress and counters of a job (dict), or None if there is no such job
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT created, updated, points FROM jobs WHERE id = ?", (job,)).fetchone()
+            if row is None:
+                return None
+            counts = {status: (chunks, size) for status, chunks, size in self._connection.execute(
+                "SELECT status, COUNT(*), SUM(size) FROM chunks WHERE job = ? GROUP BY status", (job,))}
+        created, updated, points = row
+        chunks = sum(count for count, _ in counts.values())
+        done_chunks, computed = counts.get("done", (0, 0))
+        # Rejected and precomputed points are complete from the start
+        completed = points - sum(size for _, size in counts.values()) + computed
+        if done_chunks == chunks:
+            state = "done"
+        elif done_chunks or "running" in counts:
+            state = "running"
+        else:
+            state = "queued"
+        return {"id": job, "state": state, "points": points, "completed_points": completed,
+                "progress": completed / points if points else 1.0,
+                "chunks": chunks, "completed_chunks": done_chunks, "created": created, "updated": updated}
+
+    def results(self, job, offset, limit):
+        """
+        The stored results of the points at positions offset to offset + limit.
+        :return: the fixed results by position (dict) and, for every chunk holding
+                 points in the range, their positions (ndarray), input columns and
+                 result components (ndarray each), or None if there is no such job
+        :raise JobNotReady: when some of the points in the range are not computed yet
+        """
+        end = offset + limit
+        with self._lock:
+            if self._connection.execute("SELECT 1 FROM jobs WHERE id = ?", (job,)).fetchone() is None:
+                return None
+            rows = self._connection.execute(
+                "SELECT status, positions, columns, result FROM chunks WHERE job = ? AND last >= ? AND first < ? ORDER BY chunk",
+                (job, offset, end)).fetchall()
+            fixed = {position: json.loads(result) for position, result in self._connection.execute(
+                "SELECT position, result FROM fixed WHERE job = ? AND position >= ? AND position < ?", (job, offset, end))}
+        if any(status != "done" for status, _, _, _ in rows):
+            raise JobNotReady(f"Results from position {offset} are not computed yet")
+        chunks = [(np.frombuffer(positions, dtype="<i8"),
+                   np.frombuffer(columns, dtype="<f8").reshape(INPUT_SIZE, -1),
+                   np.frombuffer(result, dtype="<f8").reshape(RESULT_SIZE, -1))
+                  for _, positions, columns, result in rows]
+        return fixed, chunks
+
+    def delete(self, job):
+        """
+        Remove a job and its results, cancelling the chunks not computed yet.
+        :return: True if the job existed
+        """
+        def remove(connection):
+            connection.execute("DELETE FROM chunks WHERE job = ?", (job,))
+            connection.execute("DELETE FROM fixed WHERE job = ?", (job,))
+            return connection.execute("DELETE FROM jobs WHERE id = ?", (job,)).rowcount > 0
+        return self._transaction(remove)
+
+    def expire(self):
+        """Remove the jobs not updated for ttl seconds"""
+        if not self.ttl:
+            return
+        with self._lock:
+            jobs = [row[0] for row in self._connection.execute("SELECT id FROM jobs WHERE updated < ?", (time.time() - self.ttl,))]
+        for job in jobs:
+            self.delete(job)
+
+    def info(self):
+        """
+        :return: number of jobs and of chunks in each state (dict)
+        """
+        with self._lock:
+            jobs = self._connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            chunks = dict(self._connection.execute("SELECT status, COUNT(*) FROM chunks GROUP BY status"))
+        return {"path": self.path, "jobs": jobs, "chunks": chunks}
+
+
+class JobRunner:
+    """Worker threads computing the chunks of a JobStore"""
+
+    def __init__(self, store, compute, workers=1, poll_interval=0.5, expire_interval=600.0):
+        """
+        :param compute: function(lats, longs, altitudes, years) returning the 7 result components of a chunk
+        """
+        self.store = store
+        self.compute = compute
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.expire_interval = expire_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def run_one(self):
+        """
+        Claim, compute and store one chunk.
+        :return: False when there was nothing to do
+        """
+        task = self.store.claim()
+        if task is None:
+            return False
+        job, chunk, columns = task
+        components = np.array(self.compute(*columns))
+        self.store.complete(job, chunk, components)
+        logger.debug(f"Computed chunk {chunk} of job {job} ({columns.shape[1]} points)")
+        return True
+
+    def run_pending(self):
+        """Compute chunks until none is left to claim"""
+        while self.run_one():
+            pass
+
+    def _work(self):
+        last_expiry = 0.0
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() - last_expiry > self.expire_interval:
+                    last_expiry = time.monotonic()
+                    self.store.expire()
+                if not self.run_one():
+                    self._stop.wait(self.poll_interval)
+            except Exception as e:
+                # The chunk lease expires and another attempt picks it up
+                logger.error(f"Job worker error: {str(e)}")
+                self._stop.wait(self.poll_interval)
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._work, name=f"igrf-job-{index}", daemon=True)
+                         for index in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+
+def from_env(environ=os.environ):
+    """
+    Open the job store configured by the IGRF_JOB_* variables.
+    :return: a JobStore, or None when jobs are off
+    """
+    path = environ.get("IGRF_JOB_STORE", os.path.join(tempfile.gettempdir(), "igrf_jobs.sqlite"))
+    if path == "off":
+        return None
+    return JobStore(path, chunk_points=int(environ.get("IGRF_JOB_CHUNK_POINTS", 100000)),
+                    lease=float(environ.get("IGRF_JOB_LEASE", 600)), ttl=float(environ.get("IGRF_JOB_TTL", 86400)))
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Single-pass parser for /pyigrf request bodies.
+
+Accepted shapes, detected from the parsed value rather than by retrying:
+    [{...}, {...}]                             bare array of points
+    {"points_json": [{...}, {...}]}            points under points_json
+    {"points_json": "[{...}, {...}]"}          stringified points under points_json
+    {"points_json": "{\"points_json\": [...]}"} doubly-stringified points_json
+    "{\"points_json\": [...]}" / "[...]"       the whole body as a JSON string
+    {"latitude": ..., "longitude": ...}        a single point
+    {"latitude": [...], "longitude": [...]}    columnar arrays (see main.is_columnar)
+
+The body is decoded once. Only a stringified payload is decoded again, and
+only the inner string. Bodies that are not valid JSON at all (escaped quotes
+without the enclosing string, as some clients send) get one repair attempt.
+"""
+import json
+
+# orjson is required by requirements.txt, the stdlib decoder only stands in when it could not be installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Maximum number of points_json / stringified wrappers that are unwrapped
+MAX_NESTING = 4
+
+
+class PointsParseError(ValueError):
+    """Raised when a request body cannot be turned into points"""
+
+
+def loads(data):
+    """Decode JSON from bytes or str with the fastest available decoder"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _repair(body):
+    """Undo the escaping of a body sent as an unquoted stringified JSON document"""
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return body.strip().strip('"').replace('\\', '').replace('"{', '{').replace('}"', '}').replace('"[', '[').replace(']"', ']')
+
+
+def parse_points(body):
+    """
+    Parse a request body into points.
+    :param body: raw request body (bytes or str)
+    :return: list of point objects, or a dict of columns
+    """
+    try:
+        data = loads(body)
+    except ValueError as e:
+        try:
+            data = loads(_repair(body))
+        except ValueError:
+            raise PointsParseError(f"Invalid JSON format in request body: {str(e)}")
+
+    for _ in range(MAX_NESTING):
+        if isinstance(data, str):
+            try:
+                data = loads(data)
+            except ValueError as e:
+                raise PointsParseError(f"Invalid JSON format in points_json field: {str(e)}")
+        elif isinstance(data, dict) and "points_json" in data:
+            data = data["points_json"]
+        else:
+            break
+
+    if isinstance(data, dict):
+        # Columnar arrays are returned as they are, a single point is wrapped in a list
+        if isinstance(data.get("latitude"), list):
+            return data
+        return [data]
+    if not isinstance(data, list):
+        raise PointsParseError(f"Expected points_data to be a list, got {type(data).__name__}")
+    return data
@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Precomputed lookup tiles of the geomagnetic field.
+
+A tile store holds X, Y, Z and their secular variation on a regular global
+lattice of latitude, longitude and altitude for one segment of the default
+coefficient model: the years from one of its epochs to the next, or one
+model interval from its last epoch for the extrapolated model. Within a segment the coefficients change linearly with
+time, so the field at any year of the segment is its value at the start plus
+the secular variation times the elapsed years, and only the position has to
+be interpolated. That is done with Catmull-Rom cubics along each axis: 16
+lattice nodes for a point at one of the altitude levels, 64 for the others.
+
+Stores are built offline from the loaded coefficients, which measures the
+error bound against exact synthesis in every lattice cell:
+
+    python igrf_tiles.py 2025 tiles.npy [--step 1] [--altitudes 0 50] [--altitude-step 10]
+
+This writes the lattice to tiles.npy, memory-mapped when the store is opened
+so every worker shares one copy through the page cache, and its description
+to tiles.json. A point is answered from the tiles when its year is in the
+segment, its altitude in the lattice range and the error bound keeps within
+the limits below; the others are left to exact synthesis.
+
+Configured from the environment by from_env():
+    IGRF_TILES              path of the tile store (.npy), unset by default (no tiles)
+    IGRF_TILE_MAX_ERROR_NT  largest error bound in nT of a tile answer (default 1)
+    IGRF_TILE_MAX_ERROR_DEG largest error bound in degrees of the declination
+                            and inclination of a tile answer (default 0.01)
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+import igrf_engine
+from igrf_engine import FACT
+from pyIGRF import loadCoeffs
+
+logger = logging.getLogger("igrf.tiles")
+
+# Values stored at each lattice node
+COMPONENTS = ["north_component", "east_component", "vertical_component",
+              "north_component_rate", "east_component_rate", "vertical_component_rate"]
+# The stated bound is this many times the largest error measured by measure_error
+BOUND_MARGIN = 2.0
+# Positions within a lattice cell where measure_error samples the error along each axis
+SAMPLE_FRACTIONS = (0.21, 0.79)
+# Points interpolated at once, which bounds the gathered (points x 64 x 6) block
+CHUNK_POINTS = 4096
+
+
+def model_segment(year):
+    """
+    :return: start and end of the segment of the default model holding year, over which the coefficients
+             change linearly, from the last epoch one model interval of its secular variation (floats)
+    """
+    model = loadCoeffs.get_model()
+    i = int(np.clip(np.searchsorted(model.epochs, year, side="right") - 1, 0, len(model.epochs) - 1))
+    start = float(model.epochs[i])
+    return start, float(model.epochs[i + 1]) if i + 1 < len(model.epochs) else start + model.interval
+
+
+def coefficients_digest():
+    """:return: digest of the default model, recorded in a store so one built from other coefficients is refused (str)"""
+    return loadCoeffs.get_model().digest
+
+
+def metadata_path(path):
+    """:return: path of the description stored next to the lattice file (str)"""
+    return os.path.splitext(path)[0] + ".json"
+
+
+def _catmull_rom(t):
+    """Weights of the 4 nodes around each fraction t of a cell (ndarray, len(t) x 4)"""
+    t2 = t * t
+    t3 = t2 * t
+    return np.stack([(-t3 + 2 * t2 - t) / 2, (3 * t3 - 5 * t2 + 2) / 2, (-3 * t3 + 4 * t2 + t) / 2, (t3 - t2) / 2], axis=-1)
+
+
+def lattice_axes(step, altitudes, altitude_step):
+    """
+    Node coordinates of the lattice. Every axis has one node before its range
+    and two after it, so the cubic of any point in range has its 4 nodes;
+    the synthesis continues smoothly across the poles and below the surface.
+    :return: latitudes, east longitudes and altitudes of the nodes (ndarray each)
+    """
+    low, high = altitudes
+    levels = int(round((high - low) / altitude_step)) + 1
+    return (-90.0 + step * np.arange(-1, round(180.0 / step) + 3),
+            step * np.arange(-1, round(360.0 / step) + 2),
+            low + altitude_step * np.arange(-1, levels + 2))
+
+
+def build_tiles(year, step=1.0, altitudes=(0.0, 50.0), altitude_step=10.0):
+    """
+    Compute the lattice of the model segment holding year.
+    :param step: latitude and longitude spacing in degrees, dividing 180 (float)
+    :param altitudes: lowest and highest altitude in km (2 floats)
+    :param altitude_step: altitude spacing in km, dividing their difference (float)
+    :return: the lattice (ndarray, altitudes x latitudes x longitudes x 6) and its description (dict)
+    """
+    if step <= 0 or abs(180.0 / step - round(180.0 / step)) > 1e-9:
+        raise ValueError(f"The lattice step must divide 180 degrees, got {step}")
+    low, high = altitudes
+    if altitude_step <= 0 or high < low or abs((high - low) / altitude_step - round((high - low) / altitude_step)) > 1e-9:
+        raise ValueError(f"The altitude step must divide the altitude range {low} to {high}, got {altitude_step}")
+    start, end = model_segment(year)
+    lats, lons, alts = lattice_axes(step, altitudes, altitude_step)
+    values = np.empty((len(alts), len(lats), len(lons), len(COMPONENTS)))
+    for level, alt in enumerate(alts):
+        field = np.stack(igrf_engine.igrf_value_grid(lats, lons, alt, start)[3:6], axis=-1)
+        values[level, ..., :3] = field
+        # Linear in time over the segment, so one year ahead gives the rate
+        values[level, ..., 3:] = np.stack(igrf_engine.igrf_value_grid(lats, lons, alt, start + 1.0)[3:6], axis=-1) - field
+    meta = {"epoch_start": start, "epoch_end": end, "step": float(step), "altitude_min": float(low),
+            "altitude_max": float(high), "altitude_step": float(altitude_step), "error_nt": None,
+            "coefficients": coefficients_digest(), "built": time.time()}
+    meta["error_nt"] = measure_error(TileStore(values, meta))
+    return values, meta
+
+
+def measure_error(store):
+    """
+    Largest difference between interpolated and synthesized fields over the
+    whole segment, sampled in every lattice cell at 0.21 and 0.79 of the cell
+    along each axis, where the error of the cubics peaks (it vanishes half way).
+    :return: the error bound in nT, BOUND_MARGIN times that difference (float)
+    """
+    meta = store.meta
+    step, altitude_step = meta["step"], meta["altitude_step"]
+    levels = meta["altitude_min"] + altitude_step * np.arange(round((meta["altitude_max"] - meta["altitude_min"]) / altitude_step) + 1)
+    altitudes = np.concatenate([levels] + [levels[:-1] + fraction * altitude_step for fraction in SAMPLE_FRACTIONS])
+    position_error = rate_error = 0.0
+    for lat_fraction in SAMPLE_FRACTIONS:
+        for lon_fraction in SAMPLE_FRACTIONS:
+            lats = -90.0 + step * (lat_fraction + np.arange(round(180.0 / step)))
+            lons = step * (lon_fraction + np.arange(round(360.0 / step)))
+            lat_grid, lon_grid = np.meshgrid(lats, lons, indexing="ij")
+            for alt in altitudes:
+                field = np.stack(igrf_engine.igrf_value_grid(lats, lons, alt, meta["epoch_start"])[3:6], axis=-1).reshape(-1, 3)
+                rate = np.stack(igrf_engine.igrf_value_grid(lats, lons, alt, meta["epoch_start"] + 1.0)[3:6], axis=-1).reshape(-1, 3) - field
+                values = store.interpolate(lat_grid.ravel(), lon_grid.ravel(), np.full(lat_grid.size, alt))
+                position_error = max(position_error, np.linalg.norm(values[:, :3] - field, axis=1).max())
+                rate_error = max(rate_error, np.linalg.norm(values[:, 3:] - rate, axis=1).max())
+    return float(BOUND_MARGIN * (position_error + (meta["epoch_end"] - meta["epoch_start"]) * rate_error))
+
+
+class TileStore:
+    """A tile store, answering the points it covers within the error limits"""
+
+    def __init__(self, values, meta, max_error_nt=1.0, max_error_deg=0.01):
+        """
+        :param values: the lattice from build_tiles (ndarray, may be memory-mapped)
+        :param meta: its description from build_tiles (dict)
+        """
+        self.values = values
+        self.meta = meta
+        self.max_error_nt = max_error_nt
+        self.max_error_deg = max_error_deg
+        self._flat = values.reshape(-1, len(COMPONENTS))
+        lats, lons, alts = lattice_axes(meta["step"], (meta["altitude_min"], meta["altitude_max"]), meta["altitude_step"])
+        self._origin = (lats[0], lons[0], alts[0])
+        levels, rows, columns = values.shape[:3]
+        # Flat offsets of the 4 x 4 (latitude x longitude) and 4 x 4 x 4 nodes around the first node of a point
+        self._offsets_2d = (np.arange(4)[:, None] * columns + np.arange(4)[None, :]).ravel()
+        self._offsets_3d = (np.arange(4)[:, None] * rows * columns + self._offsets_2d[None, :]).ravel()
+        self._strides = (rows * columns, columns)
+
+    def interpolate(self, lats, longs, altitudes):
+        """
+        The stored values at points within the lattice range.
+        :return: X, Y, Z and their rates at the start of the segment (ndarray, points x 6)
+        """
+        step, altitude_step = self.meta["step"], self.meta["altitude_step"]
+        level_stride, row_stride = self._strides
+        values = np.empty((len(lats), len(COMPONENTS)))
+        for start in range(0, len(lats), CHUNK_POINTS):
+            chunk = slice(start, start + CHUNK_POINTS)
+            rows = (np.asarray(lats[chunk]) - self._origin[0]) / step
+            columns = (np.asarray(longs[chunk]) % 360.0 - self._origin[1]) / step
+            levels = (np.asarray(altitudes[chunk]) - self._origin[2]) / altitude_step
+            row, column, level = (np.floor(rows).astype(np.intp), np.floor(columns).astype(np.intp),
+                                  np.floor(levels).astype(np.intp))
+            weights = _catmull_rom(rows - row)[:, :, None] * _catmull_rom(columns - column)[:, None, :]
+            first = (level - 1) * level_stride + (row - 1) * row_stride + (column - 1)
+            # Points on an altitude level only need the nodes of that level
+            on_level = levels == level
+            if on_level.any():
+                nodes = self._flat[(first[on_level] + level_stride)[:, None] + self._offsets_2d]
+                values[chunk][on_level] = np.einsum("pk,pkc->pc", weights[on_level].reshape(-1, 16), nodes)
+            between = ~on_level
+            if between.any():
+                weights_3d = _catmull_rom(levels[between] - level[between])[:, :, None] * weights[between].reshape(-1, 1, 16)
+                nodes = self._flat[first[between][:, None] + self._offsets_3d]
+                values[chunk][between] = np.einsum("pk,pkc->pc", weights_3d.reshape(-1, 64), nodes)
+        return values
+
+    def lookup(self, lats, longs, altitudes, years):
+        """
+        Answer the points the store covers within the error limits.
+        :return: whether each point is answered (ndarray of bool) and the
+                 D, I, H, X, Y, Z, F of those points, as igrf_value_batch (ndarray, 7 x answered)
+        """
+        lats, longs, altitudes, years = (np.asarray(column, dtype=float) for column in (lats, longs, altitudes, years))
+        meta = self.meta
+        answered = ((years >= meta["epoch_start"]) & (years < meta["epoch_end"])
+                    & (altitudes >= meta["altitude_min"]) & (altitudes <= meta["altitude_max"]))
+        if meta["error_nt"] > self.max_error_nt or not answered.any():
+            return np.zeros(len(lats), dtype=bool), np.empty((7, 0))
+        indices = np.flatnonzero(answered)
+        values = self.interpolate(lats[indices], longs[indices], altitudes[indices])
+        x, y, z = (values[:, :3] + (years[indices] - meta["epoch_start"])[:, None] * values[:, 3:]).T
+        h = np.sqrt(x * x + y * y)
+        # The declination error grows as the horizontal field vanishes, near the magnetic poles
+        with np.errstate(divide="ignore"):
+            precise = FACT * meta["error_nt"] / h <= self.max_error_deg
+        answered[indices[~precise]] = False
+        x, y, z, h = x[precise], y[precise], z[precise], h[precise]
+        return answered, np.array([FACT * np.arctan2(y, x), FACT * np.arctan2(z, h), h, x, y, z, np.sqrt(h * h + z * z)])
+
+    def info(self):
+        """
+        :return: the segment, lattice and error bound of the store and the limits it answers within (dict)
+        """
+        return dict(self.meta, size_bytes=self.values.nbytes, max_error_nt=self.max_error_nt, max_error_deg=self.max_error_deg)
+
+
+def save_tiles(path, values, meta):
+    """Write a lattice and its description, replacing both files at once so running workers never map a partial store"""
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, np.ascontiguousarray(values, dtype="<f8"))
+    with open(metadata_path(path) + ".tmp", "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(path + ".tmp", path)
+    os.replace(metadata_path(path) + ".tmp", metadata_path(path))
+
+
+def open_tiles(path, max_error_nt=1.0, max_error_deg=0.01):
+    """
+    Memory-map a tile store written by save_tiles.
+    :raise ValueError: when it was built from other coefficients than the loaded ones
+    """
+    with open(metadata_path(path)) as f:
+        meta = json.load(f)
+    if meta["coefficients"] != coefficients_digest():
+        raise ValueError(f"Tile store {path} was built from other coefficients than the loaded ones, rebuild it")
+    return TileStore(np.load(path, mmap_mode="r"), meta, max_error_nt, max_error_deg)
+
+
+def from_env(environ=os.environ):
+    """
+    Open the tile store configured by the IGRF_TILE* variables.
+    :return: a TileStore, or None when there is none or it cannot be used
+    """
+    path = environ.get("IGRF_TILES")
+    if not path:
+        return None
+    try:
+        store = open_tiles(path, float(environ.get("IGRF_TILE_MAX_ERROR_NT", 1.0)),
+                           float(environ.get("IGRF_TILE_MAX_ERROR_DEG", 0.01)))
+    except (OSError, ValueError, KeyError) as e:
+        # Exact synthesis answers everything, only slower
+        logger.error(f"Not using tile store {path}: {str(e)}")
+        return None
+    if store.meta["error_nt"] > store.max_error_nt:
+        logger.warning(f"Tile store {path} has an error bound of {store.meta['error_nt']:.3g} nT, above "
+                       f"IGRF_TILE_MAX_ERROR_NT, no point will be answered from it")
+    return store
+
+
+if __name__ == "__main__":
+    # Build step: python igrf_tiles.py 2025 tiles.npy
+    parser = argparse.ArgumentParser(description="Build a tile store for the model segment holding a year")
+    parser.add_argument("year", type=float, help="any decimal year of the segment")
+    parser.add_argument("output", help="lattice file to write (.npy), described in the .json file next to it")
+    parser.add_argument("--step", type=float, default=1.0, help="latitude and longitude spacing in degrees (default 1)")
+    parser.add_argument("--altitudes", type=float, nargs=2, default=(0.0, 50.0), help="lowest and highest altitude in km (default 0 50)")
+    parser.add_argument("--altitude-step", type=float, default=10.0, help="altitude spacing in km (default 10)")
+    args = parser.parse_args()
+    values, meta = build_tiles(args.year, args.step, tuple(args.altitudes), args.altitude_step)
+    save_tiles(args.output, values, meta)
+    print(f"Built {args.output} for {meta['epoch_start']:g} to {meta['epoch_end']:g}: "
+          f"{values.nbytes / 1e6:.1f} MB, error bound {meta['error_nt']:.3g} nT")
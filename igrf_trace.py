@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Field-line tracing on the IGRF.
+
+Field lines are integrated along the unit field direction with an adaptive
+Dormand-Prince 5(4) Runge-Kutta scheme, in Earth-centred Cartesian
+coordinates (km). Every line keeps its own step size, but all the lines of a
+batch advance together: each stage evaluates the field at the current
+position of every active line with one call to igrf_engine.igrf12syn_batch.
+
+A line stops when it comes back down to the stop altitude (the footprint,
+e.g. the magnetic conjugate point), when it leaves max_radius (an open
+line) or after max_steps integration steps. A line also stops where the
+field is zero or not finite, since it has no direction to follow there.
+
+Positions are geodetic (WGS84) on input and output, like the other endpoints.
+"""
+import numpy as np
+
+import igrf_engine
+from igrf_engine import A2, B2, FACT, RE
+
+# WGS84 semi-axes (km) and first eccentricity squared, matching the spheroid of igrf_engine
+SEMI_MAJOR = np.sqrt(A2)
+E2 = 1.0 - B2 / A2
+
+# Ways a trace can end, reported by index in the status array
+STATUSES = ("stop_altitude", "max_radius", "max_steps", "no_field")
+# Directions of a trace: along the field, against it, or whichever of the two leaves the Earth first
+DIRECTIONS = ("along", "against", "outward")
+
+# First step and step bounds in km; a step is never longer than MAX_STEP_FRACTION of the distance to the centre
+INITIAL_STEP = 10.0
+MIN_STEP = 1e-3
+MAX_STEP_FRACTION = 0.1
+
+# Dormand-Prince 5(4) tableau. The last stage is evaluated at the new position and reused as the
+# first stage of the next step
+DP_A = (
+    (),
+    (1 / 5,),
+    (3 / 40, 9 / 40),
+    (44 / 45, -56 / 15, 32 / 9),
+    (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+    (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+    (35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84),
+)
+# Fifth order weights minus the embedded fourth order ones, the local error estimate
+DP_ERROR = (35 / 384 - 5179 / 57600, 0.0, 500 / 1113 - 7571 / 16695, 125 / 192 - 393 / 640,
+            -2187 / 6784 + 92097 / 339200, 11 / 84 - 187 / 2100, -1 / 40)
+
+
+def geodetic_to_ecef(lat, lon, alt):
+    """
+    :param lat: geodetic latitude in degrees (ndarray)
+    :param lon: east longitude in degrees (ndarray)
+    :param alt: height above the spheroid in km (ndarray)
+    :return: Earth-centred Cartesian positions, shape (n, 3) (ndarray, km)
+    """
+    phi = np.asarray(lat, dtype=float) / FACT
+    lam = np.asarray(lon, dtype=float) / FACT
+    alt = np.asarray(alt, dtype=float)
+    sp = np.sin(phi)
+    cp = np.cos(phi)
+    n = SEMI_MAJOR / np.sqrt(1.0 - E2 * sp * sp)
+    return np.stack([(n + alt) * cp * np.cos(lam), (n + alt) * cp * np.sin(lam), (n * (1.0 - E2) + alt) * sp], axis=-1)
+
+
+def ecef_to_geodetic(pos, iterations=5):
+    """
+    Inverse of geodetic_to_ecef by fixed-point iteration on the latitude,
+    converged to well below a millimetre after a few iterations.
+    :param pos: Earth-centred Cartesian positions, shape (n, 3) (ndarray, km)
+    :return: latitude, longitude (degrees), height above the spheroid (km) (ndarray each)
+    """
+    x, y, z = pos[:, 0], pos[:, 1], pos[:, 2]
+    p = np.hypot(x, y)
+    phi = np.arctan2(z, p * (1.0 - E2))
+    for _ in range(iterations):
+        sp = np.sin(phi)
+        n = SEMI_MAJOR / np.sqrt(1.0 - E2 * sp * sp)
+        alt = p * np.cos(phi) + z * sp - SEMI_MAJOR * np.sqrt(1.0 - E2 * sp * sp)
+        phi = np.arctan2(z, p * (1.0 - E2 * n / (n + alt)))
+    sp = np.sin(phi)
+    alt = p * np.cos(phi) + z * sp - SEMI_MAJOR * np.sqrt(1.0 - E2 * sp * sp)
+    return phi * FACT, np.arctan2(y, x) * FACT, alt
+
+
+def field_ecef(pos, year):
+    """
+    IGRF field vectors in Earth-centred Cartesian coordinates.
+    :param pos: positions, shape (n, 3) (ndarray, km)
+    :param year: decimal year (float)
+    :return: field vectors, shape (n, 3) (ndarray, nT)
+    """
+    r = np.linalg.norm(pos, axis=1)
+    colat = np.arccos(np.clip(pos[:, 2] / r, -1.0, 1.0))
+    elong = np.arctan2(pos[:, 1], pos[:, 0])
+    # Geocentric synthesis: north, east and down components on the sphere
+    north, east, down, _ = igrf_engine.igrf12syn_batch(year, 2, r, 90.0 - colat * FACT, elong * FACT)
+    ct, st = np.cos(colat), np.sin(colat)
+    cl, sl = np.cos(elong), np.sin(elong)
+    # B = -down e_r - north e_theta + east e_phi
+    b_r, b_theta = -down, -north
+    return np.stack([
+        b_r * st * cl + b_theta * ct * cl - east * sl,
+        b_r * st * sl + b_theta * ct * sl + east * cl,
+        b_r * ct - b_theta * st,
+    ], axis=-1)
+
+
+def _direction(pos, year, sign):
+    """Unit field direction times sign (+1 or -1 per line), shape (n, 3), not finite where the field vanishes"""
+    b = field_ecef(pos, year)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sign[:, None] * b / np.linalg.norm(b, axis=1)[:, None]
+
+
+def trace_field_lines(lat, lon, alt, year, direction="outward", stop_altitude=0.0, max_radius=20 * RE,
+                      tolerance=0.01, max_steps=10000, include_path=False):
+    """
+    Trace field lines from a batch of start points.
+    :param lat, lon, alt: geodetic start points, degrees and km (array_like)
+    :param year: decimal year (float)
+    :param direction: one of DIRECTIONS
+    :param stop_altitude: a line stops when it comes down through this height above the spheroid (km)
+    :param max_radius: a line stops beyond this distance from the centre of the Earth (km)
+    :param tolerance: local error allowed per step, and how close the end point lands on stop_altitude (km)
+    :param max_steps: integration steps, accepted or not, allowed per line
+    :param include_path: return the geodetic position after every step
+    :return: dict with the geodetic end points (end_latitude, end_longitude, end_altitude),
+             status (index into STATUSES), steps, length (km) and max_altitude (km) of each line,
+             and when include_path is set, path: one (latitude, longitude, altitude) tuple of
+             ndarrays per line, starting at the start point
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError(f"direction must be one of {', '.join(DIRECTIONS)}, got {direction}")
+    lat, lon, alt = (np.atleast_1d(np.asarray(a, dtype=float)) for a in (lat, lon, alt))
+    year = float(year)
+    npts = lat.shape[0]
+
+    pos = geodetic_to_ecef(lat, lon, alt)
+    b = field_ecef(pos, year)
+    if direction == "outward":
+        # Follow the field where it points away from the centre, against it where it points down
+        sign = np.where(np.einsum('ij,ij->i', b, pos) >= 0.0, 1.0, -1.0)
+    else:
+        sign = np.full(npts, 1.0 if direction == "along" else -1.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k1 = sign[:, None] * b / np.linalg.norm(b, axis=1)[:, None]
+
+    height = alt.copy()
+    step = np.minimum(INITIAL_STEP, MAX_STEP_FRACTION * np.linalg.norm(pos, axis=1))
+    status = np.full(npts, -1)
+    status[~np.isfinite(k1).all(axis=1)] = 3
+    steps = np.zeros(npts, dtype=int)
+    attempts = np.zeros(npts, dtype=int)
+    length = np.zeros(npts)
+    max_altitude = alt.copy()
+    path_chunks = [(np.arange(npts), pos.copy())] if include_path else None
+
+    active = status < 0
+    while active.any():
+        idx = np.flatnonzero(active)
+        p0 = pos[idx]
+        h = step[idx][:, None]
+        s = sign[idx]
+        stages = [k1[idx]]
+        for row in DP_A[1:]:
+            offset = sum(weight * k for weight, k in zip(row, stages) if weight)
+            stages.append(_direction(p0 + h * offset, year, s))
+        p1 = p0 + h * sum(weight * k for weight, k in zip(DP_A[-1], stages) if weight)
+        error = np.linalg.norm(h * sum(weight * k for weight, k in zip(DP_ERROR, stages) if weight), axis=1)
+        attempts[idx] += 1
+
+        h = h[:, 0]
+        # A stage landed where the field vanishes, the step cannot be taken
+        no_field = ~(np.isfinite(p1).all(axis=1) & np.isfinite(error))
+        accept = ((error <= tolerance) | (h <= MIN_STEP)) & ~no_field
+        previous_height = height[idx]
+        _, _, new_height = ecef_to_geodetic(p1)
+        # Coming down through the stop altitude: land on it within the tolerance, shortening the step as needed
+        crossing = accept & (previous_height >= stop_altitude) & (new_height < stop_altitude)
+        landed = crossing & (stop_altitude - new_height <= tolerance)
+        at_previous = crossing & ~landed & (previous_height - stop_altitude <= tolerance)
+        retry = crossing & ~landed & ~at_previous
+        accept &= ~crossing | landed
+
+        done = idx[accept]
+        pos[done] = p1[accept]
+        k1[done] = stages[-1][accept]
+        height[done] = new_height[accept]
+        length[done] += h[accept]
+        steps[done] += 1
+        max_altitude[done] = np.maximum(max_altitude[done], new_height[accept])
+        if include_path and len(done):
+            path_chunks.append((done, p1[accept]))
+
+        # Secant estimate of the step that lands on the stop altitude
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = (previous_height - stop_altitude) / (previous_height - new_height)
+            grow = np.clip(0.9 * (tolerance / np.maximum(error, 1e-30)) ** 0.2, 0.2, 5.0)
+        h = np.where(retry, h * np.clip(fraction, 0.01, 0.99), h * grow)
+        step[idx] = np.clip(h, MIN_STEP, MAX_STEP_FRACTION * np.linalg.norm(pos[idx], axis=1))
+
+        status[idx[landed | at_previous]] = 0
+        status[idx[accept & (np.linalg.norm(p1, axis=1) > max_radius)]] = 1
+        status[idx[no_field & (status[idx] < 0)]] = 3
+        status[idx[(status[idx] < 0) & (attempts[idx] >= max_steps)]] = 2
+        active[idx] = status[idx] < 0
+
+    end_lat, end_lon, end_alt = ecef_to_geodetic(pos)
+    result = {"end_latitude": end_lat, "end_longitude": end_lon, "end_altitude": end_alt,
+              "status": status, "steps": steps, "length": length, "max_altitude": max_altitude}
+    if include_path:
+        lines = np.concatenate([indices for indices, _ in path_chunks])
+        points = np.concatenate([chunk for _, chunk in path_chunks])
+        # Stable sort keeps each line's positions in step order
+        order = np.argsort(lines, kind="stable")
+        path_lat, path_lon, path_alt = ecef_to_geodetic(points[order])
+        bounds = np.cumsum(np.bincount(lines, minlength=npts))[:-1]
+        result["path"] = list(zip(np.split(path_lat, bounds), np.split(path_lon, bounds), np.split(path_alt, bounds)))
+    return result
@@ -1,70 +1,43 @@
-from pyclbr import Class
-from typing import List, Union, Dict, Any
+from typing import List, Optional, Union, Dict, Any
 import json
+import logging
 import os
-import uvicorn
-import sys
-import shutil
+import time
+import tempfile
+import asyncio
+import concurrent.futures
 
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-
-# Try to import pyIGRF, and if it fails, set up the environment for it
-try:
-    import pyIGRF
-except Exception as e:
-    print(f"Error importing pyIGRF: {e}")
-
-    # Create necessary directories
-    pyigrf_paths = [
-        '.venv/lib/python3.11/site-packages/pyIGRF/src',
-        '/opt/render/project/src/.venv/lib/python3.11/site-packages/pyIGRF/src',
-        '/opt/render/project/.venv/lib/python3.11/site-packages/pyIGRF/src',
-        '/opt/render/project/src/.venv/lib/python3.9/site-packages/pyIGRF/src'
-    ]
-
-    for path in pyigrf_paths:
-        try:
-            os.makedirs(path, exist_ok=True)
-            print(f"Created directory: {path}")
-        except Exception as dir_error:
-            print(f"Could not create directory {path}: {dir_error}")
-
-    # Copy the custom files if they exist
-    if os.path.exists('custom_igrf14coeffs.txt'):
-        for path in pyigrf_paths:
-            try:
-                shutil.copy('custom_igrf14coeffs.txt', os.path.join(path, 'igrf14coeffs.txt'))
-                print(f"Copied custom_igrf14coeffs.txt to {os.path.join(path, 'igrf14coeffs.txt')}")
-            except Exception as copy_error:
-                print(f"Could not copy to {path}: {copy_error}")
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
+import numpy as np
 
-    if os.path.exists('custom_loadCoeffs.py'):
-        for path in pyigrf_paths:
-            try:
-                base_path = os.path.dirname(path)
-                shutil.copy('custom_loadCoeffs.py', os.path.join(base_path, 'loadCoeffs.py'))
-                print(f"Copied custom_loadCoeffs.py to {os.path.join(base_path, 'loadCoeffs.py')}")
-            except Exception as copy_error:
-                print(f"Could not copy to {base_path}: {copy_error}")
+# Log messages of the service and of the pyIGRF loader go to stderr at IGRF_LOG_LEVEL (default WARNING), DEBUG logs every request
+LOG_LEVEL = os.environ.get("IGRF_LOG_LEVEL", "WARNING").upper()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+for logger_name in ("igrf", "pyIGRF"):
+    logging.getLogger(logger_name).setLevel(LOG_LEVEL)
+    logging.getLogger(logger_name).addHandler(log_handler)
+    logging.getLogger(logger_name).propagate = False
+logger = logging.getLogger("igrf")
 
-    # Try importing again
-    try:
-        import pyIGRF
-        print("Successfully imported pyIGRF after setup")
-    except Exception as reimport_error:
-        print(f"Still could not import pyIGRF: {reimport_error}")
-        # Define a fallback function for igrf_variation
-        class FallbackPyIGRF:
-            @staticmethod
-            def igrf_variation(long, lat, altitude, year):
-                print(f"Using fallback igrf_variation with params: long={long}, lat={lat}, altitude={altitude}, year={year}")
-                # Return a dummy result with the expected structure
-                return [-1.5, -11.2, 31000, 31000, -800, -6000, 31700]
-
-        # Replace the pyIGRF module with our fallback
-        pyIGRF = FallbackPyIGRF()
+# The coefficient models are loaded on first use, from IGRF_COEFFS_FILE and IGRF_MODELS_DIR (see custom_loadCoeffs.py)
+import pyIGRF
+
+# Vectorized IGRF synthesis used by the batch endpoints
+import igrf_batching
+import igrf_cache
+import igrf_encoder
+import igrf_engine
+import igrf_jobs
+import igrf_metrics
+import igrf_parser
+import igrf_tiles
+import igrf_trace
 
 app = FastAPI()
 
@@ -77,6 +50,41 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Latency and volume metrics, served on GET /metrics
+REQUEST_SECONDS = igrf_metrics.Histogram("igrf_request_seconds", "Time from receiving a request to sending the last byte of its response", ["path"])
+STAGE_SECONDS = igrf_metrics.Histogram("igrf_stage_seconds", "Time spent in each stage of the IGRF endpoints", ["stage"])
+POINTS = igrf_metrics.Counter("igrf_points_total", "Points evaluated, computed, served from the result cache or interpolated from the tile store", ["source"])
+FAILED_POINTS = igrf_metrics.Counter("igrf_failed_points_total", "Points of requests that failed because their calculation failed or timed out", ["reason"])
+REJECTED_POINTS = igrf_metrics.Counter("igrf_rejected_points_total", "Points rejected by input validation")
+POINTS_PER_SECOND = igrf_metrics.Gauge("igrf_compute_points_per_second", "Throughput of the last computed batch")
+CACHE_HITS = igrf_metrics.Gauge("igrf_cache_hits", "Lookups answered by a cache", ["cache"])
+CACHE_MISSES = igrf_metrics.Gauge("igrf_cache_misses", "Lookups not answered by a cache", ["cache"])
+CACHE_SIZE = igrf_metrics.Gauge("igrf_cache_size", "Entries held by a cache", ["cache"])
+BATCHED_REQUESTS = igrf_metrics.Counter("igrf_batched_requests_total", "Small requests whose points were computed in a micro-batch")
+BATCHES = igrf_metrics.Counter("igrf_batches_total", "Micro-batches computed for small requests")
+# Paths reported under their own label, every other path is reported as "other"
+METERED_PATHS = ("/pyigrf", "/pyigrf/", "/pyigrf/grid", "/pyigrf/trace", "/pyigrf/timeseries", "/pyigrf/jobs", "/pyigrf/model")
+
+
+class RequestTimer:
+    """ASGI middleware observing the duration of every HTTP request in REQUEST_SECONDS"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            path = scope["path"] if scope["path"] in METERED_PATHS else "other"
+            REQUEST_SECONDS.observe(time.perf_counter() - start, path=path)
+
+
+app.add_middleware(RequestTimer)
+
 class DataPoint(BaseModel):
     long: float
     lat: float
@@ -89,9 +97,1276 @@ class PointArray(BaseModel):
 class StringifiedPointArray(BaseModel):
     points_json: str
 
+class GridRequest(BaseModel):
+    min_latitude: float
+    max_latitude: float
+    min_longitude: float
+    max_longitude: float
+    spacing: float
+    altitude: float
+    year: float
+
+class TracePoint(BaseModel):
+    latitude: float
+    longitude: float
+    altitude: float
+
+class TraceRequest(BaseModel):
+    points: List[TracePoint]
+    year: float
+    direction: str = "outward"
+    stop_altitude: float = 0.0
+    max_radius: float = 20.0
+    tolerance: float = 0.01
+    max_steps: int = 10000
+    include_path: bool = False
+
+class TimeSeriesRequest(BaseModel):
+    latitude: float
+    longitude: float
+    altitude: float
+    years: Optional[List[float]] = None
+    start_year: Optional[float] = None
+    end_year: Optional[float] = None
+    step: float = 1.0
+
 points = {
     0: DataPoint(long=1234,lat=2468,altitude=500,year=2000),
 }
+
+# Input fields which, when all present on a point, are echoed back instead of being computed
+PRECOMPUTED_FIELDS = ["declination", "horizontal intensity", "inclination", "total intensity", "vertical intensity"]
+
+# Accepted range of each input field and the message given for a value outside it, in the order the fields are checked
+POINT_RANGES = {
+    "latitude": (-90, 90, "Latitude must be between -90 and 90"),
+    "longitude": (-180, 180, "Longitude must be between -180 and 180"),
+    "altitude": (0, np.inf, "Altitude must be a non-negative number"),
+    "year": (1900, 2030, "Year must be between 1900 and 2030"),
+}
+
+
+def point_result(lat, long, altitude, year, result):
+    """Format an IGRF result into a dictionary with descriptive field names"""
+    dd, ds, dh, dx, dy, dz, df = result
+    return {
+        "latitude": lat,
+        "longitude": long,
+        "altitude": altitude,
+        "year": year,
+        "declination": dd,  # D: declination (+ve east) in degrees
+        "inclination": ds,  # I: inclination (+ve down) in degrees
+        "horizontal_intensity": dh,  # H: horizontal intensity in nT
+        "north_component": dx,  # X: north component in nT
+        "east_component": dy,  # Y: east component in nT
+        "vertical_component": dz,  # Z: vertical component (+ve down) in nT
+        "total_intensity": df  # F: total intensity in nT
+    }
+
+
+def rejected_result(lat, long, altitude, year, reason):
+    """
+    Result of a point that failed validation: the input values that could be
+    read (None for the others) and the reason, without any field values
+    """
+    values = [None if value != value else value for value in (lat, long, altitude, year)]
+    return dict(zip(POINT_COLUMNS, values), error=reason)
+
+
+# A single long-lived pool does the IGRF work for the whole app
+IGRF_WORKERS = int(os.environ.get("IGRF_WORKERS", min(4, os.cpu_count() or 1)))
+igrf_executor = concurrent.futures.ThreadPoolExecutor(max_workers=IGRF_WORKERS, thread_name_prefix="igrf")
+
+# Batches are split into chunks of this many points, each submitted to the pool as one task
+CHUNK_POINTS = int(os.environ.get("IGRF_CHUNK_POINTS", 10000))
+
+# Batches of at least this many points run on a process pool so they use every core, 0 processes disables it.
+# A single CPU gains nothing from it. Every uvicorn worker (WEB_CONCURRENCY, as uvicorn reads it) has its own pool,
+# so by default they share the CPUs instead of each spawning one process per CPU.
+UVICORN_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+IGRF_PROCESSES = int(os.environ.get("IGRF_PROCESSES", max(1, (os.cpu_count() or 1) // UVICORN_WORKERS) if (os.cpu_count() or 1) > 1 else 0))
+PROCESS_MIN_POINTS = int(os.environ.get("IGRF_PROCESS_MIN_POINTS", 100000))
+igrf_process_pool = None
+
+
+def get_process_pool():
+    """
+    The shared process pool, created by the first batch of at least
+    PROCESS_MIN_POINTS points so servers that never see one do not pay for
+    it at startup. Workers are spawned rather than forked from the threaded
+    server and load the coefficients once when they start, memory-mapping
+    the compiled table so all of them share one copy through the page cache.
+    """
+    global igrf_process_pool
+    # A worker that died (e.g. killed for memory) breaks the whole pool, start a new one
+    if igrf_process_pool is None or igrf_process_pool._broken:
+        # Only servers that compute large batches pay for importing multiprocessing
+        import multiprocessing
+        igrf_process_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=IGRF_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=igrf_engine.warm_up,
+        )
+    return igrf_process_pool
+
+
+def executor_for(npts):
+    """Process pool for large batches, the in-process thread pool for small ones"""
+    if IGRF_PROCESSES > 0 and npts >= PROCESS_MIN_POINTS:
+        return get_process_pool()
+    return igrf_executor
+
+
+# Number of requests computing at the same time, later ones wait for a slot without blocking the event loop
+MAX_CONCURRENT_COMPUTE = int(os.environ.get("IGRF_MAX_CONCURRENT", 4))
+compute_slots = None
+
+
+async def offload(func, *args):
+    """
+    Run a CPU-bound or blocking function off the event loop, at most
+    MAX_CONCURRENT_COMPUTE at a time, so health checks and small requests
+    are answered while large batches are computed. Functions that build a
+    response should return it already rendered (e.g. with json_response), or
+    FastAPI encodes it on the event loop.
+    """
+    global compute_slots
+    # Created on first use so it belongs to the running loop
+    if compute_slots is None:
+        compute_slots = asyncio.Semaphore(MAX_CONCURRENT_COMPUTE)
+    async with compute_slots:
+        return await run_in_threadpool(func, *args)
+
+
+# Timeouts in seconds for one chunk and for all the chunks of a request
+CHUNK_TIMEOUT = float(os.environ.get("IGRF_CHUNK_TIMEOUT", 5))
+REQUEST_TIMEOUT = float(os.environ.get("IGRF_REQUEST_TIMEOUT", 60))
+
+
+# Results of recently computed points, see igrf_cache for the settings
+result_cache = igrf_cache.from_env()
+RESULT_CACHE_QUANTUM = igrf_cache.quantum_from_env()
+
+# Precomputed field lattice answering the points it covers by interpolation, see igrf_tiles for the settings
+tile_store = igrf_tiles.from_env()
+
+
+def collect_chunks(futures, components, deadline):
+    """
+    Store the result of each (chunk, future) pair in components[:, chunk].
+    A chunk that fails or times out fails the whole request, with 504 for a
+    timeout and 500 for an error, and the chunks still queued are cancelled.
+    :param deadline: time.monotonic() past which no chunk is waited for
+    """
+    try:
+        for chunk, future in futures:
+            # Chunks run concurrently, so each one gets the chunk timeout but never past the request deadline
+            timeout = max(0.0, min(CHUNK_TIMEOUT, deadline - time.monotonic()))
+            components[:, chunk] = future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        logger.warning(f"Calculation timed out for {components[0].size} points")
+        FAILED_POINTS.inc(components[0].size, reason="timeout")
+        raise HTTPException(status_code=504, detail="Calculation timed out, send fewer points per request")
+    except Exception as e:
+        logger.error(f"Error calculating IGRF for {components[0].size} points: {str(e)}")
+        FAILED_POINTS.inc(components[0].size, reason="error")
+        raise HTTPException(status_code=500, detail="Calculation failed")
+    finally:
+        for _, future in futures:
+            future.cancel()
+
+
+def compute_chunks(lats, longs, altitudes, years, itype=1, model=None):
+    """
+    Evaluate the IGRF for columns of points on the shared worker pool.
+    A chunk that fails or times out fails the request, see collect_chunks.
+    :param itype: frame of the points, see coordinate_type
+    :param model: coefficient model name, see model_name
+    :return: the result components (ndarray, one row per component) and
+             whether each point has a result, not a year outside the model (ndarray of bool)
+    """
+    components = np.empty((len(RESULT_COMPONENTS), len(lats)))
+    executor = executor_for(len(lats))
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+    futures = []
+    for start in range(0, len(lats), CHUNK_POINTS):
+        chunk = slice(start, start + CHUNK_POINTS)
+        futures.append((chunk, executor.submit(igrf_engine.igrf_value_batch, lats[chunk], longs[chunk], altitudes[chunk], years[chunk],
+                                                 itype=itype, model=model)))
+    collect_chunks(futures, components, deadline)
+    # The engine cannot synthesize years outside the model, whatever it returned for them is not a result
+    coefficients = pyIGRF.loadCoeffs.get_model(model)
+    computed = (years >= coefficients.start) & (years <= coefficients.end)
+    return components, computed
+
+
+def compute_columns(lats, longs, altitudes, years, itype=1, model=None):
+    """
+    Evaluate the IGRF for columns of points, answering repeat points from
+    the result cache. The values match pyIGRF.igrf_value(lat, long, altitude, year)
+    to within the tolerance documented in igrf_engine, or to within the cache
+    quantum for cached points. A failed calculation fails the request, see collect_chunks.
+    :param itype: frame of the points, see coordinate_type. The result cache only holds geodetic points
+    :param model: coefficient model name, see model_name. Cached results are kept apart by model digest
+    :return: declination, inclination, horizontal, north, east, vertical and total intensity (ndarray each)
+    """
+    with STAGE_SECONDS.time(stage="compute"):
+        lats, longs, altitudes, years = (np.asarray(column, dtype=float) for column in (lats, longs, altitudes, years))
+        # A batch larger than the cache would only evict itself, key building and lookups cost more than they save
+        if result_cache is None or not len(lats) or itype != 1 or len(lats) > result_cache.maxsize:
+            return tuple(timed_compute_chunks(lats, longs, altitudes, years, itype, model)[0])
+
+        keys = igrf_cache.quantize(lats, longs, altitudes, years, RESULT_CACHE_QUANTUM, model_namespace(model))
+        found, cached = result_cache.get_many(keys)
+        components = np.empty((len(RESULT_COMPONENTS), len(lats)))
+        if found.any():
+            components[:, found] = cached.T
+            POINTS.inc(int(found.sum()), source="cache")
+        if not found.all():
+            indices = np.nonzero(~found)[0]
+            computed_components, computed = timed_compute_chunks(lats[indices], longs[indices], altitudes[indices], years[indices],
+                                                                 itype, model)
+            components[:, indices] = computed_components
+            result_cache.set_many([keys[index] for index in indices[computed].tolist()], computed_components[:, computed].T)
+        return tuple(components)
+
+
+def compute_columns_tiled(lats, longs, altitudes, years, itype=1, model=None):
+    """
+    compute_columns, answering the points the tile store covers within its
+    error limits by interpolation instead of synthesis.
+    :param itype: frame of the points, see coordinate_type. The tiles only answer geodetic points
+    :param model: coefficient model name, see model_name. The tiles only answer the model they were built from
+    :return: the result components (tuple of ndarray) and whether each point
+             was answered from the tiles (ndarray of bool), None without a tile store
+    """
+    if tile_store is None or not len(lats):
+        return compute_columns(lats, longs, altitudes, years, itype, model), None
+    if itype != 1 or tile_store.meta["coefficients"] != pyIGRF.loadCoeffs.get_model(model).digest:
+        return compute_columns(lats, longs, altitudes, years, itype, model), np.zeros(len(lats), dtype=bool)
+    lats, longs, altitudes, years = (np.asarray(column, dtype=float) for column in (lats, longs, altitudes, years))
+    with STAGE_SECONDS.time(stage="tiles"):
+        tiled, tile_components = tile_store.lookup(lats, longs, altitudes, years)
+    POINTS.inc(int(tiled.sum()), source="tile")
+    if tiled.all():
+        return tuple(tile_components), tiled
+    components = np.empty((len(RESULT_COMPONENTS), len(lats)))
+    components[:, tiled] = tile_components
+    exact = ~tiled
+    components[:, exact] = compute_columns(lats[exact], longs[exact], altitudes[exact], years[exact], itype, model)
+    return tuple(components), tiled
+
+
+async def compute_batch(lats, longs, altitudes, years, key):
+    """
+    Compute the points of one micro-batch of point_batcher off the event loop.
+    :param key: frame and coefficient model name of the points of the batch (tuple)
+    :return: the result components (ndarray, one row per component) and whether each
+             point was answered from the tiles, see compute_columns_tiled
+    """
+    BATCHES.inc()
+    components, tiled = await offload(compute_columns_tiled, lats, longs, altitudes, years, *key)
+    return np.array(components), tiled
+
+
+# Points of concurrent small requests computed together, see igrf_batching for the settings
+point_batcher = igrf_batching.from_env(compute_batch)
+
+
+def point_sources(tiled):
+    """
+    The "source" field of each result: "tile" or "exact" (synthesis)
+    :param tiled: whether each point was answered from the tiles (ndarray of bool), None without a tile store
+    :return: list, or None without a tile store
+    """
+    return None if tiled is None else np.where(tiled, "tile", "exact").tolist()
+
+
+def timed_compute_chunks(lats, longs, altitudes, years, itype=1, model=None):
+    """compute_chunks, counting the computed points and their throughput"""
+    start = time.perf_counter()
+    result = compute_chunks(lats, longs, altitudes, years, itype, model)
+    if len(lats):
+        POINTS.inc(len(lats), source="computed")
+        POINTS_PER_SECOND.set(len(lats) / max(time.perf_counter() - start, 1e-9))
+    return result
+
+
+def format_point_results(lats, longs, altitudes, years, components):
+    """One result dictionary per point from the columns returned by compute_columns"""
+    columns = [column.tolist() for column in components]
+    return [point_result(lat, long, altitude, year, result)
+            for lat, long, altitude, year, result in zip(lats, longs, altitudes, years, zip(*columns))]
+
+
+# Points formatted and encoded together when a ResultBatch is serialized, which bounds the dictionaries alive at once
+ENCODE_CHUNK_POINTS = 10000
+
+
+class ResultBatch:
+    """
+    Results of a batch of points held as arrays: the input columns and result
+    components of the computed points, plus the dictionaries of the other
+    points (rejected or precomputed) by position. Result dictionaries are
+    only built when the batch is iterated or encoded, a chunk at a time, so
+    the peak memory drops for batches larger than ENCODE_CHUNK_POINTS. A
+    smaller batch is one chunk, whose arrays add to its dictionaries.
+    """
+    __slots__ = ("size", "positions", "columns", "components", "fixed", "tiled")
+
+    def __init__(self, size, positions, columns, components, fixed=None, tiled=None):
+        """
+        :param size: number of points (int)
+        :param positions: increasing position of each computed point (ndarray of int)
+        :param columns: latitude, longitude, altitude and year of the computed points (4 ndarrays)
+        :param components: result components of the computed points in RESULT_COMPONENTS order (7 ndarrays)
+        :param fixed: result dictionaries of the other points by position (dict)
+        :param tiled: whether each computed point was answered from the tiles (ndarray of bool),
+                      None without a tile store, in which case the results have no "source" field
+        """
+        self.size = size
+        self.positions = np.asarray(positions, dtype=int)
+        self.columns = [np.asarray(column, dtype=float) for column in columns]
+        self.components = [np.asarray(component, dtype=float) for component in components]
+        self.fixed = fixed or {}
+        self.tiled = tiled
+
+    def __len__(self):
+        return self.size
+
+    def rows(self, start=0, stop=None):
+        """
+        :return: the result dictionaries of positions start to stop (list)
+        """
+        stop = self.size if stop is None else min(stop, self.size)
+        first, last = np.searchsorted(self.positions, [start, stop]).tolist()
+        computed = format_point_results(*(column[first:last].tolist() for column in self.columns),
+                                        [component[first:last] for component in self.components])
+        if self.tiled is not None:
+            for result, source in zip(computed, point_sources(self.tiled[first:last])):
+                result["source"] = source
+        if last - first == stop - start:
+            return computed
+        rows = [self.fixed.get(position) for position in range(start, stop)]
+        for position, result in zip(self.positions[first:last].tolist(), computed):
+            rows[position - start] = result
+        return rows
+
+    def __iter__(self):
+        for start in range(0, self.size, ENCODE_CHUNK_POINTS):
+            yield from self.rows(start, start + ENCODE_CHUNK_POINTS)
+
+    def to_json(self):
+        """
+        :return: the results as a JSON array, the body of a /pyigrf response (bytes)
+        """
+        chunks = (igrf_encoder.dumps(self.rows(start, start + ENCODE_CHUNK_POINTS))[1:-1]
+                  for start in range(0, self.size, ENCODE_CHUNK_POINTS))
+        return b"[" + b",".join(chunks) + b"]"
+
+    def to_ndjson(self):
+        """
+        :return: one JSON result per line (bytes)
+        """
+        return b"".join(igrf_encoder.dumps_lines(self.rows(start, start + ENCODE_CHUNK_POINTS))
+                        for start in range(0, self.size, ENCODE_CHUNK_POINTS))
+
+    def to_columnar(self):
+        """The results as a columnar response, see columnar_result"""
+        if not self.fixed:
+            return columnar_result(self.columns, self.components, sources=point_sources(self.tiled))
+        return columnar_from_points(list(self))
+
+
+def compute_point_results(lats, longs, altitudes, years, itype=1, model=None):
+    """Evaluate the IGRF for columns of points, see ResultBatch"""
+    if not len(lats):
+        return ResultBatch(0, (), (lats, longs, altitudes, years), [()] * len(RESULT_COMPONENTS))
+    components, tiled = compute_columns_tiled(lats, longs, altitudes, years, itype, model)
+    return ResultBatch(len(lats), np.arange(len(lats)), (lats, longs, altitudes, years), components, tiled=tiled)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def float_column(values, field, reasons):
+    """
+    Convert the values of one input field to floats in a single call, only
+    going value by value when that fails. Missing and unreadable values
+    become NaN and their reason is added to reasons.
+    :param values: the field of each point, None where it is missing (list)
+    :param reasons: rejection reason by point position (dict), updated in place
+    :return: ndarray
+    """
+    try:
+        column = np.array(values, dtype=float)
+    except (TypeError, ValueError):
+        column = None
+    if column is None or column.ndim != 1:
+        column = np.array([_to_float(value) for value in values], dtype=float)
+    for index in np.flatnonzero(np.isnan(column)).tolist():
+        value = values[index]
+        reasons.setdefault(index, f"Missing field '{field}'" if value is None else f"Invalid value for {field}: {value!r:.40}")
+    return column
+
+
+def check_range(field, column, reasons):
+    """Add a reason to reasons (dict by position) for every value of column outside the range of field in POINT_RANGES"""
+    low, high, message = POINT_RANGES[field]
+    with np.errstate(invalid="ignore"):
+        outside = np.flatnonzero(~((column >= low) & (column <= high) & np.isfinite(column)))
+    for index in outside.tolist():
+        reasons.setdefault(index, f"{message}, got {column[index]}")
+    return column
+
+
+def check_model_years(years, reasons, model=None):
+    """
+    Add a reason to reasons (dict by position) for every year outside the range of the coefficient model,
+    which may be narrower than the year range of POINT_RANGES
+    :param model: coefficient model name, see model_name
+    """
+    coefficients = pyIGRF.loadCoeffs.get_model(model)
+    with np.errstate(invalid="ignore"):
+        outside = np.flatnonzero(~((years >= coefficients.start) & (years <= coefficients.end)))
+    for index in outside.tolist():
+        reasons.setdefault(index, f"Year must be between {coefficients.start:g} and {coefficients.end:g} "
+                                  f"for model '{coefficients.name}', got {years[index]}")
+    return years
+
+
+def rejected_points(reasons, start_index=0):
+    """
+    The compact list of rejected points, counted in REJECTED_POINTS.
+    :param reasons: rejection reason by point position (dict)
+    :return: {"index", "reason"} dicts in input order (list)
+    """
+    if reasons:
+        REJECTED_POINTS.inc(len(reasons))
+    return [{"index": start_index + index, "reason": reasons[index]} for index in sorted(reasons)]
+
+
+def validate_points(points_data, start_index=0, model=None):
+    """
+    Validate a list of point objects a whole field at a time. Precomputed
+    and rejected points get their results straight away, the others are
+    collected into columns so they can be evaluated in one batch.
+    start_index is the position of the first point in the whole request,
+    used in the list of rejected points. Years are also checked against the
+    range of the coefficient model.
+    :return: the results of the rejected and precomputed points by position
+             (dict), the positions of the points still to compute (ndarray),
+             their latitude, longitude, altitude and year columns (ndarray each),
+             and the rejected points (see rejected_points)
+    """
+    # The first failing check of each point, by position in points_data
+    reasons = {index: "Point must be an object" for index, point in enumerate(points_data) if not isinstance(point, dict)}
+    objects = [point if isinstance(point, dict) else {} for point in points_data] if reasons else points_data
+    columns = [check_range(field, float_column([point.get(field) for point in objects], field, reasons), reasons)
+               for field in POINT_RANGES]
+    check_model_years(columns[3], reasons, model)
+
+    fixed = {}
+    pending = np.ones(len(points_data), dtype=bool)
+    pending[list(reasons)] = False
+
+    # Points that carry declination, horizontal intensity, etc. are echoed back instead of being computed,
+    # testing one field first keeps the scan cheap when there are none
+    for index, point in enumerate(objects):
+        if PRECOMPUTED_FIELDS[0] in point and index not in reasons and all(key in point for key in PRECOMPUTED_FIELDS):
+            pending[index] = False
+            try:
+                fixed[index] = {
+                    "latitude": columns[0][index].item(),
+                    "longitude": columns[1][index].item(),
+                    "altitude": columns[2][index].item(),
+                    "year": columns[3][index].item(),
+                    "declination": float(point["declination"]),
+                    "horizontal_intensity": float(point["horizontal intensity"]),
+                    "inclination": float(point["inclination"]),
+                    "total_intensity": float(point["total intensity"]),
+                    "vertical_intensity": float(point["vertical intensity"])
+                }
+            except (TypeError, ValueError) as e:
+                reasons[index] = f"Invalid precomputed value: {str(e)}"
+
+    for index, reason in reasons.items():
+        fixed[index] = rejected_result(*(column[index].item() for column in columns), reason)
+    if not fixed:
+        return fixed, np.arange(len(points_data)), tuple(columns), []
+    batch_positions = np.flatnonzero(pending)
+    return fixed, batch_positions, tuple(column[batch_positions] for column in columns), rejected_points(reasons, start_index)
+
+
+def evaluate_points(points_data, start_index=0, itype=1, model=None):
+    """
+    Validate a list of point objects and evaluate the valid ones in one batch.
+    :param itype: frame of the points, see coordinate_type
+    :param model: coefficient model name, see model_name
+    :return: the results in input order (ResultBatch), see validate_points
+    """
+    with STAGE_SECONDS.time(stage="validate"):
+        fixed, positions, columns, _ = validate_points(points_data, start_index, model)
+    # Evaluate all valid points at once with the vectorized engine
+    results = compute_point_results(*columns, itype, model)
+    return ResultBatch(len(points_data), positions, columns, results.components, fixed, results.tiled)
+
+
+# Columnar (struct-of-arrays) request and response format
+POINT_COLUMNS = ["latitude", "longitude", "altitude", "year"]
+RESULT_COMPONENTS = ["declination", "inclination", "horizontal_intensity", "north_component",
+                     "east_component", "vertical_component", "total_intensity"]
+# Content type of the raw little-endian float64 columnar format
+BINARY_MEDIA_TYPE = "application/octet-stream"
+
+
+def is_columnar(data):
+    """True if the parsed request holds parallel arrays instead of point objects"""
+    return isinstance(data, dict) and isinstance(data.get("latitude"), list)
+
+
+def wants_columnar(request: Request):
+    """True if the caller asked for a columnar response with ?format=columnar"""
+    return request.query_params.get("format", "").lower() == "columnar"
+
+
+# Frames of the input points selected with ?coordinates=, as the itype of igrf12syn
+COORDINATE_TYPES = {"geodetic": 1, "geocentric": 2}
+
+
+def coordinate_type(request: Request):
+    """
+    The frame of the points of a request. Geodetic points (the default) have
+    a WGS84 latitude and an altitude above the spheroid. With
+    ?coordinates=geocentric they have a geocentric latitude and an altitude
+    above the reference sphere of radius igrf_engine.RE, and the components
+    are geocentric too.
+    :return: itype for igrf_engine (int)
+    """
+    name = request.query_params.get("coordinates", "geodetic").lower()
+    if name not in COORDINATE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid coordinates {name!r}, expected one of {', '.join(COORDINATE_TYPES)}")
+    return COORDINATE_TYPES[name]
+
+
+def geodetic_only(request: Request):
+    """Refuse ?coordinates=geocentric on the endpoints that only take geodetic points, rather than ignore it"""
+    if coordinate_type(request) != COORDINATE_TYPES["geodetic"]:
+        raise HTTPException(status_code=400, detail="Geocentric coordinates are not supported on this endpoint, its points are geodetic")
+
+
+def model_name(request: Request):
+    """
+    The coefficient model of a request, chosen by name with ?model= (see
+    GET /pyigrf/models). Without it the default model is used.
+    :return: model name, None for the default model (str)
+    """
+    name = request.query_params.get("model")
+    if name is None:
+        return None
+    if not name:
+        raise HTTPException(status_code=400, detail="Empty model name")
+    try:
+        pyIGRF.loadCoeffs.get_model(name)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+    return name
+
+
+def default_model_only(request: Request):
+    """Refuse ?model= on the endpoints that always compute with the default model, rather than ignore it"""
+    if "model" in request.query_params:
+        raise HTTPException(status_code=400, detail="Model selection is not supported on this endpoint, it uses the default model")
+
+
+def model_namespace(model=None):
+    """:return: result cache namespace of a coefficient model, from its digest so a reloaded file gets a new one (int)"""
+    return int(pyIGRF.loadCoeffs.get_model(model).digest[:15], 16)
+
+
+def parse_columnar(data):
+    """
+    Convert a columnar JSON object into float arrays. Values may be numbers or stringified numbers.
+    :return: latitude, longitude, altitude, year (ndarray each)
+    """
+    try:
+        columns = [np.asarray(data[column], dtype=float) for column in POINT_COLUMNS]
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Missing column in columnar request: {str(e)}")
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid value in columnar request: {str(e)}")
+    if any(column.ndim != 1 or len(column) != len(columns[0]) for column in columns):
+        raise HTTPException(status_code=400, detail=f"Columns {', '.join(POINT_COLUMNS)} must be flat arrays of the same length")
+    return columns
+
+
+# Largest body read in one piece (1000MB), use the NDJSON mode for larger uploads
+MAX_REQUEST_SIZE = 1000 * 1024 * 1024
+# Largest number of points in one request
+MAX_POINTS = 1000000
+
+
+def check_request_size(body):
+    """Refuse a body larger than MAX_REQUEST_SIZE with 413"""
+    if len(body) > MAX_REQUEST_SIZE:
+        raise HTTPException(status_code=413, detail=f"Request too large. Maximum size is {MAX_REQUEST_SIZE/1024/1024}MB")
+
+
+def parse_binary(body):
+    """
+    Convert a raw little-endian float64 body into arrays. The body holds the
+    latitude, longitude, altitude and year columns one after the other.
+    The size limits are checked before the body is mapped.
+    :return: latitude, longitude, altitude, year (ndarray each)
+    """
+    check_request_size(body)
+    if len(body) // (8 * len(POINT_COLUMNS)) > MAX_POINTS:
+        raise HTTPException(status_code=413, detail=f"Too many points. Maximum is {MAX_POINTS}")
+    if len(body) % (8 * len(POINT_COLUMNS)):
+        raise HTTPException(status_code=400, detail=f"Binary body must hold {len(POINT_COLUMNS)} float64 columns of equal length")
+    return list(np.frombuffer(body, dtype="<f8").reshape(len(POINT_COLUMNS), -1))
+
+
+def column_reasons(lats, longs, altitudes, years, model=None):
+    """
+    Range-check columns of points, the years also against the range of the coefficient model.
+    :return: rejection reason by position (dict)
+    """
+    reasons = {}
+    for field, column in zip(POINT_RANGES, (lats, longs, altitudes, years)):
+        check_range(field, column, reasons)
+    check_model_years(years, reasons, model)
+    return reasons
+
+
+def evaluate_columns(lats, longs, altitudes, years, use_tiles=True, itype=1, model=None):
+    """
+    Range-check and evaluate columns of points. Points outside the accepted
+    ranges are not computed, their components are NaN.
+    :param use_tiles: answer points from the tile store when there is one (bool)
+    :param itype: frame of the points, see coordinate_type
+    :param model: coefficient model name, see model_name
+    :return: list of result components in RESULT_COMPONENTS order (ndarray each),
+             the rejected points (see rejected_points) and the source of each
+             result (see point_sources, None for the rejected points)
+    """
+    with STAGE_SECONDS.time(stage="validate"):
+        reasons = column_reasons(lats, longs, altitudes, years, model)
+        valid = np.ones(len(lats), dtype=bool)
+        valid[list(reasons)] = False
+        rejected = rejected_points(reasons)
+    components = np.full((len(RESULT_COMPONENTS), len(lats)), np.nan)
+    tiled = np.zeros(len(lats), dtype=bool) if use_tiles and tile_store is not None else None
+    if valid.any():
+        columns = (lats, longs, altitudes, years) if valid.all() else (lats[valid], longs[valid], altitudes[valid], years[valid])
+        if tiled is None:
+            components[:, valid] = compute_columns(*columns, itype, model)
+        else:
+            components[:, valid], tiled[valid] = compute_columns_tiled(*columns, itype, model)
+    sources = point_sources(tiled)
+    if sources is not None:
+        for index in reasons:
+            sources[index] = None
+    return list(components), rejected, sources
+
+
+def json_column(values):
+    """A float column for json_response, with null in place of NaN"""
+    values = np.asarray(values, dtype=float)
+    missing = np.isnan(values)
+    if not missing.any():
+        # Arrays are encoded directly by json_response
+        return values
+    values = values.astype(object)
+    values[missing] = None
+    return values.tolist()
+
+
+def columnar_result(columns, components, rejected=(), sources=None):
+    """
+    Columnar response with the same field names as point_result. Rejected
+    points have null components and are listed under "rejected". With a
+    tile store, the "source" column says how each point was answered.
+    """
+    fields = dict(zip(POINT_COLUMNS, columns))
+    fields.update(zip(RESULT_COMPONENTS, components))
+    result = {field: json_column(values) for field, values in fields.items()}
+    if sources is not None:
+        result["source"] = sources
+    if rejected:
+        result["rejected"] = rejected
+    return result
+
+
+def columnar_from_points(results):
+    """Turn a list of result dictionaries into a columnar response, listing rejected points as columnar_result does"""
+    fields = []
+    for result in results:
+        for field in result:
+            if field not in fields and field != "error":
+                fields.append(field)
+    columnar = {field: [result.get(field) for result in results] for field in fields}
+    rejected = [{"index": index, "reason": result["error"]} for index, result in enumerate(results) if "error" in result]
+    if rejected:
+        columnar["rejected"] = rejected
+    return columnar
+
+
+def binary_result(components):
+    """Raw little-endian float64 response holding the result components one after the other"""
+    with STAGE_SECONDS.time(stage="serialize"):
+        return Response(
+            content=np.ascontiguousarray(components, dtype="<f8").tobytes(),
+            media_type=BINARY_MEDIA_TYPE,
+            headers={"X-IGRF-Columns": ",".join(RESULT_COMPONENTS)},
+        )
+
+
+async def read_body(request: Request):
+    """The whole request body, timed as the read stage"""
+    with STAGE_SECONDS.time(stage="read"):
+        return await request.body()
+
+
+# JSON responses of at least this many bytes are gzip-compressed for clients that accept it, 0 disables compression
+GZIP_MIN_BYTES = int(os.environ.get("IGRF_GZIP_MIN_BYTES", 1024 * 1024))
+# Level 1 compresses result lists about 7 times, at a third of the time of the default level 6
+GZIP_LEVEL = int(os.environ.get("IGRF_GZIP_LEVEL", 1))
+
+
+def json_response(content, accept_encoding=""):
+    """
+    JSON response encoded straight away with igrf_encoder, so the caller
+    decides which thread pays for it. content may be a ResultBatch. Large bodies are gzip-compressed when
+    accept_encoding (the Accept-Encoding header) allows it.
+    """
+    with STAGE_SECONDS.time(stage="serialize"):
+        body = content.to_json() if isinstance(content, ResultBatch) else igrf_encoder.dumps(content)
+        headers = {}
+        if GZIP_MIN_BYTES and len(body) >= GZIP_MIN_BYTES and igrf_encoder.accepts_gzip(accept_encoding):
+            body = igrf_encoder.gzip(body, GZIP_LEVEL)
+            headers = {"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+        return Response(content=body, media_type=igrf_encoder.MEDIA_TYPE, headers=headers)
+
+
+# Maximum number of points in one regular grid request
+MAX_GRID_POINTS = int(os.environ.get("IGRF_MAX_GRID_POINTS", 5000000))
+
+
+def grid_count(start, stop, spacing):
+    """Number of grid values from start up to and including stop when it falls on the spacing"""
+    return int(np.floor((stop - start) / spacing + 1e-9)) + 1
+
+
+def grid_axis(start, stop, spacing):
+    """Evenly spaced grid values, see grid_count"""
+    return start + spacing * np.arange(grid_count(start, stop, spacing))
+
+
+def parse_grid(grid: GridRequest, model=None):
+    """
+    Range-check a grid request and build its axes.
+    :param model: coefficient model name, see model_name
+    :return: latitude of each row, longitude of each column (ndarray each)
+    """
+    if not -90 <= grid.min_latitude <= grid.max_latitude <= 90:
+        raise HTTPException(status_code=400, detail=f"Latitudes must satisfy -90 <= min_latitude <= max_latitude <= 90, got {grid.min_latitude} and {grid.max_latitude}")
+    if not -180 <= grid.min_longitude <= grid.max_longitude <= 180:
+        raise HTTPException(status_code=400, detail=f"Longitudes must satisfy -180 <= min_longitude <= max_longitude <= 180, got {grid.min_longitude} and {grid.max_longitude}")
+    if not grid.spacing > 0:
+        raise HTTPException(status_code=400, detail=f"Spacing must be positive, got {grid.spacing}")
+    if grid.altitude < 0:
+        raise HTTPException(status_code=400, detail=f"Altitude must be non-negative, got {grid.altitude}")
+    if not 1900 <= grid.year <= 2030:
+        raise HTTPException(status_code=400, detail=f"Year must be between 1900 and 2030, got {grid.year}")
+    reasons = {}
+    check_model_years(np.array([grid.year]), reasons, model)
+    if reasons:
+        raise HTTPException(status_code=400, detail=reasons[0])
+
+    if (grid_count(grid.min_latitude, grid.max_latitude, grid.spacing)
+            * grid_count(grid.min_longitude, grid.max_longitude, grid.spacing)) > MAX_GRID_POINTS:
+        raise HTTPException(status_code=413, detail=f"Too many grid points. Maximum is {MAX_GRID_POINTS}")
+    return (grid_axis(grid.min_latitude, grid.max_latitude, grid.spacing),
+            grid_axis(grid.min_longitude, grid.max_longitude, grid.spacing))
+
+
+def compute_grid(lats, longs, altitude, year, model=None):
+    """
+    Evaluate the IGRF on a regular grid on the shared worker pool, one block
+    of latitude rows per task. A block that fails or times out fails the
+    request, as in compute_chunks.
+    :param model: coefficient model name, see model_name
+    :return: result components in RESULT_COMPONENTS order, each of shape (len(lats), len(longs)) (ndarray)
+    """
+    start_time = time.perf_counter()
+    components = np.empty((len(RESULT_COMPONENTS), len(lats), len(longs)))
+    rows_per_chunk = max(1, CHUNK_POINTS // max(1, len(longs)))
+    executor = executor_for(len(lats) * len(longs))
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+    futures = []
+    for start in range(0, len(lats), rows_per_chunk):
+        chunk = slice(start, start + rows_per_chunk)
+        futures.append((chunk, executor.submit(igrf_engine.igrf_value_grid, lats[chunk], longs, altitude, year, model)))
+
+    collect_chunks(futures, components, deadline)
+    elapsed = time.perf_counter() - start_time
+    STAGE_SECONDS.observe(elapsed, stage="compute")
+    POINTS.inc(components[0].size, source="computed")
+    POINTS_PER_SECOND.set(components[0].size / max(elapsed, 1e-9))
+    return components
+
+
+def grid_result(lats, longs, grid: GridRequest, components, accept_encoding=""):
+    """JSON response of the grid endpoint, with one row per latitude in every result field"""
+    result = {"latitude": lats, "longitude": longs, "altitude": grid.altitude, "year": grid.year}
+    result.update(zip(RESULT_COMPONENTS, components))
+    return json_response(result, accept_encoding)
+
+
+# Maximum number of start points in one field-line trace request
+MAX_TRACE_POINTS = int(os.environ.get("IGRF_MAX_TRACE_POINTS", 10000))
+
+
+def parse_trace(trace: TraceRequest):
+    """
+    Check the settings of a trace request and range-check its start points
+    as validate_points does.
+    :return: latitude, longitude, altitude columns (ndarray each) and the rejection reason by position (dict)
+    """
+    if len(trace.points) > MAX_TRACE_POINTS:
+        raise HTTPException(status_code=413, detail=f"Too many start points. Maximum is {MAX_TRACE_POINTS}")
+    if trace.direction not in igrf_trace.DIRECTIONS:
+        raise HTTPException(status_code=400, detail=f"Direction must be one of {', '.join(igrf_trace.DIRECTIONS)}, got {trace.direction}")
+    if not 1900 <= trace.year <= 2030:
+        raise HTTPException(status_code=400, detail=f"Year must be between 1900 and 2030, got {trace.year}")
+    year_reasons = {}
+    check_model_years(np.array([trace.year]), year_reasons)
+    if year_reasons:
+        raise HTTPException(status_code=400, detail=year_reasons[0])
+    if not trace.tolerance > 0:
+        raise HTTPException(status_code=400, detail=f"Tolerance must be positive, got {trace.tolerance}")
+    if not 0 < trace.max_steps <= 100000:
+        raise HTTPException(status_code=400, detail=f"max_steps must be between 1 and 100000, got {trace.max_steps}")
+    if not trace.stop_altitude >= 0:
+        raise HTTPException(status_code=400, detail=f"Stop altitude must be non-negative, got {trace.stop_altitude}")
+    if not trace.max_radius > 1:
+        raise HTTPException(status_code=400, detail=f"max_radius must be more than 1 Earth radius, got {trace.max_radius}")
+
+    reasons = {}
+    columns = [check_range(field, np.array([getattr(point, field) for point in trace.points], dtype=float), reasons)
+               for field in ("latitude", "longitude", "altitude")]
+    return columns, reasons
+
+
+def compute_trace(trace: TraceRequest, accept_encoding=""):
+    """Trace the field lines of a /pyigrf/trace request and build its JSON response, one result per start point"""
+    (lats, longs, altitudes), reasons = parse_trace(trace)
+    results = [None] * len(lats)
+    for rejected in rejected_points(reasons):
+        position = rejected["index"]
+        results[position] = rejected_result(lats[position].item(), longs[position].item(), altitudes[position].item(),
+                                            trace.year, rejected["reason"])
+    positions = [position for position, result in enumerate(results) if result is None]
+    if not positions:
+        return json_response(results, accept_encoding)
+
+    with STAGE_SECONDS.time(stage="trace"):
+        traced = igrf_trace.trace_field_lines(
+            lats[positions], longs[positions], altitudes[positions], trace.year, direction=trace.direction,
+            stop_altitude=trace.stop_altitude, max_radius=trace.max_radius * igrf_engine.RE,
+            tolerance=trace.tolerance, max_steps=trace.max_steps, include_path=trace.include_path)
+
+    columns = {field: values.tolist() for field, values in traced.items() if field != "path"}
+    for line, position in enumerate(positions):
+        results[position] = {
+            "latitude": lats[position].item(),
+            "longitude": longs[position].item(),
+            "altitude": altitudes[position].item(),
+            "year": trace.year,
+            "status": igrf_trace.STATUSES[columns["status"][line]],
+            "end_latitude": columns["end_latitude"][line],
+            "end_longitude": columns["end_longitude"][line],
+            "end_altitude": columns["end_altitude"][line],
+            "length": columns["length"][line],  # km along the field line
+            "max_altitude": columns["max_altitude"][line],
+            "steps": columns["steps"][line],
+        }
+        if trace.include_path:
+            results[position]["path"] = dict(zip(("latitude", "longitude", "altitude"), traced["path"][line]))
+    return json_response(results, accept_encoding)
+
+
+# Maximum number of epochs in one time series request
+MAX_TIMESERIES_YEARS = int(os.environ.get("IGRF_MAX_TIMESERIES_YEARS", 100000))
+# Rate of change fields of a time series, in RESULT_COMPONENTS order
+RATE_COMPONENTS = [f"{component}_rate" for component in RESULT_COMPONENTS]
+
+
+def parse_timeseries(series: TimeSeriesRequest, model=None):
+    """
+    Range-check the location of a time series request and build its epochs,
+    either the given years or start_year to end_year every step years.
+    :param model: coefficient model name, see model_name
+    :return: years (ndarray) and the rejection reason of each year outside the model range by position (dict)
+    """
+    reasons = {}
+    for field in ("latitude", "longitude", "altitude"):
+        check_range(field, np.array([getattr(series, field)]), reasons)
+        if reasons:
+            raise HTTPException(status_code=400, detail=reasons[0])
+
+    if series.years is not None:
+        years = np.array(series.years, dtype=float)
+    elif series.start_year is not None and series.end_year is not None:
+        if not series.step > 0 or series.end_year < series.start_year:
+            raise HTTPException(status_code=400, detail=f"Years must satisfy start_year <= end_year with a positive step, got {series.start_year}, {series.end_year} and {series.step}")
+        if grid_count(series.start_year, series.end_year, series.step) > MAX_TIMESERIES_YEARS:
+            raise HTTPException(status_code=413, detail=f"Too many years. Maximum is {MAX_TIMESERIES_YEARS}")
+        years = grid_axis(series.start_year, series.end_year, series.step)
+    else:
+        raise HTTPException(status_code=400, detail="Give either years or start_year and end_year")
+    if len(years) > MAX_TIMESERIES_YEARS:
+        raise HTTPException(status_code=413, detail=f"Too many years. Maximum is {MAX_TIMESERIES_YEARS}")
+    check_range("year", years, reasons)
+    check_model_years(years, reasons, model)
+    return years, reasons
+
+
+def compute_timeseries(series: TimeSeriesRequest, accept_encoding="", model=None):
+    """
+    Evaluate one location at every epoch of a /pyigrf/timeseries request.
+    The response is columnar, with a rate of change column per result field;
+    years outside the model range have null values and are listed under "rejected".
+    :param model: coefficient model name, see model_name
+    """
+    years, reasons = parse_timeseries(series, model)
+    rejected = rejected_points(reasons)
+    valid = np.ones(len(years), dtype=bool)
+    valid[list(reasons)] = False
+    values = np.full((len(RESULT_COMPONENTS) + len(RATE_COMPONENTS), len(years)), np.nan)
+    with STAGE_SECONDS.time(stage="compute"):
+        if valid.any():
+            values[:, valid] = igrf_engine.igrf_value_series(series.latitude, series.longitude, series.altitude,
+                                                             years[valid], model)
+    POINTS.inc(int(valid.sum()), source="computed")
+
+    result = {"latitude": series.latitude, "longitude": series.longitude, "altitude": series.altitude,
+              "year": json_column(years)}
+    result.update((field, json_column(column)) for field, column in zip(RESULT_COMPONENTS + RATE_COMPONENTS, values))
+    if rejected:
+        result["rejected"] = rejected
+    return json_response(result, accept_encoding)
+
+
+def compute_job_chunk(lats, longs, altitudes, years):
+    """
+    Evaluate one chunk of a job for the JobRunner. Unlike compute_columns
+    there is no request deadline: an error propagates,
+    so the chunk stays leased and is computed again once its lease expires.
+    :return: the 7 result components (tuple of ndarray)
+    """
+    start = time.perf_counter()
+    with STAGE_SECONDS.time(stage="compute"):
+        components = igrf_engine.igrf_value_batch(lats, longs, altitudes, years)
+    if len(lats):
+        POINTS.inc(len(lats), source="computed")
+        POINTS_PER_SECOND.set(len(lats) / max(time.perf_counter() - start, 1e-9))
+    return components
+
+
+# Surveys computed in the background and fetched in pages, see igrf_jobs for the settings
+job_store = igrf_jobs.from_env()
+job_runner = igrf_jobs.JobRunner(job_store, compute_job_chunk, workers=int(os.environ.get("IGRF_JOB_WORKERS", 1))) if job_store is not None else None
+# Maximum number of points in one job, and in one page of its results
+MAX_JOB_POINTS = int(os.environ.get("IGRF_MAX_JOB_POINTS", 10000000))
+MAX_JOB_PAGE_POINTS = int(os.environ.get("IGRF_MAX_JOB_PAGE_POINTS", 100000))
+
+
+def require_job_store():
+    if job_store is None:
+        raise HTTPException(status_code=404, detail="Jobs are disabled on this server")
+    return job_store
+
+
+def submit_job(body, accept_encoding=""):
+    """
+    Parse and validate a /pyigrf/jobs body, which takes every format of POST /pyigrf,
+    and queue its valid points. Rejected and precomputed points get their results straight away.
+    """
+    store = require_job_store()
+    try:
+        with STAGE_SECONDS.time(stage="parse"):
+            points_data = igrf_parser.parse_points(body)
+    except igrf_parser.PointsParseError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if is_columnar(points_data):
+        columns = parse_columnar(points_data)
+        count = len(columns[0])
+    else:
+        count = len(points_data)
+    if count > MAX_JOB_POINTS:
+        raise HTTPException(status_code=413, detail=f"Too many points. Maximum is {MAX_JOB_POINTS}")
+
+    with STAGE_SECONDS.time(stage="validate"):
+        if is_columnar(points_data):
+            reasons = column_reasons(*columns)
+            values = [column.tolist() for column in columns]
+            fixed = {rejected["index"]: rejected_result(*(column[rejected["index"]] for column in values), rejected["reason"])
+                     for rejected in rejected_points(reasons)}
+            positions = np.array([position for position in range(count) if position not in reasons], dtype=int)
+            columns = np.array(columns)[:, positions]
+        else:
+            fixed, positions, columns, _ = validate_points(points_data)
+    job = store.submit(count, positions, columns, fixed)
+    logger.debug(f"Queued job {job} with {count} points")
+    response = json_response(store.status(job), accept_encoding)
+    response.status_code = 202
+    return response
+
+
+def job_results(job, offset, limit, columnar_response=False, accept_encoding=""):
+    """One page of the results of a job, in the format of POST /pyigrf"""
+    store = require_job_store()
+    if offset < 0 or not 0 < limit <= MAX_JOB_PAGE_POINTS:
+        raise HTTPException(status_code=400, detail=f"offset must be non-negative and limit between 1 and {MAX_JOB_PAGE_POINTS}")
+    status = store.status(job)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"No job {job}")
+    if offset > status["points"]:
+        raise HTTPException(status_code=400, detail=f"offset must be at most the {status['points']} points of the job, got {offset}")
+    end = min(offset + limit, status["points"])
+    try:
+        page = store.results(job, offset, end - offset)
+    except igrf_jobs.JobNotReady as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if page is None:
+        raise HTTPException(status_code=404, detail=f"No job {job}")
+
+    fixed, chunks = page
+    in_page = [(positions >= offset) & (positions < end) for positions, _, _ in chunks]
+    results = ResultBatch(
+        end - offset,
+        np.concatenate([positions[mask] - offset for (positions, _, _), mask in zip(chunks, in_page)] or [[]]),
+        np.concatenate([columns[:, mask] for (_, columns, _), mask in zip(chunks, in_page)] or [np.empty((4, 0))], axis=1),
+        np.concatenate([components[:, mask] for (_, _, components), mask in zip(chunks, in_page)] or [np.empty((7, 0))], axis=1),
+        {position - offset: result for position, result in fixed.items()})
+    page = {"id": job, "offset": offset, "next_offset": end if end < status["points"] else None,
+            "results": results.to_columnar() if columnar_response else list(results)}
+    return json_response(page, accept_encoding)
+
+
+# Content types that select the streaming NDJSON mode of POST /pyigrf
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonlines")
+# Number of streamed points evaluated together, which bounds the memory used by a streamed request
+STREAM_BATCH_POINTS = int(os.environ.get("IGRF_STREAM_BATCH_POINTS", 10000))
+# Streamed results are kept in memory up to this size and spill to a temporary file beyond it
+STREAM_SPOOL_BYTES = int(os.environ.get("IGRF_STREAM_SPOOL_BYTES", 16 * 1024 * 1024))
+STREAM_READ_BYTES = 64 * 1024
+# Longest accepted line of a streamed body, a point object takes about 100 bytes
+STREAM_LINE_BYTES = int(os.environ.get("IGRF_STREAM_LINE_BYTES", 1024 * 1024))
+
+
+async def spool_point_results(request: Request, itype=1, model=None):
+    """
+    Parse newline-delimited point objects as they arrive and write one NDJSON
+    result line per point to a spooled temporary file, evaluating
+    STREAM_BATCH_POINTS at a time.
+    Results are spooled rather than sent while the body is still arriving
+    because most HTTP/1.1 clients only read the response after they have
+    sent the whole request, so writing back early would deadlock on large uploads.
+    A line longer than STREAM_LINE_BYTES is refused with 413.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_BYTES)
+
+    def flush(batch, start_index):
+        spool.write(evaluate_points(batch, start_index, itype, model).to_ndjson())
+
+    def check_line(size):
+        if size > STREAM_LINE_BYTES:
+            raise HTTPException(status_code=413, detail=f"Line too long. Maximum is {STREAM_LINE_BYTES} bytes")
+
+    # Pieces of the unfinished last line, only the new chunk is searched for line ends
+    pending = []
+    pending_bytes = 0
+    batch = []
+    count = 0
+    try:
+        async for chunk in request.stream():
+            lines = chunk.split(b"\n")
+            if len(lines) == 1:
+                pending.append(chunk)
+                pending_bytes += len(chunk)
+                check_line(pending_bytes)
+                continue
+            lines[0] = b"".join(pending + [lines[0]])
+            pending = [lines.pop()]
+            pending_bytes = len(pending[0])
+            check_line(max(pending_bytes, *(len(line) for line in lines)))
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(igrf_parser.loads(line))
+                except ValueError:
+                    # Reported like any other invalid point
+                    batch.append(None)
+                if len(batch) >= STREAM_BATCH_POINTS:
+                    await offload(flush, batch, count)
+                    count += len(batch)
+                    batch = []
+
+        last = b"".join(pending)
+        if last.strip():
+            try:
+                batch.append(igrf_parser.loads(last))
+            except ValueError:
+                batch.append(None)
+        if batch:
+            await offload(flush, batch, count)
+            count += len(batch)
+    except BaseException:
+        spool.close()
+        raise
+    logger.debug(f"Streaming {count} results")
+    spool.seek(0)
+    return spool
+
+
+def iter_spool(spool):
+    """Read a spooled result file back in chunks and close it when done"""
+    try:
+        while True:
+            chunk = spool.read(STREAM_READ_BYTES)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        spool.close()
+
+
+def process_points_body(body, columnar_response=False, accept_encoding="", itype=1, model=None):
+    """Parse a /pyigrf body and evaluate its points, see compute_pyigrf"""
+    # Detect the body format and parse it in a single pass
+    try:
+        with STAGE_SECONDS.time(stage="parse"):
+            points_data = igrf_parser.parse_points(body)
+    except igrf_parser.PointsParseError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Parallel arrays are evaluated as columns and answered in the same format
+    if is_columnar(points_data):
+        columns = parse_columnar(points_data)
+        if len(columns[0]) > MAX_POINTS:
+            raise HTTPException(status_code=413, detail=f"Too many points. Maximum is {MAX_POINTS}")
+        logger.debug(f"Processing {len(columns[0])} columnar points")
+        components, rejected, sources = evaluate_columns(*columns, True, itype, model)
+        return json_response(columnar_result(columns, components, rejected, sources), accept_encoding)
+
+    # Check if there are too many points
+    if len(points_data) > MAX_POINTS:
+        raise HTTPException(status_code=413, detail=f"Too many points. Maximum is {MAX_POINTS}")
+
+    logger.debug(f"Processing {len(points_data)} points")
+    results = evaluate_points(points_data, 0, itype, model)
+    # The results hold no reference to the parsed point objects, free them before encoding
+    del points_data
+
+    logger.debug(f"Returning {len(results)} results")
+    if columnar_response:
+        return json_response(results.to_columnar(), accept_encoding)
+    return json_response(results, accept_encoding)
+
+
+async def batched_points_body(body, columnar_response=False, accept_encoding="", itype=1, model=None):
+    """
+    process_points_body for the small bodies point_batcher takes. They are
+    parsed and validated on the event loop and their points computed in one
+    micro-batch with those of concurrent requests.
+    :return: the response, or None for a columnar body, which process_points_body evaluates
+    """
+    try:
+        with STAGE_SECONDS.time(stage="parse"):
+            points_data = igrf_parser.parse_points(body)
+    except igrf_parser.PointsParseError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if is_columnar(points_data):
+        return None
+
+    with STAGE_SECONDS.time(stage="validate"):
+        fixed, positions, columns, _ = validate_points(points_data, 0, model)
+    components, tiled = [()] * len(RESULT_COMPONENTS), None
+    if len(positions):
+        BATCHED_REQUESTS.inc()
+        components, tiled = await point_batcher.submit(columns, (itype, model))
+    results = ResultBatch(len(points_data), positions, columns, components, fixed, tiled)
+    if columnar_response:
+        return json_response(results.to_columnar(), accept_encoding)
+    return json_response(results, accept_encoding)
+
+
+def process_model_points(points_json, columnar_response=False, accept_encoding=""):
+    """Parse the stringified points of a /pyigrf/model request and evaluate them"""
+    # Parse the stringified JSON to get the points array
+    try:
+        # First, check if the input is already a JSON string or if it needs to be parsed
+        try:
+            # Try to parse the input as a JSON string
+            with STAGE_SECONDS.time(stage="parse"):
+                parsed_data = json.loads(points_json)
+
+            # Check if the parsed data has a "points_json" field
+            if "points_json" in parsed_data:
+                points_data = parsed_data["points_json"]
+            else:
+                # If not, assume the parsed data is the array of points directly
+                points_data = parsed_data
+        except json.JSONDecodeError:
+            # If the input is not valid JSON, raise an error
+            raise HTTPException(status_code=400, detail="Invalid JSON format")
+
+        # Parallel arrays are evaluated as columns and answered in the same format
+        if is_columnar(points_data):
+            columns = parse_columnar(points_data)
+            if len(columns[0]) > MAX_POINTS:
+                raise HTTPException(status_code=413, detail=f"Too many points. Maximum is {MAX_POINTS}")
+            components, rejected, sources = evaluate_columns(*columns)
+            return json_response(columnar_result(columns, components, rejected, sources), accept_encoding)
+
+        if not isinstance(points_data, list):
+            raise HTTPException(status_code=400, detail="points_json must hold a list of points or parallel arrays")
+        if len(points_data) > MAX_POINTS:
+            raise HTTPException(status_code=413, detail=f"Too many points. Maximum is {MAX_POINTS}")
+        # Checked like the points of /pyigrf, invalid points come back with the reason they were rejected
+        results = evaluate_points(points_data)
+        if columnar_response:
+            return json_response(results.to_columnar(), accept_encoding)
+        return json_response(results, accept_encoding)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON format")
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid point format. Each point should be an object with 'latitude', 'longitude', 'altitude', and 'year' fields. Error: {str(e)}")
+
+
+@app.on_event("startup")
+def start_job_runner():
+    # Picks up the chunks left by a previous run once their lease expires
+    if job_runner is not None:
+        job_runner.start()
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    if job_runner is not None:
+        job_runner.stop(timeout=5)
+    igrf_executor.shutdown(wait=False, cancel_futures=True)
+    if igrf_process_pool is not None:
+        igrf_process_pool.shutdown(wait=False, cancel_futures=True)
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
@@ -115,335 +1390,179 @@ async def get_point(point_id: int)->DataPoint:
 async def get_pyigrf():
     return pyIGRF.igrf_value(300,300,500,2024.9)
 
-@app.post("/pyigrf")
-async def compute_pyigrf(request: Request):
-    # Set a maximum request size (10MB)
-    MAX_REQUEST_SIZE = 1000 * 1024 * 1024  # 10MB in bytes
+@app.get("/pyigrf/cache")
+async def get_pyigrf_cache():
+    # Hit/miss counters of the per-epoch coefficient and kernel caches and of the result cache
+    return {"coefficients": pyIGRF.loadCoeffs.coeffs_cache_info(),
+            "kernels": igrf_engine.kernel_cache_info(),
+            "results": result_cache.info() if result_cache is not None else None}
 
-    try:
-        # Get the raw request body with size limit
-        body = await request.body()
-        if len(body) > MAX_REQUEST_SIZE:
-            return HTTPException(status_code=413, detail=f"Request too large. Maximum size is {MAX_REQUEST_SIZE/1024/1024}MB")
 
-        body_str = body.decode('utf-8')
-        # Log only the first 200 chars of the request body to avoid excessive logging
-        log_body = body_str[:200] + "..." if len(body_str) > 200 else body_str
-        print(f"Request received, size: {len(body_str)} bytes")
+@app.get("/pyigrf/models")
+async def get_pyigrf_models():
+    # The coefficient models a request can choose with ?model=, the default one first
+    registry = pyIGRF.loadCoeffs.registry()
+    default = registry.get()
+    return {"default": default.name,
+            "models": [default.info()] + [model.info() for name, model in sorted(registry.models.items()) if model is not default]}
 
-        # Set a maximum number of points to process
-        MAX_POINTS = 1000000
-        points_data = None
 
-        # Try to parse the body as JSON with minimal logging
-        try:
-            # If the body is a JSON object, parse it
-            data = json.loads(body_str)
-            print("Data: ", data)
+@app.post("/pyigrf/models/reload")
+async def reload_pyigrf_models():
+    # Load new and changed coefficient files now, instead of at the next periodic check.
+    # Worker processes pick them up on their own next check or when a request names a model they do not know yet
+    loaded = await offload(pyIGRF.loadCoeffs.registry().reload)
+    return {"loaded": loaded, "models": sorted(pyIGRF.loadCoeffs.registry().models)}
 
-            # Check if the data has a points_json field
-            if isinstance(data, dict) and "points_json" in data:
-                # If it does, use that as the points_json string
-                points_json_str = data["points_json"]
-                print("points_json_str in data: ", points_json_str)
 
-                # Try to parse the points_json string as JSON
-                try:
-                    # Check if points_json_str is already a list
-                    if isinstance(points_json_str, list):
-                        parsed_points = points_json_str
-                        print("parsed_points as list: ", parsed_points)
-                    else:
-                        # Try to parse as JSON string
-                        parsed_points = json.loads(points_json_str)
-
-                    # Check if parsed_points has a points_json field
-                    if isinstance(parsed_points, dict) and "points_json" in parsed_points:
-                        points_data = parsed_points["points_json"]
-                    else:
-                        # If not, assume the parsed data is the array of points directly
-                        points_data = parsed_points
-                except json.JSONDecodeError as e:
-                    # If points_json is not valid JSON, try using it directly
-                    if isinstance(points_json_str, list):
-                        points_data = points_json_str
-                    else:
-                        # If it's not a list, raise an error
-                        raise HTTPException(status_code=400, detail=f"Invalid JSON format in points_json field: {str(e)}")
-            else:
-                # If the body is not a JSON object with a points_json field,
-                # assume it's a raw JSON string that needs to be parsed
-                try:
-                    # Try to parse the body as a JSON string
-                    # First, try without any modifications
-                    try:
-                        parsed_body = json.loads(body_str)
-                    except json.JSONDecodeError:
-                        # If that fails, try stripping quotes and replacing escaped quotes
-                        parsed_body = json.loads(body_str.strip('"').replace('\\"', '"'))
-
-                    print("Parsed body without point_json key: ", parsed_body)
-                    # Check if parsed_body has a points_json field
-                    if isinstance(parsed_body, dict) and "points_json" in parsed_body:
-                        points_data = parsed_body["points_json"]
-                    else:
-                        # If not, assume the parsed data is the array of points directly
-                        points_data = parsed_body
-                except json.JSONDecodeError as e:
-                    # If the body is not valid JSON, try one more approach
-                    try:
-                        # Try parsing with different quote handling
-                        parsed_body = json.loads(body_str.replace('\\', '').replace('"{', '{').replace('}"', '}'))
-
-                        # Check if parsed_body has a points_json field
-                        if isinstance(parsed_body, dict) and "points_json" in parsed_body:
-                            points_data = parsed_body["points_json"]
-                        else:
-                            # If not, assume the parsed data is the array of points directly
-                            points_data = parsed_body
-                    except json.JSONDecodeError as e2:
-                        # If all parsing attempts fail, raise an error
-                        raise HTTPException(status_code=400, detail=f"Invalid JSON format in request body: {str(e)}")
-        except json.JSONDecodeError as e:
-            # If the body is not valid JSON, raise an error
-            raise HTTPException(status_code=400, detail=f"Invalid JSON format in request body: {str(e)}")
-
-        # Ensure points_data is a list
-        if not isinstance(points_data, list):
-            if isinstance(points_data, dict):
-                # If it's a single point as a dict, wrap it in a list
-                points_data = [points_data]
-            else:
-                raise HTTPException(status_code=400, detail=f"Expected points_data to be a list, got {type(points_data).__name__}")
+@app.get("/pyigrf/tiles")
+async def get_pyigrf_tiles():
+    # Model segment, lattice and error bound of the tile store
+    if tile_store is None:
+        raise HTTPException(status_code=404, detail="No tile store is loaded, set IGRF_TILES to one built with igrf_tiles.py")
+    return tile_store.info()
 
-        # Check if there are too many points
-        if len(points_data) > MAX_POINTS:
-            raise HTTPException(status_code=413, detail=f"Too many points. Maximum is {MAX_POINTS}")
 
-        # Process the points data with minimal logging
-        print(f"Processing {len(points_data)} points")
-        results = []
+def collect_cache_metrics():
+    """Copy the counters of the coefficient, kernel and result caches into the cache gauges"""
+    caches = {"coefficients": pyIGRF.loadCoeffs.coeffs_cache_info(), "kernels": igrf_engine.kernel_cache_info()}
+    if result_cache is not None:
+        caches["results"] = result_cache.info()
+    for cache, info in caches.items():
+        CACHE_HITS.set(info["hits"], cache=cache)
+        CACHE_MISSES.set(info["misses"], cache=cache)
+        CACHE_SIZE.set(info["currsize"], cache=cache)
 
-        # Process points in batches to avoid memory issues
-        BATCH_SIZE = 100
-        for batch_start in range(0, len(points_data), BATCH_SIZE):
-            batch_end = min(batch_start + BATCH_SIZE, len(points_data))
-            batch = points_data[batch_start:batch_end]
 
-            for i, point in enumerate(batch):
-                point_index = batch_start + i
-                # Each point is an object with latitude, longitude, altitude, and year fields
-                try:
-                    # Extract values with validation
-                    try:
-                        lat = float(point["latitude"])
-                        if not -90 <= lat <= 90:
-                            raise ValueError(f"Latitude must be between -90 and 90, got {lat}")
-
-                        long = float(point["longitude"])
-                        if not -180 <= long <= 180:
-                            raise ValueError(f"Longitude must be between -180 and 180, got {long}")
-
-                        altitude = float(point["altitude"])
-                        if altitude < 0:
-                            raise ValueError(f"Altitude must be non-negative, got {altitude}")
-
-                        year = float(point["year"])
-                        if not 1900 <= year <= 2030:
-                            raise ValueError(f"Year must be between 1900 and 2030, got {year}")
-                    except KeyError as e:
-                        raise HTTPException(status_code=400, detail=f"Missing field in point {point_index}: {str(e)}")
-                    except ValueError as e:
-                        raise HTTPException(status_code=400, detail=f"Invalid value in point {point_index}: {str(e)}")
-
-                    # Note: pyIGRF.igrf_value expects parameters in the order (long, lat, altitude, year)
-                    try:
-                        # Platform-independent timeout implementation
-                        import threading
-                        import concurrent.futures
-
-                        # Use ThreadPoolExecutor with a timeout to prevent hanging
-                        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                            future = executor.submit(pyIGRF.igrf_value, long, lat, altitude, year)
-                            try:
-                                # Wait for at most 5 seconds for the calculation to complete
-                                result = future.result(timeout=5)
-
-                                # Check if the point has additional fields like declination, horizontal intensity, etc.
-                                # If so, we'll use those values instead of calculating them
-                                if all(key in point for key in ["declination", "horizontal intensity", "inclination", "total intensity", "vertical intensity"]):
-                                    # Create a result object with all the fields from the input point
-                                    point_result = {
-                                        "latitude": lat,
-                                        "longitude": long,
-                                        "altitude": altitude,
-                                        "year": year,
-                                        "declination": float(point["declination"]),
-                                        "horizontal_intensity": float(point["horizontal intensity"]),
-                                        "inclination": float(point["inclination"]),
-                                        "total_intensity": float(point["total intensity"]),
-                                        "vertical_intensity": float(point["vertical intensity"])
-                                    }
-
-                                    results.append(point_result)
-                                else:
-                                    # If the point doesn't have the additional fields, use the calculated result
-                                    # Format the result into a dictionary with descriptive field names
-                                    dd, ds, dh, dx, dy, dz, df = result
-                                    point_result = {
-                                        "latitude": lat,
-                                        "longitude": long,
-                                        "altitude": altitude,
-                                        "year": year,
-                                        "declination": dd,  # D: declination (+ve east) in degrees
-                                        "inclination": ds,  # I: inclination (+ve down) in degrees
-                                        "horizontal_intensity": dh,  # H: horizontal intensity in nT
-                                        "north_component": dx,  # X: north component in nT
-                                        "east_component": dy,  # Y: east component in nT
-                                        "vertical_component": dz,  # Z: vertical component (+ve down) in nT
-                                        "total_intensity": df  # F: total intensity in nT
-                                    }
-                                    results.append(point_result)
-                            except concurrent.futures.TimeoutError:
-                                # If the calculation times out, use fallback values
-                                print(f"Calculation timed out for point {point_index}")
-                                # Create a fallback result with the same structure as the normal result
-                                fallback_result = {
-                                    "latitude": lat,
-                                    "longitude": long,
-                                    "altitude": altitude,
-                                    "year": year,
-                                    "declination": -1.5,  # D: declination (+ve east) in degrees
-                                    "inclination": -11.2,  # I: inclination (+ve down) in degrees
-                                    "horizontal_intensity": 31000,  # H: horizontal intensity in nT
-                                    "north_component": 31000,  # X: north component in nT
-                                    "east_component": -800,  # Y: east component in nT
-                                    "vertical_component": -6000,  # Z: vertical component (+ve down) in nT
-                                    "total_intensity": 31700  # F: total intensity in nT
-                                }
-                                results.append(fallback_result)
-                    except Exception as e:
-                        print(f"Error calculating IGRF for point {point_index}: {str(e)}")
-                        # Use fallback values instead of crashing
-                        fallback_result = {
-                            "latitude": lat,
-                            "longitude": long,
-                            "altitude": altitude,
-                            "year": year,
-                            "declination": -1.5,  # D: declination (+ve east) in degrees
-                            "inclination": -11.2,  # I: inclination (+ve down) in degrees
-                            "horizontal_intensity": 31000,  # H: horizontal intensity in nT
-                            "north_component": 31000,  # X: north component in nT
-                            "east_component": -800,  # Y: east component in nT
-                            "vertical_component": -6000,  # Z: vertical component (+ve down) in nT
-                            "total_intensity": 31700  # F: total intensity in nT
-                        }
-                        results.append(fallback_result)
-
-                except Exception as e:
-                    print(f"Unexpected error processing point {point_index}: {str(e)}")
-                    # Continue processing other points instead of failing completely
-                    fallback_result = {
-                        "latitude": lat if 'lat' in locals() else 0,
-                        "longitude": long if 'long' in locals() else 0,
-                        "altitude": altitude if 'altitude' in locals() else 0,
-                        "year": year if 'year' in locals() else 2020,
-                        "declination": -1.5,  # D: declination (+ve east) in degrees
-                        "inclination": -11.2,  # I: inclination (+ve down) in degrees
-                        "horizontal_intensity": 31000,  # H: horizontal intensity in nT
-                        "north_component": 31000,  # X: north component in nT
-                        "east_component": -800,  # Y: east component in nT
-                        "vertical_component": -6000,  # Z: vertical component (+ve down) in nT
-                        "total_intensity": 31700  # F: total intensity in nT
-                    }
-                    results.append(fallback_result)
-
-        print(f"Returning {len(results)} results")
-        return results
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text format, the values are per worker process
+    return Response(content=igrf_metrics.render([collect_cache_metrics]), media_type=igrf_metrics.CONTENT_TYPE)
+
+@app.post("/pyigrf")
+async def compute_pyigrf(request: Request):
+    itype = coordinate_type(request)
+    model = model_name(request)
+    # Newline-delimited points are parsed and answered batch by batch as they arrive
+    if request.headers.get("content-type", "").split(";")[0].strip() in NDJSON_MEDIA_TYPES:
+        spool = await spool_point_results(request, itype, model)
+        return StreamingResponse(iter_spool(spool), media_type="application/x-ndjson")
+    # Raw float64 columns in, raw float64 components out
+    if request.headers.get("content-type", "").split(";")[0].strip() == BINARY_MEDIA_TYPE:
+        # Exact synthesis only, the binary format has no field for the source of a point
+        components, _, _ = await offload(evaluate_columns, *parse_binary(await read_body(request)), False, itype, model)
+        return binary_result(components)
+
+    try:
+        # Get the raw request body with size limit
+        body = await read_body(request)
+        check_request_size(body)
+
+        logger.debug(f"Request received, size: {len(body)} bytes")
+
+        # Small bodies are computed together with those of concurrent requests
+        if point_batcher is not None and len(body) <= point_batcher.max_body_bytes:
+            response = await batched_points_body(body, wants_columnar(request), request.headers.get("accept-encoding", ""), itype, model)
+            if response is not None:
+                return response
+
+        # Parsing and computing run off the event loop
+        return await offload(process_points_body, body, wants_columnar(request), request.headers.get("accept-encoding", ""), itype, model)
     except json.JSONDecodeError as e:
-        print(f"JSONDecodeError: {str(e)}")
+        logger.info(f"JSONDecodeError: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid JSON format: {str(e)}")
     except (KeyError, ValueError) as e:
-        print(f"KeyError or ValueError: {str(e)}")
+        logger.info(f"KeyError or ValueError: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid point format. Each point should be an object with 'latitude', 'longitude', 'altitude', and 'year' fields. Error: {str(e)}")
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Unexpected error: {str(e)}")
+        logger.error(f"Unexpected error: {str(e)}")
         # Don't print traceback to avoid exposing sensitive information
         raise HTTPException(status_code=500, detail="An internal server error occurred. Please try again later.")
 
+@app.post("/pyigrf/grid")
+async def compute_pyigrf_grid(grid: GridRequest, request: Request):
+    # Legendre terms are computed once per latitude row and cos/sin(m*lon) once per longitude column
+    geodetic_only(request)
+    model = model_name(request)
+    lats, longs = parse_grid(grid, model)
+    logger.debug(f"Processing grid of {len(lats)} x {len(longs)} points")
+    components = await offload(compute_grid, lats, longs, grid.altitude, grid.year, model)
+
+    # Raw float64 components out, each one row-major with one row per latitude
+    if request.headers.get("accept", "").split(";")[0].strip() == BINARY_MEDIA_TYPE:
+        response = binary_result(components)
+        response.headers["X-IGRF-Grid-Shape"] = f"{len(lats)},{len(longs)}"
+        return response
+    return await offload(grid_result, lats, longs, grid, components, request.headers.get("accept-encoding", ""))
+
+@app.post("/pyigrf/trace")
+async def compute_pyigrf_trace(trace: TraceRequest, request: Request):
+    # All the lines of a request are integrated together, one batched field evaluation per Runge-Kutta stage
+    geodetic_only(request)
+    default_model_only(request)
+    logger.debug(f"Tracing {len(trace.points)} field lines")
+    return await offload(compute_trace, trace, request.headers.get("accept-encoding", ""))
+
+@app.post("/pyigrf/timeseries")
+async def compute_pyigrf_timeseries(series: TimeSeriesRequest, request: Request):
+    # The location's spherical harmonic basis is computed once and reused for every epoch
+    geodetic_only(request)
+    return await offload(compute_timeseries, series, request.headers.get("accept-encoding", ""), model_name(request))
+
+@app.post("/pyigrf/jobs")
+async def create_pyigrf_job(request: Request):
+    # Returns as soon as the points are stored, the job workers compute them in chunks
+    geodetic_only(request)
+    default_model_only(request)
+    return await offload(submit_job, await read_body(request), request.headers.get("accept-encoding", ""))
+
+@app.get("/pyigrf/jobs/{job}")
+async def get_pyigrf_job(job: str):
+    status = require_job_store().status(job)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"No job {job}")
+    return status
+
+@app.get("/pyigrf/jobs/{job}/results")
+async def get_pyigrf_job_results(job: str, request: Request, offset: int = 0, limit: int = 10000):
+    # Pages can be fetched as soon as their chunks are computed, and fetched again after a failed download
+    return await offload(job_results, job, offset, limit, wants_columnar(request), request.headers.get("accept-encoding", ""))
+
+@app.delete("/pyigrf/jobs/{job}")
+async def delete_pyigrf_job(job: str):
+    if not require_job_store().delete(job):
+        raise HTTPException(status_code=404, detail=f"No job {job}")
+    return {"id": job, "deleted": True}
+
 # Keep the original endpoint for backward compatibility
 @app.post("/pyigrf/model")
-async def compute_pyigrf_model(point_array: StringifiedPointArray):
-    # Parse the stringified JSON to get the points array
-    try:
-        # First, check if the input is already a JSON string or if it needs to be parsed
-        try:
-            # Try to parse the input as a JSON string
-            parsed_data = json.loads(point_array.points_json)
+async def compute_pyigrf_model(request: Request):
+    geodetic_only(request)
+    default_model_only(request)
+    # Raw float64 columns in, raw float64 components out
+    if request.headers.get("content-type", "").split(";")[0].strip() == BINARY_MEDIA_TYPE:
+        # Range-checked like the binary requests of /pyigrf, rejected points come back as NaN
+        components, _, _ = await offload(evaluate_columns, *parse_binary(await read_body(request)), False)
+        return binary_result(components)
 
-            # Check if the parsed data has a "points_json" field
-            if "points_json" in parsed_data:
-                points_data = parsed_data["points_json"]
-            else:
-                # If not, assume the parsed data is the array of points directly
-                points_data = parsed_data
-        except json.JSONDecodeError:
-            # If the input is not valid JSON, raise an error
-            raise HTTPException(status_code=400, detail="Invalid JSON format")
+    # The body is read by hand so binary requests can share the route, validate it as before
+    try:
+        point_array = StringifiedPointArray.parse_raw(await read_body(request))
+    except ValidationError as e:
+        raise RequestValidationError(e.raw_errors)
 
-        results = []
-        for point in points_data:
-            # Each point is an object with latitude, longitude, altitude, and year fields
-            lat = float(point["latitude"])
-            long = float(point["longitude"])
-            altitude = float(point["altitude"])
-            year = float(point["year"])
-            # Note: pyIGRF.igrf_value expects parameters in the order (long, lat, altitude, year)
-            try:
-                result = pyIGRF.igrf_value(long, lat, altitude, year)
-                # Format the result into a dictionary with descriptive field names
-                dd, ds, dh, dx, dy, dz, df = result
-                point_result = {
-                    "latitude": lat,
-                    "longitude": long,
-                    "altitude": altitude,
-                    "year": year,
-                    "declination": dd,  # D: declination (+ve east) in degrees
-                    "inclination": ds,  # I: inclination (+ve down) in degrees
-                    "horizontal_intensity": dh,  # H: horizontal intensity in nT
-                    "north_component": dx,  # X: north component in nT
-                    "east_component": dy,  # Y: east component in nT
-                    "vertical_component": dz,  # Z: vertical component (+ve down) in nT
-                    "total_intensity": df  # F: total intensity in nT
-                }
-                results.append(point_result)
-            except Exception as e:
-                print(f"Error calculating IGRF: {str(e)}")
-                # Use fallback values instead of crashing
-                fallback_result = {
-                    "latitude": lat,
-                    "longitude": long,
-                    "altitude": altitude,
-                    "year": year,
-                    "declination": -1.5,  # D: declination (+ve east) in degrees
-                    "inclination": -11.2,  # I: inclination (+ve down) in degrees
-                    "horizontal_intensity": 31000,  # H: horizontal intensity in nT
-                    "north_component": 31000,  # X: north component in nT
-                    "east_component": -800,  # Y: east component in nT
-                    "vertical_component": -6000,  # Z: vertical component (+ve down) in nT
-                    "total_intensity": 31700  # F: total intensity in nT
-                }
-                results.append(fallback_result)
-        return results
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON format")
-    except (KeyError, ValueError) as e:
-        raise HTTPException(status_code=400, detail=f"Invalid point format. Each point should be an object with 'latitude', 'longitude', 'altitude', and 'year' fields. Error: {str(e)}")
+    # Parsing and computing run off the event loop
+    return await offload(process_model_points, point_array.points_json, wants_columnar(request), request.headers.get("accept-encoding", ""))
 
 # For Render deployment - get the port from the environment variable or use 8000 as default
 port = int(os.environ.get("PORT", 8000))
 
 if __name__ == "__main__":
+    # Imported here, "uvicorn main:app" has already imported it and nothing else needs it
+    import uvicorn
+
     # Run the application with Uvicorn, binding to all network interfaces (0.0.0.0)
     # This makes the API accessible via the server's IP address
     uvicorn.run(app, host="0.0.0.0", port=port)
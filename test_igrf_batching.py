@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+import igrf_batching
+import main
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def recording_batcher(**settings):
+    calls = []
+
+    async def compute(values, key):
+        calls.append((values.tolist(), key))
+        return values * 2, None
+
+    return igrf_batching.MicroBatcher(compute, **settings), calls
+
+
+def test_concurrent_requests_share_one_batch():
+    batcher, calls = recording_batcher(window=0.01)
+
+    async def requests():
+        return await asyncio.gather(batcher.submit([np.array([1.0, 2.0])]), batcher.submit([np.array([3.0])]),
+                                    batcher.submit([np.array([4.0])], key="other"))
+
+    first, second, other = run(requests())
+    assert calls == [([1.0, 2.0, 3.0], None), ([4.0], "other")]
+    assert first[0].tolist() == [2.0, 4.0] and first[1] is None
+    assert second[0].tolist() == [6.0]
+    assert other[0].tolist() == [8.0]
+
+
+def test_full_batch_does_not_wait_for_the_window():
+    batcher, calls = recording_batcher(window=60.0, max_points=3)
+
+    async def requests():
+        return await asyncio.wait_for(asyncio.gather(batcher.submit([np.array([1.0, 2.0])]),
+                                                     batcher.submit([np.array([3.0])])), 5)
+
+    run(requests())
+    assert calls == [([1.0, 2.0, 3.0], None)]
+
+
+def test_errors_reach_every_request_of_the_batch():
+    async def compute(values, key):
+        raise ValueError("broken")
+
+    batcher = igrf_batching.MicroBatcher(compute, window=0.001)
+
+    async def requests():
+        return await asyncio.gather(batcher.submit([np.array([1.0])]), batcher.submit([np.array([2.0])]),
+                                    return_exceptions=True)
+
+    assert [str(error) for error in run(requests())] == ["broken", "broken"]
+    assert igrf_batching.from_env(compute, {"IGRF_BATCH_WINDOW_MS": "0"}) is None
+    assert igrf_batching.from_env(compute, {"IGRF_BATCH_WINDOW_MS": "5"}).window == pytest.approx(0.005)
+
+
+def test_batched_bodies_match_unbatched(monkeypatch):
+    monkeypatch.setattr(main, "point_batcher", igrf_batching.MicroBatcher(main.compute_batch, window=0.01))
+    bodies = [json.dumps([{"latitude": str(10 + i), "longitude": "4.0625", "altitude": "253.7", "year": str(2000 + i)},
+                          {"latitude": "95", "longitude": "0", "altitude": "0", "year": "2024.9"}]).encode()
+              for i in range(5)]
+    calls = []
+    compute_columns_tiled = main.compute_columns_tiled
+    monkeypatch.setattr(main, "compute_columns_tiled", lambda *args: calls.append(len(args[0])) or compute_columns_tiled(*args))
+
+    async def requests():
+        return await asyncio.gather(*(main.batched_points_body(body) for body in bodies))
+
+    batched = run(requests())
+    assert calls == [5]
+    for body, response in zip(bodies, batched):
+        assert json.loads(response.body) == json.loads(main.process_points_body(body).body)
+    # Columnar bodies are left to process_points_body
+    assert run(main.batched_points_body(b'{"latitude": [1], "longitude": [1], "altitude": [1], "year": [2020]}')) is None
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+import igrf_cache
+import main
+
+RESULT = (-0.2, 6.4, 29930.9, 29930.7, -106.5, 3390.1, 30122.3)
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = igrf_cache.MemoryCache(maxsize=2, ttl=0)
+    cache.set_many([b"1", b"2"], [RESULT, RESULT])
+    cache.get_many([b"1"])
+    cache.set_many([b"3"], [RESULT])
+    found, values = cache.get_many([b"1", b"2", b"3"])
+    assert found.tolist() == [True, False, True]
+    assert values.tolist() == [list(RESULT), list(RESULT)]
+    assert cache.info()["hits"] == 3
+
+
+def test_memory_cache_expires_entries(monkeypatch):
+    cache = igrf_cache.MemoryCache(maxsize=10, ttl=60)
+    now = igrf_cache.time.monotonic()
+    cache.set_many([b"1"], [RESULT])
+    monkeypatch.setattr(igrf_cache.time, "monotonic", lambda: now + 61)
+    assert cache.get_many([b"1"])[0].tolist() == [False]
+    assert cache.info()["currsize"] == 0
+
+
+def test_sqlite_cache_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    keys = igrf_cache.quantize([13.9375, 13.8125], [4.0625, 4.1875], [253.74992, 301.00001], [2024.9, 2024.9])
+    cache = igrf_cache.SqliteCache(path, maxsize=1)
+    cache.set_many(keys[:1], [RESULT])
+    cache.set_many(keys[1:], [RESULT])
+    other = igrf_cache.SqliteCache(path, maxsize=1)
+    found, values = other.get_many(keys)
+    assert found.tolist() == [False, True] and values.tolist() == [list(RESULT)]
+    assert other.info()["currsize"] == 1
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path):
+    cache = igrf_cache.SqliteCache(str(tmp_path / "results.sqlite"), maxsize=2, ttl=0)
+    cache.set_many([b"1", b"2"], [RESULT, RESULT])
+    cache.get_many([b"1"])
+    cache.set_many([b"3"], [RESULT])
+    assert cache.get_many([b"1", b"2", b"3"])[0].tolist() == [True, False, True]
+    # Rewriting an entry does not count it twice
+    cache.set_many([b"3"], [RESULT])
+    assert cache.info()["currsize"] == 2
+    cache.clear()
+    assert cache.info()["currsize"] == 0
+
+
+def test_quantized_keys():
+    keys = igrf_cache.quantize([10.0, 10.0000001, 10.00001], [0, 0, 0], [1, 1, 1], [2024.9, 2024.9, 2024.9])
+    assert keys[0] == keys[1] != keys[2]
+    assert np.frombuffer(keys[2], dtype="<i8").tolist() == [10000010, 0, 1000, 20249000]
+    with pytest.raises(ValueError):
+        igrf_cache.quantum_from_env({"IGRF_RESULT_CACHE_QUANTUM": "1,1,1"})
+    assert igrf_cache.from_env({"IGRF_RESULT_CACHE": "off"}) is None
+
+
+def test_repeat_points_are_served_from_cache(monkeypatch):
+    monkeypatch.setattr(main, "result_cache", igrf_cache.MemoryCache(maxsize=100, ttl=0))
+    columns = [np.array([13.9375, 13.8125]), np.array([4.0625, 4.1875]),
+               np.array([253.74992, 301.00001]), np.array([2024.9, 2024.9])]
+    first = main.compute_columns(*columns)
+
+    calls = []
+    compute_chunks = main.compute_chunks
+    monkeypatch.setattr(main, "compute_chunks", lambda *args: calls.append(len(args[0])) or compute_chunks(*args))
+    overlapping = [np.append(column, value) for column, value in zip(columns, (13.6875, 4.3125, 275.74988, 2024.9))]
+    second = main.compute_columns(*overlapping)
+    assert calls == [1]
+    for component, expected in zip(second, first):
+        assert component[:2].tolist() == expected.tolist()
+
+
+def test_batches_larger_than_the_cache_bypass_it(monkeypatch):
+    monkeypatch.setattr(main, "result_cache", igrf_cache.MemoryCache(maxsize=2, ttl=0))
+    main.compute_columns([1.0, 2.0, 3.0], [2.0, 2.0, 2.0], [3.0, 3.0, 3.0], [2024.9, 2024.9, 2024.9])
+    assert main.result_cache.info() == dict(main.result_cache.info(), hits=0, misses=0, currsize=0)
+
+
+def test_failed_points_are_not_cached(monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError
+
+    monkeypatch.setattr(main, "result_cache", igrf_cache.MemoryCache(maxsize=100, ttl=0))
+    monkeypatch.setattr(main.igrf_engine, "igrf_value_batch", fail)
+    with pytest.raises(main.HTTPException) as failed:
+        main.compute_columns([1.0], [2.0], [3.0], [2024.9])
+    assert failed.value.status_code == 500
+    assert main.result_cache.info()["currsize"] == 0
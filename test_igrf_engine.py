@@ -0,0 +1,234 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pyIGRF
+import pytest
+from fastapi.testclient import TestClient
+
+import igrf_engine
+from main import app
+
+client = TestClient(app)
+
+# The sample points from test_main.http
+points = [
+    {"latitude": "13.9375", "longitude": "4.0625", "altitude": "253.74992", "year": "2024.9"},
+    {"latitude": "13.9375", "longitude": "4.1875", "altitude": "255.7499", "year": "2024.9"},
+    {"latitude": "13.8125", "longitude": "4.0625", "altitude": "301.00001", "year": "2024.9"},
+    {"latitude": "13.8125", "longitude": "4.1875", "altitude": "307.25054", "year": "2024.9"},
+    {"latitude": "13.9375", "longitude": "4.3125", "altitude": "275.74988", "year": "2024.9"}
+]
+
+FIELDS = ["declination", "inclination", "horizontal_intensity", "north_component",
+          "east_component", "vertical_component", "total_intensity"]
+TOLERANCES = [igrf_engine.ANGLE_TOLERANCE_DEG] * 2 + [igrf_engine.FIELD_TOLERANCE_NT] * 5
+
+
+def test_batch_matches_scalar_path():
+    rng = np.random.default_rng(0)
+    n = 500
+    lat = rng.uniform(-90, 90, n)
+    lon = rng.uniform(-180, 180, n)
+    alt = rng.uniform(0, 1000, n)
+    year = rng.choice([1900.0, 1957.3, 1994.9, 2003.2, 2024.9, 2027.5], n)
+    lat[:2] = [90, -90]
+
+    batch = igrf_engine.igrf_value_batch(lat, lon, alt, year)
+    scalar = np.array([pyIGRF.igrf_value(*point) for point in zip(lat, lon, alt, year)]).T
+    for component, expected, tolerance in zip(batch, scalar, TOLERANCES):
+        assert np.abs(component - expected).max() <= tolerance
+
+
+def test_geocentric_input_matches_igrf12syn():
+    rng = np.random.default_rng(2)
+    n = 200
+    lat = np.repeat(rng.uniform(-90, 90, n // 4), 4)
+    lon = rng.uniform(-180, 180, n)
+    alt = np.repeat(rng.uniform(0, 1000, n // 4), 4)
+    lat[:8] = [90] * 4 + [-90] * 4
+
+    # Four points per latitude and altitude pair, converted once each
+    coordinates = igrf_engine.geocentric_coordinates(1, alt, lat)
+    assert len(coordinates) == n and len(np.unique(coordinates.r)) == n // 4
+
+    batch = igrf_engine.igrf_value_batch(lat, lon, alt, 2003.2, itype=2)
+    scalar = np.array([pyIGRF.calculate.igrf12syn(2003.2, 2, igrf_engine.RE + a, la, lo)
+                       for la, lo, a in zip(lat, lon, alt)]).T
+    for component, expected in zip(batch[3:], scalar):
+        assert np.abs(component - expected).max() <= igrf_engine.FIELD_TOLERANCE_NT
+
+
+def test_pyigrf_endpoint_uses_batch_engine():
+    response = client.post("/pyigrf", json=points)
+    assert response.status_code == 200
+    results = response.json()
+    assert len(results) == len(points)
+    for point, result in zip(points, results):
+        expected = pyIGRF.igrf_value(float(point["latitude"]), float(point["longitude"]),
+                                     float(point["altitude"]), float(point["year"]))
+        for field, value, tolerance in zip(FIELDS, expected, TOLERANCES):
+            assert abs(result[field] - value) <= tolerance
+
+
+def test_pyigrf_model_endpoint_matches_pyigrf():
+    response = client.post("/pyigrf/model", json={"points_json": json.dumps({"points_json": points})})
+    assert response.status_code == 200
+    assert response.json() == client.post("/pyigrf", json=points).json()
+
+
+def test_single_epoch_batch_interpolates_once():
+    pyIGRF.loadCoeffs.get_model().coeffs.cache_clear()
+    igrf_engine._kernels.cache_clear()
+    lat = np.linspace(-80, 80, 10000)
+    igrf_engine.igrf_value_batch(lat, lat, 100.0, 2024.9, chunk_size=1000)
+    igrf_engine.igrf_value_batch(lat, lat, 100.0, 2024.9, chunk_size=1000)
+    assert pyIGRF.loadCoeffs.coeffs_cache_info()["misses"] == 1
+    info = igrf_engine.kernel_cache_info()
+    assert info["misses"] == 1
+    assert info["hits"] == 1
+
+
+def test_sparse_epochs_match_per_epoch_synthesis():
+    rng = np.random.default_rng(1)
+    n = 3000
+    lat, lon, alt = rng.uniform(-90, 90, n), rng.uniform(-180, 180, n), rng.uniform(-1, 500, n)
+    # Both degrees, the poles, a shared epoch and dates out of range
+    lat[:4] = [90.0, -90.0, 90.0, -90.0]
+    years = rng.uniform(1900, 2035, n)
+    years[:2] = 1990.0
+    years[-300:] = 2024.9
+    years[-302:-300] = [1899.0, 2040.0]
+    batch = np.array(igrf_engine.igrf_value_batch(lat, lon, alt, years, chunk_size=1000))
+    for i in range(0, n, 97):
+        single = np.array(igrf_engine.igrf_value_batch(lat[i], lon[i], alt[i], years[i]))[:, 0]
+        assert np.abs(batch[:, i] - single) == pytest.approx(0.0, abs=igrf_engine.FIELD_TOLERANCE_NT)
+    assert (batch[-1, -302:-300] == 1.0).all()
+
+
+def test_compiled_coefficients_match_text(tmp_path):
+    text = shutil.copy("custom_igrf14coeffs.txt", tmp_path / "igrf14coeffs.txt")
+    parsed = pyIGRF.loadCoeffs.load_table(str(text))
+    pyIGRF.loadCoeffs.compile_coeffs(str(text))
+    mapped = pyIGRF.loadCoeffs.load_table(str(text))
+    assert isinstance(mapped[5], np.memmap)
+    assert not isinstance(parsed[5], np.memmap)
+    for a, b in zip(parsed, mapped):
+        assert np.array_equal(a, b)
+    with pytest.raises(FileNotFoundError, match="IGRF_COEFFS_FILE"):
+        pyIGRF.loadCoeffs.load_table(str(tmp_path / "missing.txt"))
+
+
+def test_stale_compiled_coefficients_are_compiled_again(tmp_path):
+    text = str(shutil.copy("custom_igrf14coeffs.txt", tmp_path / "igrf14coeffs.txt"))
+    binary = pyIGRF.loadCoeffs.compile_coeffs(text)
+    parsed = pyIGRF.loadCoeffs.parse_table(text)
+    # A table written before the format marker, and one cut short
+    old = np.load(binary)
+    old[0, 1:3] = np.nan
+    for table in (old, old[:-1]):
+        np.save(binary, table)
+        with pytest.raises(ValueError, match="format"):
+            pyIGRF.loadCoeffs.read_table(binary)
+        mapped = pyIGRF.loadCoeffs.load_table(text)
+        assert isinstance(mapped[5], np.memmap)
+        assert all(np.array_equal(a, b) for a, b in zip(parsed, mapped))
+    # A table older than its text file
+    os.utime(binary, ns=(1, 1))
+    pyIGRF.loadCoeffs.load_table(text)
+    assert os.path.getmtime(binary) >= os.path.getmtime(text)
+
+
+def test_model_is_indexed_from_the_file_header():
+    model = pyIGRF.loadCoeffs.get_model()
+    assert model.name == "igrf14"
+    assert (model.start, model.intended_end, model.end, model.nmax) == (1900.0, 2030.0, 2035.0, 13)
+    assert model.degree(np.array([1994.9, 1995.0, 2000.0, 2034.0])).tolist() == [10, 13, 13, 13]
+    nmx, g, h = model.coeffs(2025.0)
+    # g(1, 0), g(1, 1) and h(1, 1) of IGRF-14 at 2025
+    assert (nmx, g[0], g[1], h[1]) == (13, -29350.0, -1410.3, 4545.5)
+    assert model.coeffs(1899.0) == (0, None, None)
+
+
+def test_import_defers_coefficients_and_server_imports():
+    # Run in a fresh interpreter, this one has loaded everything already
+    code = ("import sys, main; "
+            "print(main.pyIGRF.loadCoeffs.registry.cache_info().currsize, 'uvicorn' in sys.modules, 'multiprocessing' in sys.modules)")
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    assert output.split() == ["0", "False", "False"]
+
+
+def test_grid_matches_batch():
+    lat = np.arange(-90, 90.1, 7.5)
+    lon = np.arange(-180, 180.1, 15.0)
+    lat_grid, lon_grid = np.meshgrid(lat, lon, indexing="ij")
+    for year in (1957.3, 2024.9, 2027.5):
+        grid = igrf_engine.igrf_value_grid(lat, lon, 300.0, year)
+        batch = igrf_engine.igrf_value_batch(lat_grid.ravel(), lon_grid.ravel(), 300.0, year)
+        for component, expected, tolerance in zip(grid, batch, TOLERANCES):
+            assert component.shape == lat_grid.shape
+            assert np.abs(component.ravel() - expected).max() <= tolerance
+
+
+def test_grid_endpoint():
+    grid = {"min_latitude": 13.8125, "max_latitude": 13.9375, "min_longitude": 4.0625, "max_longitude": 4.3125,
+            "spacing": 0.125, "altitude": 300, "year": 2024.9}
+    response = client.post("/pyigrf/grid", json=grid)
+    assert response.status_code == 200
+    result = response.json()
+    assert result["latitude"] == [13.8125, 13.9375]
+    assert result["longitude"] == [4.0625, 4.1875, 4.3125]
+    for row, lat in enumerate(result["latitude"]):
+        for column, lon in enumerate(result["longitude"]):
+            expected = pyIGRF.igrf_value(lat, lon, 300, 2024.9)
+            for field, value, tolerance in zip(FIELDS, expected, TOLERANCES):
+                assert abs(result[field][row][column] - value) <= tolerance
+
+    binary = client.post("/pyigrf/grid", json=grid, headers={"Accept": "application/octet-stream"})
+    assert binary.headers["x-igrf-grid-shape"] == "2,3"
+    components = np.frombuffer(binary.content, dtype="<f8").reshape(len(FIELDS), 2, 3)
+    assert components[-1].tolist() == result["total_intensity"]
+
+    assert client.post("/pyigrf/grid", json=dict(grid, spacing=0)).status_code == 400
+    assert client.post("/pyigrf/grid", json=dict(grid, spacing=1e-5)).status_code == 413
+
+
+def test_series_matches_batch():
+    years = np.array([1900.0, 1903.3, 1992.5, 1994.99, 1995.0, 2020.1, 2024.9, 2025.0, 2027.3, 2030.0])
+    for lat, lon, alt in [(13.9375, 4.0625, 253.74992), (-89.9, 170.0, 0.0), (90.0, 0.0, 10.0)]:
+        series = igrf_engine.igrf_value_series(lat, lon, alt, years)
+        batch = igrf_engine.igrf_value_batch(lat, lon, alt, years)
+        for component, expected, tolerance in zip(series, batch, TOLERANCES):
+            assert np.abs(component - expected).max() <= tolerance
+
+    # Rates of change against central differences inside an interpolation interval and past the last epoch
+    years = np.array([1992.5, 2012.3, 2027.0])
+    above = igrf_engine.igrf_value_series(45.0, 10.0, 100.0, years + 1e-3)
+    below = igrf_engine.igrf_value_series(45.0, 10.0, 100.0, years - 1e-3)
+    rates = igrf_engine.igrf_value_series(45.0, 10.0, 100.0, years)[7:]
+    for high, low, rate in zip(above, below, rates):
+        assert np.abs((high - low) / 2e-3 - rate).max() <= 1e-6
+
+
+def test_timeseries_endpoint():
+    body = {"latitude": 13.9375, "longitude": 4.0625, "altitude": 253.74992, "start_year": 2020, "end_year": 2021, "step": 0.5}
+    response = client.post("/pyigrf/timeseries", json=body)
+    assert response.status_code == 200
+    result = response.json()
+    assert result["year"] == [2020.0, 2020.5, 2021.0]
+    for index, year in enumerate(result["year"]):
+        expected = pyIGRF.igrf_value(13.9375, 4.0625, 253.74992, year)
+        for field, value, tolerance in zip(FIELDS, expected, TOLERANCES):
+            assert abs(result[field][index] - value) <= tolerance
+    assert len(set(result["north_component_rate"])) == 1
+
+    listed = client.post("/pyigrf/timeseries", json=dict(body, years=[1800, 2020.5])).json()
+    assert listed["total_intensity"][0] is None
+    assert abs(listed["total_intensity"][1] - result["total_intensity"][1]) <= igrf_engine.FIELD_TOLERANCE_NT
+    assert listed["rejected"] == [{"index": 0, "reason": "Year must be between 1900 and 2030, got 1800.0"}]
+
+    assert client.post("/pyigrf/timeseries", json=dict(body, latitude=95)).status_code == 400
+    assert client.post("/pyigrf/timeseries", json={"latitude": 0, "longitude": 0, "altitude": 0}).status_code == 400
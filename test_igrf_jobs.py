@@ -0,0 +1,115 @@
+import json
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import igrf_jobs
+import main
+
+client = TestClient(main.app)
+
+points = [
+    {"latitude": "13.9375", "longitude": "4.0625", "altitude": "253.74992", "year": "2024.9"},
+    {"latitude": "95", "longitude": "4.1875", "altitude": "255.7499", "year": "2024.9"},
+    {"latitude": "13.8125", "longitude": "4.0625", "altitude": "301.00001", "year": "2024.9"},
+    {"latitude": "13.8125", "longitude": "4.1875", "altitude": "307.25054", "year": "2024.9"},
+    {"latitude": "13.9375", "longitude": "4.3125", "altitude": "275.74988", "year": "2024.9"}
+]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = igrf_jobs.JobStore(str(tmp_path / "jobs.sqlite"), chunk_points=2)
+    monkeypatch.setattr(main, "job_store", store)
+    monkeypatch.setattr(main, "job_runner", igrf_jobs.JobRunner(store, main.compute_job_chunk))
+    return store
+
+
+def test_job_results_match_direct_request(store):
+    response = client.post("/pyigrf/jobs", data=json.dumps(points))
+    assert response.status_code == 202
+    job = response.json()
+    assert (job["state"], job["chunks"], job["completed_points"]) == ("queued", 2, 1)
+    assert client.get(f"/pyigrf/jobs/{job['id']}/results").status_code == 409
+
+    main.job_runner.run_one()
+    assert client.get(f"/pyigrf/jobs/{job['id']}").json()["state"] == "running"
+    # The first chunk holds the points at positions 0 and 2, so the page before position 3 is ready
+    first = client.get(f"/pyigrf/jobs/{job['id']}/results?limit=3").json()
+    assert first["next_offset"] == 3
+    assert client.get(f"/pyigrf/jobs/{job['id']}/results?offset=3").status_code == 409
+
+    main.job_runner.run_pending()
+    assert client.get(f"/pyigrf/jobs/{job['id']}").json()["progress"] == 1.0
+    rest = client.get(f"/pyigrf/jobs/{job['id']}/results?offset=3").json()
+    assert rest["next_offset"] is None
+    assert first["results"] + rest["results"] == client.post("/pyigrf", json=points).json()
+
+    columnar = client.get(f"/pyigrf/jobs/{job['id']}/results?format=columnar").json()["results"]
+    assert columnar["rejected"] == [{"index": 1, "reason": "Latitude must be between -90 and 90, got 95.0"}]
+
+    assert client.delete(f"/pyigrf/jobs/{job['id']}").status_code == 200
+    assert client.get(f"/pyigrf/jobs/{job['id']}").status_code == 404
+
+
+def test_columnar_job(store):
+    body = {column: [point[column] for point in points] for column in main.POINT_COLUMNS}
+    job = client.post("/pyigrf/jobs", json=body).json()
+    main.job_runner.run_pending()
+    results = client.get(f"/pyigrf/jobs/{job['id']}/results").json()["results"]
+    assert results == client.post("/pyigrf", json=points).json()
+
+
+def test_expired_lease_resumes_chunk(store, monkeypatch):
+    job = store.submit(3, [0, 1, 2], np.array([[10.0] * 3, [20.0] * 3, [0.0] * 3, [2024.9] * 3]), {})
+    assert store.claim()[:2] == (job, 0)
+    # A worker that died holds its chunk until the lease expires
+    assert store.claim()[:2] == (job, 1)
+    assert store.claim() is None
+    now = igrf_jobs.time.time()
+    monkeypatch.setattr(igrf_jobs.time, "time", lambda: now + store.lease + 1)
+    reopened = igrf_jobs.JobStore(store.path, chunk_points=2)
+    runner = igrf_jobs.JobRunner(reopened, main.compute_job_chunk)
+    runner.run_pending()
+    assert reopened.status(job)["state"] == "done"
+    fixed, chunks = reopened.results(job, 0, 3)
+    assert [positions.tolist() for positions, _, _ in chunks] == [[0, 1], [2]]
+
+
+def test_failed_chunk_stays_leased_and_is_retried(store, monkeypatch):
+    job = store.submit(2, [0, 1], np.array([[10.0] * 2, [20.0] * 2, [0.0] * 2, [2024.9] * 2]), {})
+
+    def fail(*columns):
+        raise RuntimeError("worker lost")
+
+    igrf_value_batch = main.igrf_engine.igrf_value_batch
+    monkeypatch.setattr(main.igrf_engine, "igrf_value_batch", fail)
+    with pytest.raises(RuntimeError):
+        main.job_runner.run_one()
+    # No made-up values are stored, the chunk waits for its lease to expire
+    assert store.status(job)["completed_points"] == 0
+    assert store.claim() is None
+    monkeypatch.setattr(main.igrf_engine, "igrf_value_batch", igrf_value_batch)
+    now = igrf_jobs.time.time()
+    monkeypatch.setattr(igrf_jobs.time, "time", lambda: now + store.lease + 1)
+    igrf_jobs.JobRunner(store, main.compute_job_chunk).run_pending()
+    assert store.status(job)["state"] == "done"
+
+
+def test_expired_jobs_are_removed(store, monkeypatch):
+    job = store.submit(1, [], np.empty((4, 0)), {0: {"error": "rejected"}})
+    assert store.status(job)["state"] == "done"
+    assert store.results(job, 0, 1)[0] == {0: {"error": "rejected"}}
+    now = igrf_jobs.time.time()
+    monkeypatch.setattr(igrf_jobs.time, "time", lambda: now + store.ttl + 1)
+    store.expire()
+    assert store.status(job) is None
+
+
+def test_results_offset_past_the_end(store):
+    job = client.post("/pyigrf/jobs", data=json.dumps(points[:1])).json()
+    main.job_runner.run_pending()
+    last = client.get(f"/pyigrf/jobs/{job['id']}/results?offset=1").json()
+    assert (last["results"], last["next_offset"]) == ([], None)
+    assert client.get(f"/pyigrf/jobs/{job['id']}/results?offset=10").status_code == 400
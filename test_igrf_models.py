@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+import pyIGRF
+import pytest
+from fastapi.testclient import TestClient
+
+import igrf_cache
+import igrf_engine
+import main
+
+client = TestClient(main.app)
+
+DEFAULT_FILE = os.path.abspath("custom_igrf14coeffs.txt")
+
+
+def write_igrf13(path, scale=1.0):
+    """An IGRF-13 like file: the IGRF-14 table up to 2020 with the 2020-2025 change as secular variation"""
+    lines = []
+    with open(DEFAULT_FILE) as f:
+        for line in f:
+            fields = line.split()
+            if line.startswith("# 14th Generation"):
+                line = line.replace("14th", "13th")
+            elif line[:3] == "g/h":
+                line = " ".join(fields[:-2] + ["2020-25"]) + "\n"
+            elif line[:2] in ("g ", "h "):
+                values = [float(value) * scale for value in fields[3:-1]]
+                line = " ".join(fields[:3] + [repr(value) for value in values[:-1]] + [repr((values[-1] - values[-2]) / 5)]) + "\n"
+            lines.append(line)
+    path.write_text("".join(lines))
+    return str(path)
+
+
+def write_old(path):
+    """A model named after its file, ending in 2015 without secular variation"""
+    lines = []
+    with open(DEFAULT_FILE) as f:
+        for line in f:
+            fields = line.split()
+            if line.startswith("# 14th Generation"):
+                line = "# Test model\n"
+            elif line[:3] == "g/h" or line[:2] in ("g ", "h "):
+                line = " ".join(fields[:-3]) + "\n"
+            lines.append(line)
+    path.write_text("".join(lines))
+    return str(path)
+
+
+def test_registry_indexes_each_file_from_its_header(tmp_path):
+    write_igrf13(tmp_path / "igrf13coeffs.txt")
+    registry = pyIGRF.loadCoeffs.ModelRegistry(DEFAULT_FILE, str(tmp_path), reload_seconds=0)
+    igrf13, igrf14 = registry.get("igrf13"), registry.get()
+    assert (registry.default_name, igrf14.name) == ("igrf14", "igrf14")
+    assert (igrf13.epochs[-1], igrf13.intended_end, igrf13.end) == (2020.0, 2025.0, 2030.0)
+    # Same definitive model up to 2020, IGRF-13 extrapolates after it
+    assert np.array_equal(igrf13.coeffs(2017.5)[1], igrf14.coeffs(2017.5)[1])
+    assert igrf13.coeffs(2024.0)[1] == pytest.approx(igrf14.coeffs(2024.0)[1])
+    assert igrf13.coeffs(2031.0) == (0, None, None)
+    with pytest.raises(KeyError, match="igrf13, igrf14"):
+        registry.get("igrf12")
+
+
+def test_new_and_changed_files_are_reloaded(tmp_path):
+    registry = pyIGRF.loadCoeffs.ModelRegistry(DEFAULT_FILE, str(tmp_path), reload_seconds=0)
+    assert sorted(registry.models) == ["igrf14"]
+    path = write_igrf13(tmp_path / "igrf13coeffs.txt")
+    # An unknown name checks the files again before failing
+    first = registry.get("igrf13")
+    assert registry.reload() == []
+
+    write_igrf13(tmp_path / "igrf13coeffs.txt", scale=2.0)
+    os.utime(path, ns=(1, 1))
+    assert registry.reload() == ["igrf13"]
+    second = registry.get("igrf13")
+    assert second is not first and second.digest != first.digest
+    assert second.g[0] == pytest.approx(2 * first.g[0])
+
+    # A broken file keeps the model loaded before it
+    (tmp_path / "igrf13coeffs.txt").write_text("g/h n m\n")
+    assert registry.reload() == []
+    assert registry.get("igrf13") is second
+
+
+def test_requests_choose_a_model(tmp_path, monkeypatch):
+    write_igrf13(tmp_path / "igrf13coeffs.txt", scale=1.01)
+    registry = pyIGRF.loadCoeffs.ModelRegistry(DEFAULT_FILE, str(tmp_path), reload_seconds=0)
+    monkeypatch.setattr(pyIGRF.loadCoeffs, "registry", lambda: registry)
+    points = [{"latitude": "13.9375", "longitude": "4.0625", "altitude": "253.74992", "year": "2015.5"},
+              {"latitude": "-40.5", "longitude": "170.25", "altitude": "0", "year": "2024.9"}]
+    columns = [np.array([float(point[field]) for point in points]) for field in main.POINT_COLUMNS]
+
+    default = client.post("/pyigrf", json=points).json()
+    chosen = client.post("/pyigrf?model=igrf13", json=points).json()
+    expected = igrf_engine.igrf_value_batch(*columns, model="igrf13")
+    assert [result["total_intensity"] for result in chosen] == pytest.approx(expected[-1].tolist())
+    assert chosen[0]["total_intensity"] != pytest.approx(default[0]["total_intensity"])
+    # The result cache keeps the models apart
+    assert client.post("/pyigrf", json=points).json() == default
+
+    grid = {"min_latitude": -40.5, "max_latitude": -40.5, "min_longitude": 170.25, "max_longitude": 170.25,
+            "spacing": 1.0, "altitude": 0, "year": 2024.9}
+    assert client.post("/pyigrf/grid?model=igrf13", json=grid).json()["total_intensity"][0][0] == pytest.approx(chosen[1]["total_intensity"])
+
+    assert client.post("/pyigrf?model=igrf12", json=points).status_code == 404
+    models = client.get("/pyigrf/models").json()
+    assert models["default"] == "igrf14"
+    assert [model["name"] for model in models["models"]] == ["igrf14", "igrf13"]
+    assert client.post("/pyigrf/models/reload").json() == {"loaded": [], "models": ["igrf13", "igrf14"]}
+
+
+def test_years_are_checked_against_the_chosen_model(tmp_path, monkeypatch):
+    write_old(tmp_path / "oldcoeffs.txt")
+    registry = pyIGRF.loadCoeffs.ModelRegistry(DEFAULT_FILE, str(tmp_path), reload_seconds=0)
+    monkeypatch.setattr(pyIGRF.loadCoeffs, "registry", lambda: registry)
+    old = registry.get("old")
+    assert (old.secular, old.end) == (False, 2015.0)
+    with pytest.raises(ValueError, match="2015"):
+        old.series(np.array([2010.0, 2024.9]))
+    # The last epoch keeps the rate of change of the interval before it
+    assert old.series(np.array([2015.0]))[2] == pytest.approx(old.series(np.array([2014.0]))[2])
+
+    reason = "Year must be between 1900 and 2015 for model 'old', got 2024.9"
+    points = [{"latitude": "10", "longitude": "20", "altitude": "0", "year": "2024.9"},
+              {"latitude": "10", "longitude": "20", "altitude": "0", "year": "2010"}]
+    results = client.post("/pyigrf?model=old", json=points).json()
+    assert results[0]["error"] == reason
+    assert results[1]["total_intensity"] > 20000
+    columnar = client.post("/pyigrf?model=old", json={field: [point[field] for point in points] for field in main.POINT_COLUMNS}).json()
+    assert columnar["rejected"] == [{"index": 0, "reason": reason}]
+    assert columnar["total_intensity"][0] is None
+
+    series = client.post("/pyigrf/timeseries?model=old", json={"latitude": 10, "longitude": 20, "altitude": 0,
+                                                               "years": [2010, 2024.9]}).json()
+    assert series["rejected"] == [{"index": 1, "reason": reason}]
+    assert series["total_intensity"][1] is None
+    grid = {"min_latitude": 0, "max_latitude": 0, "min_longitude": 0, "max_longitude": 0, "spacing": 1.0,
+            "altitude": 0, "year": 2024.9}
+    assert client.post("/pyigrf/grid?model=old", json=grid).status_code == 400
+
+
+def test_points_the_engine_cannot_synthesize_are_not_cached(monkeypatch):
+    cache = igrf_cache.MemoryCache()
+    monkeypatch.setattr(main, "result_cache", cache)
+    main.compute_columns(np.array([10.0, 10.0]), np.array([20.0, 20.0]), np.array([0.0, 0.0]), np.array([2024.9, 1899.0]))
+    assert cache.info()["currsize"] == 1
+
+
+def test_endpoints_without_model_selection_refuse_it():
+    body = {"points_json": '[{"latitude": "10", "longitude": "20", "altitude": "0", "year": "2020"}]'}
+    response = client.post("/pyigrf/model?model=nope", json=body)
+    assert response.status_code == 400 and "not supported" in response.json()["detail"]
+    assert client.post("/pyigrf/model?model=igrf14", data=b"", headers={"Content-Type": "application/octet-stream"}).status_code == 400
+    trace = {"points": [{"latitude": 10, "longitude": 20, "altitude": 0}], "year": 2020}
+    assert client.post("/pyigrf/trace?model=igrf14", json=trace).status_code == 400
+    assert client.post("/pyigrf/jobs?model=igrf14", json=[]).status_code == 400
+    assert client.post("/pyigrf/model", json=body).status_code == 200
@@ -0,0 +1,97 @@
+import json
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import igrf_engine
+import igrf_tiles
+import main
+
+client = TestClient(main.app)
+
+
+@pytest.fixture(scope="module")
+def tile_path(tmp_path_factory):
+    # A coarse lattice keeps the build fast, its error bound is a few tens of nT
+    path = str(tmp_path_factory.mktemp("tiles") / "tiles.npy")
+    igrf_tiles.save_tiles(path, *igrf_tiles.build_tiles(2024.9, step=5.0, altitudes=(0.0, 20.0), altitude_step=10.0))
+    return path
+
+
+@pytest.fixture
+def store(tile_path):
+    return igrf_tiles.open_tiles(tile_path, max_error_nt=100.0, max_error_deg=1.0)
+
+
+def test_model_segment():
+    assert igrf_tiles.model_segment(2024.9) == (2020.0, 2025.0)
+    assert igrf_tiles.model_segment(2025.0) == (2025.0, 2030.0)
+    assert igrf_tiles.model_segment(2029.5) == (2025.0, 2030.0)
+    assert igrf_tiles.model_segment(1900.0) == (1900.0, 1905.0)
+
+
+def test_lookup_within_error_bound(store):
+    rng = np.random.default_rng(0)
+    n = 5000
+    lats, longs = rng.uniform(-90, 90, n), rng.uniform(-180, 180, n)
+    # On the altitude levels and between them, over the whole segment
+    altitudes = np.where(rng.random(n) < 0.5, rng.choice([0.0, 10.0, 20.0], n), rng.uniform(0, 20, n))
+    for year in (2020.0, 2022.3, 2024.9):
+        years = np.full(n, year)
+        answered, components = store.lookup(lats, longs, altitudes, years)
+        assert answered.mean() > 0.95
+        exact = np.array(igrf_engine.igrf_value_batch(lats, longs, altitudes, years))[:, answered]
+        error = np.linalg.norm(components[3:6] - exact[3:6], axis=0)
+        assert error.max() <= store.meta["error_nt"]
+        assert np.abs(components[0] - exact[0]).max() <= 1.0
+        assert components[2] == pytest.approx(np.hypot(components[3], components[4]))
+
+
+def test_lookup_leaves_uncovered_points_to_synthesis(store):
+    answered, components = store.lookup([45.0, 45.0, 45.0, 45.0], [10.0] * 4, [0.0, 30.0, 5.0, 5.0], [2022.0, 2022.0, 2025.0, 2019.9])
+    assert answered.tolist() == [True, False, False, False]
+    assert components.shape == (7, 1)
+
+    # Near the dip pole the horizontal field vanishes and the declination error bound grows
+    strict = igrf_tiles.TileStore(store.values, store.meta, max_error_nt=100.0, max_error_deg=0.2)
+    answered, _ = strict.lookup([86.0, 45.0], [150.0, 10.0], [0.0, 0.0], [2022.0, 2022.0])
+    assert answered.tolist() == [False, True]
+
+    # A store whose bound is above the limit answers nothing
+    assert not igrf_tiles.TileStore(store.values, store.meta, max_error_nt=1.0).lookup([45.0], [10.0], [0.0], [2022.0])[0].any()
+
+
+def test_open_refuses_other_coefficients(tile_path, tmp_path):
+    path = str(tmp_path / "tiles.npy")
+    values = np.load(tile_path)
+    with open(igrf_tiles.metadata_path(tile_path)) as f:
+        meta = json.load(f)
+    igrf_tiles.save_tiles(path, values, dict(meta, coefficients="0" * 16))
+    with pytest.raises(ValueError, match="other coefficients"):
+        igrf_tiles.open_tiles(path)
+    assert igrf_tiles.from_env({"IGRF_TILES": path}) is None
+    assert isinstance(igrf_tiles.open_tiles(tile_path).values, np.memmap)
+
+
+def test_endpoints_report_the_source(store, monkeypatch):
+    points = [{"latitude": "45", "longitude": "10", "altitude": "0", "year": "2024.9"},
+              {"latitude": "45", "longitude": "10", "altitude": "100", "year": "2024.9"},
+              {"latitude": "95", "longitude": "10", "altitude": "0", "year": "2024.9"}]
+    assert "source" not in client.post("/pyigrf", json=points[:1]).json()[0]
+    assert client.get("/pyigrf/tiles").status_code == 404
+
+    monkeypatch.setattr(main, "tile_store", store)
+    tiled, exact, rejected = client.post("/pyigrf", json=points).json()
+    assert (tiled["source"], exact["source"]) == ("tile", "exact")
+    assert "source" not in rejected
+    expected = igrf_engine.igrf_value_batch(45.0, 10.0, 0.0, 2024.9)
+    assert tiled["total_intensity"] == pytest.approx(expected[-1][0], abs=store.meta["error_nt"])
+
+    columnar = client.post("/pyigrf", json={"latitude": [45, 45, 95], "longitude": [10, 10, 10],
+                                            "altitude": [0, 100, 0], "year": [2024.9] * 3}).json()
+    assert columnar["source"] == ["tile", "exact", None]
+    assert client.post("/pyigrf?format=columnar", json=points[:2]).json()["source"] == ["tile", "exact"]
+
+    info = client.get("/pyigrf/tiles").json()
+    assert (info["epoch_start"], info["epoch_end"], info["step"]) == (2020.0, 2025.0, 5.0)
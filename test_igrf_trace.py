@@ -0,0 +1,97 @@
+import types
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import igrf_engine
+import igrf_trace
+import main
+
+client = TestClient(main.app)
+
+LATS = [13.9375, 60.0, -45.0]
+LONGS = [4.0625, -100.0, 170.0]
+
+
+def test_geodetic_round_trip():
+    lat, lon, alt = np.array([0.0, 45.0, -89.9, 90.0]), np.array([0.0, 10.0, -170.0, 0.0]), np.array([0.0, 100.0, 5.0, 40000.0])
+    back = igrf_trace.ecef_to_geodetic(igrf_trace.geodetic_to_ecef(lat, lon, alt))
+    for values, expected in zip(back, (lat, lon, alt)):
+        assert values == pytest.approx(expected, abs=1e-9)
+
+
+def test_field_matches_engine():
+    b = igrf_trace.field_ecef(igrf_trace.geodetic_to_ecef([45.0], [10.0], [100.0]), 2024.9)
+    assert np.linalg.norm(b) == pytest.approx(igrf_engine.igrf_value_batch(45.0, 10.0, 100.0, 2024.9)[-1][0])
+
+
+def test_trace_back_from_conjugate_point():
+    traced = igrf_trace.trace_field_lines(LATS, LONGS, [0.0] * 3, 2024.9)
+    assert traced["status"].tolist() == [0, 0, 0]
+    assert traced["end_altitude"] == pytest.approx([0.0] * 3, abs=0.01)
+    # The conjugate point is in the other magnetic hemisphere
+    assert np.sign(traced["end_latitude"][1:]).tolist() == [-1, 1]
+
+    back = igrf_trace.trace_field_lines(traced["end_latitude"], traced["end_longitude"], [0.0] * 3, 2024.9)
+    assert back["end_latitude"] == pytest.approx(LATS, abs=1e-3)
+    assert back["end_longitude"] == pytest.approx(LONGS, abs=1e-3)
+
+
+def test_path_follows_the_field():
+    traced = igrf_trace.trace_field_lines([60.0], [-100.0], [0.0], 2024.9, tolerance=0.001, include_path=True)
+    positions = igrf_trace.geodetic_to_ecef(*traced["path"][0])
+    assert len(positions) == traced["steps"][0] + 1
+    segments = np.diff(positions, axis=0)
+    field = igrf_trace.field_ecef((positions[1:] + positions[:-1]) / 2, 2024.9)
+    cosines = np.abs(np.einsum('ij,ij->i', segments, field)) / np.linalg.norm(segments, axis=1) / np.linalg.norm(field, axis=1)
+    assert cosines.min() > 0.9999
+
+
+def test_lines_are_traced_independently_of_the_batch():
+    batch = igrf_trace.trace_field_lines(LATS + [80.0], LONGS + [10.0], [0.0, 0.0, 300.0, 0.0], 2024.9, max_radius=10 * igrf_engine.RE)
+    single = igrf_trace.trace_field_lines([LATS[1]], [LONGS[1]], [0.0], 2024.9, max_radius=10 * igrf_engine.RE)
+    assert batch["end_latitude"][1] == single["end_latitude"][0]
+    # A high latitude line leaves 10 Earth radii before coming back down
+    assert igrf_trace.STATUSES[batch["status"][3]] == "max_radius"
+
+
+def test_trace_endpoint():
+    body = {"points": [{"latitude": "60", "longitude": -100, "altitude": 0},
+                       {"latitude": 95, "longitude": 0, "altitude": 0}],
+            "year": 2024.9, "include_path": True}
+    response = client.post("/pyigrf/trace", json=body)
+    assert response.status_code == 200
+    line, rejected = response.json()
+    assert line["status"] == "stop_altitude"
+    assert line["end_latitude"] == pytest.approx(-72.8, abs=0.1)
+    assert len(line["path"]["latitude"]) == line["steps"] + 1
+    assert rejected["error"] == "Latitude must be between -90 and 90, got 95.0"
+
+    assert client.post("/pyigrf/trace", json=dict(body, direction="sideways")).status_code == 400
+    assert client.post("/pyigrf/trace", json=dict(body, year=1800)).status_code == 400
+
+
+def test_trace_year_is_checked_against_the_model(monkeypatch):
+    model = types.SimpleNamespace(name="old", start=1900.0, end=2015.0)
+    monkeypatch.setattr(main.pyIGRF.loadCoeffs, "get_model", lambda name=None: model)
+    body = {"points": [{"latitude": 60, "longitude": -100, "altitude": 0}], "year": 2024.9}
+    response = client.post("/pyigrf/trace", json=body)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Year must be between 1900 and 2015 for model 'old', got 2024.9"
+
+
+def test_lines_stop_where_the_field_vanishes(monkeypatch):
+    field_ecef = igrf_trace.field_ecef
+
+    def vanishing_field(pos, year):
+        b = field_ecef(pos, year)
+        b[np.linalg.norm(pos, axis=1) > igrf_engine.RE + 100.0] = 0.0
+        return b
+
+    monkeypatch.setattr(igrf_trace, "field_ecef", vanishing_field)
+    with np.errstate(all="raise"):
+        traced = igrf_trace.trace_field_lines([60.0, 0.0], [-100.0, 0.0], [0.0, 200.0], 2024.9)
+    assert [igrf_trace.STATUSES[status] for status in traced["status"]] == ["no_field", "no_field"]
+    assert traced["steps"][0] > 0 and traced["steps"][1] == 0
+    assert traced["max_altitude"][0] < 120.0
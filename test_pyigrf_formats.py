@@ -0,0 +1,299 @@
+import asyncio
+import json
+import types
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+points = [
+    {"latitude": "13.9375", "longitude": "4.0625", "altitude": "253.74992", "year": "2024.9"},
+    {"latitude": "13.9375", "longitude": "4.1875", "altitude": "255.7499", "year": "2024.9"},
+    {"latitude": "13.8125", "longitude": "4.0625", "altitude": "301.00001", "year": "2024.9"},
+    {"latitude": "13.8125", "longitude": "4.1875", "altitude": "307.25054", "year": "2024.9"},
+    {"latitude": "13.9375", "longitude": "4.3125", "altitude": "275.74988", "year": "2024.9"}
+]
+
+
+def test_ndjson_stream_matches_json(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_BATCH_POINTS", 2)
+    body = "\n".join(json.dumps(point) for point in points)
+    response = client.post("/pyigrf", data=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    streamed = [json.loads(line) for line in response.text.splitlines()]
+    # Batch boundaries differ, so allow for the last bit of floating point summation
+    assert streamed == [pytest.approx(result) for result in client.post("/pyigrf", json=points).json()]
+
+
+def columns():
+    return {column: [point[column] for point in points] for column in main.POINT_COLUMNS}
+
+
+def test_columnar_request_matches_rows():
+    rows = client.post("/pyigrf", json=points).json()
+    response = client.post("/pyigrf", json=columns())
+    assert response.status_code == 200
+    result = response.json()
+    for field in main.RESULT_COMPONENTS:
+        assert result[field] == pytest.approx([row[field] for row in rows])
+
+    model = client.post("/pyigrf/model", json={"points_json": json.dumps({"points_json": columns()})}).json()
+    assert model == result
+
+
+def test_model_endpoint_rejects_invalid_points():
+    invalid = [dict(points[0], latitude="95"), dict(points[1], year="1800"), points[2]]
+    expected = client.post("/pyigrf", json=invalid).json()
+    results = client.post("/pyigrf/model", json={"points_json": json.dumps(invalid)}).json()
+    assert results == expected
+    assert "Latitude" in results[0]["error"] and "1800" in results[1]["error"]
+    assert "error" not in results[2]
+
+    columnar = {"points_json": json.dumps({column: [point[column] for point in invalid] for column in main.POINT_COLUMNS})}
+    result = client.post("/pyigrf/model", json=columnar).json()
+    assert [rejected["index"] for rejected in result["rejected"]] == [0, 1]
+    assert result["total_intensity"][:2] == [None, None]
+
+
+def test_rows_with_columnar_response():
+    rows = client.post("/pyigrf", json=points).json()
+    result = client.post("/pyigrf?format=columnar", json=points).json()
+    assert result["total_intensity"] == [row["total_intensity"] for row in rows]
+
+
+def test_ndjson_lines_split_across_chunks(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_LINE_BYTES", 200)
+    body = ("\n".join(json.dumps(point) for point in points) + "\n").encode()
+
+    async def stream():
+        for start in range(0, len(body), 7):
+            yield body[start:start + 7]
+
+    spool = asyncio.run(main.spool_point_results(types.SimpleNamespace(stream=stream)))
+    streamed = [json.loads(line) for line in b"".join(main.iter_spool(spool)).splitlines()]
+    assert streamed == [pytest.approx(result) for result in client.post("/pyigrf", json=points).json()]
+
+    long_line = json.dumps(dict(points[0], padding=" " * 200))
+    for body in (long_line, long_line + "\n" + json.dumps(points[1])):
+        response = client.post("/pyigrf", data=body, headers={"Content-Type": "application/x-ndjson"})
+        assert response.status_code == 413
+
+
+def test_binary_request():
+    body = np.array([[float(value) for value in column] for column in columns().values()], dtype="<f8").tobytes()
+    response = client.post("/pyigrf", data=body, headers={"Content-Type": "application/octet-stream"})
+    assert response.status_code == 200
+    assert response.headers["x-igrf-columns"].split(",") == main.RESULT_COMPONENTS
+    components = np.frombuffer(response.content, dtype="<f8").reshape(len(main.RESULT_COMPONENTS), -1)
+    expected = client.post("/pyigrf", json=columns()).json()
+    for field, values in zip(main.RESULT_COMPONENTS, components):
+        assert values.tolist() == pytest.approx(expected[field])
+
+    model = client.post("/pyigrf/model", data=body, headers={"Content-Type": "application/octet-stream"})
+    assert model.content == response.content
+
+    assert client.post("/pyigrf", data=body[:-8], headers={"Content-Type": "application/octet-stream"}).status_code == 400
+
+
+def test_binary_requests_are_limited_like_json(monkeypatch):
+    body = np.zeros((len(main.POINT_COLUMNS), 3), dtype="<f8").tobytes()
+    headers = {"Content-Type": "application/octet-stream"}
+    monkeypatch.setattr(main, "MAX_POINTS", 2)
+    for path in ("/pyigrf", "/pyigrf/model"):
+        response = client.post(path, data=body, headers=headers)
+        assert response.status_code == 413 and "Too many points" in response.json()["detail"]
+    monkeypatch.setattr(main, "MAX_REQUEST_SIZE", len(body) - 1)
+    assert "too large" in client.post("/pyigrf", data=body, headers=headers).json()["detail"]
+
+
+def test_parser_accepts_every_documented_shape():
+    point = points[0]
+    array = json.dumps([point])
+    bodies = [
+        array,
+        json.dumps({"points_json": [point]}),
+        json.dumps({"points_json": array}),
+        json.dumps({"points_json": json.dumps({"points_json": [point]})}),
+        json.dumps(json.dumps({"points_json": [point]})),
+        json.dumps(array),
+        json.dumps(point),
+        # Escaped quotes without the enclosing string
+        json.dumps({"points_json": [point]}).replace('"', '\\"'),
+    ]
+    for body in bodies:
+        assert main.igrf_parser.parse_points(body.encode()) == [point], body
+
+
+def test_parser_errors_are_bad_requests():
+    assert client.post("/pyigrf", data="{nope").status_code == 400
+    assert client.post("/pyigrf", data="42").status_code == 400
+
+
+def test_large_batches_use_process_pool(monkeypatch):
+    # The default is 0 on a single CPU
+    monkeypatch.setattr(main, "IGRF_PROCESSES", 2)
+    monkeypatch.setattr(main, "PROCESS_MIN_POINTS", 1000)
+    monkeypatch.setattr(main, "CHUNK_POINTS", 300)
+    rng = np.random.default_rng(1)
+    columns = [rng.uniform(-90, 90, 2000), rng.uniform(-180, 180, 2000), rng.uniform(0, 1000, 2000),
+               rng.choice([1957.3, 2024.9], 2000)]
+    assert main.executor_for(2000) is main.get_process_pool()
+    assert main.executor_for(999) is main.igrf_executor
+    merged = main.compute_columns(*columns)
+    expected = main.igrf_engine.igrf_value_batch(*columns)
+    for component, values in zip(merged, expected):
+        assert component.tolist() == pytest.approx(values.tolist())
+
+
+def test_metrics_endpoint():
+    client.post("/pyigrf", json=points)
+    client.post("/pyigrf", json=[{"latitude": "95", "longitude": "0", "altitude": "0", "year": "2024.9"}])
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    samples = {}
+    for line in response.text.splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    for stage in ("read", "parse", "validate", "compute", "serialize"):
+        assert samples[f'igrf_stage_seconds_count{{stage="{stage}"}}'] >= 1
+    assert samples['igrf_request_seconds_bucket{path="/pyigrf",le="+Inf"}'] >= 2
+    assert samples["igrf_rejected_points_total"] >= 1
+    assert 'igrf_cache_hits{cache="coefficients"}' in samples
+    assert sum(value for name, value in samples.items() if name.startswith("igrf_points_total")) >= len(points)
+
+
+def test_invalid_points_are_rejected_with_reasons():
+    invalid = [
+        {"latitude": "95", "longitude": "0", "altitude": "0", "year": "2024.9"},
+        {"longitude": "0", "altitude": "0", "year": "2024.9"},
+        {"latitude": "north", "longitude": "0", "altitude": "0", "year": "2024.9"},
+        {"latitude": "10", "longitude": "0", "altitude": "-1", "year": "1800"},
+        None,
+    ]
+    body = [points[0]] + invalid + [points[1]]
+    results = client.post("/pyigrf", json=body).json()
+    expected = client.post("/pyigrf", json=[points[0], points[1]]).json()
+    assert [results[0], results[-1]] == expected
+    assert results[1] == {"latitude": 95.0, "longitude": 0.0, "altitude": 0.0, "year": 2024.9,
+                          "error": "Latitude must be between -90 and 90, got 95.0"}
+    assert results[2]["latitude"] is None and results[2]["error"] == "Missing field 'latitude'"
+    assert results[3]["error"] == "Invalid value for latitude: 'north'"
+    # The first failing check is reported
+    assert results[4]["error"] == "Altitude must be a non-negative number, got -1.0"
+    assert results[5]["error"] == "Point must be an object"
+    assert all("total_intensity" not in result for result in results[1:-1])
+
+    _, batch_indices, _, rejected = main.validate_points(body, start_index=10)
+    assert batch_indices.tolist() == [0, 6]
+    assert [entry["index"] for entry in rejected] == [11, 12, 13, 14, 15]
+
+    columnar = client.post("/pyigrf?format=columnar", json=body).json()
+    assert columnar["total_intensity"][1:-1] == [None] * len(invalid)
+    assert [entry["index"] for entry in columnar["rejected"]] == [1, 2, 3, 4, 5]
+
+
+def test_invalid_columns_are_rejected_with_reasons():
+    data = columns()
+    data["year"][1] = "1800"
+    result = client.post("/pyigrf", json=data).json()
+    assert result["rejected"] == [{"index": 1, "reason": "Year must be between 1900 and 2030, got 1800.0"}]
+    assert result["declination"][1] is None and None not in result["declination"][2:]
+
+    body = np.array([[float(value) for value in column] for column in data.values()], dtype="<f8").tobytes()
+    response = client.post("/pyigrf", data=body, headers={"Content-Type": "application/octet-stream"})
+    components = np.frombuffer(response.content, dtype="<f8").reshape(len(main.RESULT_COMPONENTS), -1)
+    assert np.isnan(components[:, 1]).all() and not np.isnan(components[:, 2:]).any()
+    model = client.post("/pyigrf/model", data=body, headers={"Content-Type": "application/octet-stream"})
+    assert model.content == response.content
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_encoder_keeps_point_result_fields(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(main.igrf_encoder, "orjson", None)
+    elif main.igrf_encoder.orjson is None:
+        pytest.skip("orjson is not installed")
+    response = client.post("/pyigrf", json=points)
+    assert response.headers["content-type"] == "application/json"
+    results = response.json()
+    assert list(results[0]) == list(main.point_result(0, 0, 0, 0, [0.0] * len(main.RESULT_COMPONENTS)))
+    columnar = client.post("/pyigrf", json=columns()).json()
+    assert columnar["total_intensity"] == [result["total_intensity"] for result in results]
+
+
+def test_stdlib_encoder_writes_rejected_points_as_null(monkeypatch):
+    monkeypatch.setattr(main.igrf_encoder, "orjson", None)
+    data = columns()
+    data["latitude"][1] = "95"
+    response = client.post("/pyigrf", json=data)
+    assert response.status_code == 200
+    assert response.json()["total_intensity"][1] is None
+    assert main.igrf_encoder.dumps({"a": np.array([1.0, np.nan]), "b": float("inf")}) == b'{"a":[1.0,null],"b":null}'
+
+
+def test_large_responses_are_gzipped(monkeypatch):
+    monkeypatch.setattr(main, "GZIP_MIN_BYTES", 100)
+    response = client.post("/pyigrf", json=points, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json() == client.post("/pyigrf", json=points, headers={"Accept-Encoding": "identity"}).json()
+    assert "content-encoding" not in client.post("/pyigrf", json=points[:1], headers={"Accept-Encoding": "gzip;q=0"}).headers
+
+
+def test_geocentric_coordinates_flag():
+    geodetic = client.post("/pyigrf", json=points).json()
+    geocentric = client.post("/pyigrf?coordinates=geocentric", json=points).json()
+    expected = main.igrf_engine.igrf_value_batch(*(np.array([float(point[field]) for point in points]) for field in main.POINT_COLUMNS),
+                                                 itype=2)
+    assert [result["total_intensity"] for result in geocentric] == pytest.approx(expected[-1].tolist())
+    assert geocentric[0]["total_intensity"] != pytest.approx(geodetic[0]["total_intensity"])
+
+    columnar = client.post("/pyigrf?coordinates=geocentric", json=columns()).json()
+    assert columnar["total_intensity"] == [result["total_intensity"] for result in geocentric]
+    assert client.post("/pyigrf?coordinates=ecef", json=points).status_code == 400
+
+
+def test_geodetic_only_endpoints_refuse_geocentric_points():
+    requests = [("/pyigrf/grid", {"min_latitude": 0, "max_latitude": 0, "min_longitude": 0, "max_longitude": 0,
+                                  "spacing": 1.0, "altitude": 0, "year": 2020}),
+                ("/pyigrf/timeseries", {"latitude": 10, "longitude": 20, "altitude": 0, "years": [2020]}),
+                ("/pyigrf/trace", {"points": [{"latitude": 10, "longitude": 20, "altitude": 0}], "year": 2020}),
+                ("/pyigrf/jobs", points),
+                ("/pyigrf/model", {"points_json": json.dumps(points)})]
+    for path, body in requests:
+        response = client.post(path + "?coordinates=geocentric", json=body)
+        assert response.status_code == 400 and "Geocentric" in response.json()["detail"], path
+    assert client.post("/pyigrf/timeseries?coordinates=geodetic", json=requests[1][1]).status_code == 200
+
+
+def test_failed_calculations_fail_the_request(monkeypatch):
+    igrf_value_batch = main.igrf_engine.igrf_value_batch
+
+    def slow(*args, **kwargs):
+        main.time.sleep(0.2)
+        return igrf_value_batch(*args, **kwargs)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError
+
+    monkeypatch.setattr(main, "result_cache", None)
+    monkeypatch.setattr(main, "point_batcher", None)
+    monkeypatch.setattr(main.igrf_engine, "igrf_value_batch", fail)
+    assert client.post("/pyigrf", json=points).status_code == 500
+    body = "\n".join(json.dumps(point) for point in points)
+    assert client.post("/pyigrf", data=body, headers={"Content-Type": "application/x-ndjson"}).status_code == 500
+    monkeypatch.setattr(main.igrf_engine, "igrf_value_grid", fail)
+    grid = {"min_latitude": 0, "max_latitude": 0, "min_longitude": 0, "max_longitude": 0, "spacing": 1.0,
+            "altitude": 0, "year": 2020}
+    assert client.post("/pyigrf/grid", json=grid).status_code == 500
+
+    monkeypatch.setattr(main, "CHUNK_TIMEOUT", 0.01)
+    monkeypatch.setattr(main.igrf_engine, "igrf_value_batch", slow)
+    response = client.post("/pyigrf", json=columns())
+    assert response.status_code == 504 and "timed out" in response.json()["detail"]